@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+EXAMPLE = """Example:
+  python3 benchmark/run_benchmark.py --dates 30 --iws 1 2 3 --workers 1 2 4 8
+  python3 benchmark/run_benchmark.py --cost cost.json --save base.json
+  python3 benchmark/run_benchmark.py --cost cost.json --baseline base.json
+  python3 benchmark/run_benchmark.py --formats BEAM-DIMAP GeoTIFF-BigTIFF --workers 4
+"""
+
+
+def cmdline_parser():
+    parser = argparse.ArgumentParser(
+        description='Run the whole chain on a synthetic stack with a stub gpt.',
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=EXAMPLE)
+
+    parser.add_argument('--dates',
+                        type=int,
+                        default=10,
+                        help='number of acquisition dates (default: 10)')
+    parser.add_argument('--iws',
+                        nargs='+',
+                        default=['1'],
+                        choices=['1', '2', '3'],
+                        help='subswaths to process (default: 1)')
+    parser.add_argument('--workers',
+                        type=int,
+                        nargs='+',
+                        default=[1, 2, 4],
+                        help='values of --jobs to compare (default: 1 2 4)')
+    parser.add_argument('--cost',
+                        default='{}',
+                        help='cost model of the stub gpt, JSON or JSON file\n' +
+                        '(see benchmark/gpt)')
+    parser.add_argument('--formats',
+                        nargs='+',
+                        default=['BEAM-DIMAP'],
+                        help='--format values of the intermediate products to compare\n' +
+                        '(default: BEAM-DIMAP)')
+    parser.add_argument('--subset',
+                        type=int,
+                        nargs=4,
+                        metavar=('X0', 'X1', 'Y0', 'Y1'),
+                        help='also run subset.py rdc with this region')
+    parser.add_argument('--work-dir',
+                        help='directory for the synthetic stack (default: temporary)')
+    parser.add_argument('--save', help='save the results as JSON to this file')
+    parser.add_argument('--baseline',
+                        help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.2,
+                        help='allowed relative increase of planning time (default: 0.2)')
+    inps = parser.parse_args()
+
+    return inps
+
+
+def make_stack(work_dir, num_dates, iws):
+    """Create empty zips and a date.info for num_dates dates, return the dates."""
+    zip_dir = os.path.join(work_dir, 'zips')
+    os.makedirs(zip_dir, exist_ok=True)
+
+    start = datetime.date(2020, 1, 6)
+    dates = [(start + datetime.timedelta(days=12 * i)).strftime('%Y%m%d')
+             for i in range(num_dates)]
+    with open(os.path.join(work_dir, 'date.info'), 'w') as f:
+        f.write('# date IW first_burst last_burst\n')
+        for date in dates:
+            name = f"S1A_IW_SLC__1SDV_{date}T100001_{date}T100028_000000_000000_0000.zip"
+            open(os.path.join(zip_dir, name), 'w').close()
+            for iw in iws:
+                f.write(f"{date} {iw} 1 2\n")
+
+    return dates
+
+
+def stage_commands(work_dir, master, iws, subset, fmt='BEAM-DIMAP'):
+    """Return [(stage, args, output_dir)] of the chain in processing order."""
+    d = lambda name: os.path.join(work_dir, name)
+    f = ['--format', fmt]
+    stages = [
+        ('split_orbit', ['split_orbit.py', d('zips'), d('slc'), d('date.info')] + f,
+         d('slc')),
+        ('coreg', ['coreg.py', d('slc'), d('coreg'), master] + f, d('coreg')),
+    ]
+    product_dir = d('coreg')
+    if len(iws) > 1:
+        stages.append(('merge', ['merge.py', product_dir, d('merge')] + f, d('merge')))
+        product_dir = d('merge')
+    if subset:
+        region = [str(i) for i in subset]
+        stages.append(('subset', ['subset.py', product_dir, d('subset'), 'rdc'] +
+                       region + f, d('subset')))
+        product_dir = d('subset')
+    stages.append(('ifg', ['ifg.py', product_dir, d('ifg')] + f, d('ifg')))
+    stages.append(('psi_export',
+                   ['psi_export.py', product_dir, d('ifg'), d('INSAR_' + master)],
+                   d('INSAR_' + master)))
+
+    return stages
+
+
+def dir_size(path):
+    """Return the size in bytes of the files under path, without xml/."""
+    size = 0
+    for root, dirs, files in os.walk(path):
+        if root == path and 'xml' in dirs:
+            dirs.remove('xml')
+        size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+
+    return size
+
+
+def read_trace(trace_file):
+    """Return start and end times of every graph in the trace of the stub gpt."""
+    starts = {}
+    ends = {}
+    if os.path.isfile(trace_file):
+        with open(trace_file, 'r') as f:
+            for line in f:
+                stamp, event, xml_path = line.split(maxsplit=2)
+                target = starts if event == 'start' else ends
+                target[xml_path.strip()] = float(stamp)
+
+    return starts, ends
+
+
+def ideal_makespan(job_times, workers):
+    """Makespan of the measured jobs on workers with no orchestration cost."""
+    loads = [0.0] * workers
+    for job_time in sorted(job_times, reverse=True):
+        loads[loads.index(min(loads))] += job_time
+
+    return max(loads)
+
+
+def run_stage(stage, args, workers, env, trace_file, output_dir):
+    """Run one stage script and return its timings and output size."""
+    env = dict(env, FAKE_GPT_TRACE=trace_file)
+    cmd = [sys.executable] + args + ['--jobs', str(workers)]
+
+    time_start = time.time()
+    process = subprocess.run(cmd,
+                             cwd=REPO_DIR,
+                             env=env,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.STDOUT)
+    wall = time.time() - time_start
+
+    starts, ends = read_trace(trace_file)
+    job_times = [ends[p] - starts[p] for p in ends if p in starts]
+    planning = (min(starts.values()) - time_start) if starts else wall
+    busy = sum(job_times)
+    ideal = ideal_makespan(job_times, workers)
+
+    return {
+        'stage': stage,
+        'workers': workers,
+        'returncode': process.returncode,
+        'jobs': len(starts),
+        'failed': len(starts) - len(job_times),
+        'wall_time': wall,
+        'planning_time': planning,
+        'gpt_time': busy,
+        'overhead': wall - ideal,
+        'disk': dir_size(output_dir),
+    }
+
+
+def run_chain(work_dir, num_dates, iws, workers, cost, subset, fmt='BEAM-DIMAP'):
+    """Run the chain on a fresh synthetic stack, return the stage results."""
+    if os.path.isdir(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    dates = make_stack(work_dir, num_dates, iws)
+
+    env = dict(os.environ)
+    env['PATH'] = BENCHMARK_DIR + os.pathsep + env.get('PATH', '')
+    env['FAKE_GPT_COST'] = cost
+
+    results = []
+    for stage, args, output_dir in stage_commands(work_dir, dates[0], iws, subset, fmt):
+        trace_file = os.path.join(work_dir, f"{stage}.trace")
+        result = run_stage(stage, args, workers, env, trace_file, output_dir)
+        result['format'] = fmt
+        results.append(result)
+
+    return results
+
+
+def print_results(results):
+    print(f"\n{'format':<16} {'stage':<12} {'jobs':>5} {'workers':>7} {'wall':>8} "
+          f"{'gpt':>8} {'planning':>9} {'overhead':>9} {'speedup':>8} {'disk MB':>9}")
+    single = {(r['format'], r['stage']): r['wall_time']
+              for r in results if r['workers'] == 1}
+    for r in results:
+        speedup = single.get((r['format'], r['stage']))
+        speedup = f"{speedup / r['wall_time']:.2f}" if speedup else '-'
+        print(f"{r['format']:<16} {r['stage']:<12} {r['jobs']:>5} {r['workers']:>7} "
+              f"{r['wall_time']:>8.2f} {r['gpt_time']:>8.2f} "
+              f"{r['planning_time']:>9.3f} {r['overhead']:>9.3f} {speedup:>8} "
+              f"{r['disk'] / 2**20:>9.1f}")
+        if r['returncode'] != 0 or r['failed']:
+            print(f"  warning: {r['stage']} returned {r['returncode']} "
+                  f"with {r['failed']} failed jobs")
+
+
+def print_formats(results):
+    """Print end-to-end time and disk footprint of the chain per format."""
+    totals = {}
+    for r in results:
+        total = totals.setdefault((r['format'], r['workers']), [0.0, 0])
+        total[0] += r['wall_time']
+        total[1] += r['disk']
+
+    print(f"\n{'format':<16} {'workers':>7} {'wall':>8} {'disk MB':>9} "
+          f"{'wall x':>7} {'disk x':>7}")
+    reference = {}
+    for (fmt, workers), (wall, disk) in totals.items():
+        first = reference.setdefault(workers, (wall, disk))
+        # relative to the first format of --formats
+        print(f"{fmt:<16} {workers:>7} {wall:>8.2f} {disk / 2**20:>9.1f} "
+              f"{wall / first[0]:>7.2f} {disk / first[1] if first[1] else 0:>7.2f}")
+
+
+def compare_baseline(results, baseline, tolerance):
+    """Print stages whose planning time regressed, return their number."""
+    reference = {(r.get('format', 'BEAM-DIMAP'), r['stage'], r['workers']): r
+                 for r in baseline['results']}
+    regressions = 0
+    for r in results:
+        ref = reference.get((r['format'], r['stage'], r['workers']))
+        if ref is None:
+            continue
+        # absolute slack of 50 ms for the jitter of process startup
+        limit = ref['planning_time'] * (1 + tolerance) + 0.05
+        if r['planning_time'] > limit:
+            regressions += 1
+            print(f"Regression: {r['stage']} with {r['workers']} workers plans in "
+                  f"{r['planning_time']:.3f}s, baseline {ref['planning_time']:.3f}s")
+
+    if regressions == 0:
+        print('No planning time regression against the baseline.')
+
+    return regressions
+
+
+if __name__ == "__main__":
+    inps = cmdline_parser()
+
+    work_root = inps.work_dir or tempfile.mkdtemp(prefix='snap2stamps_bench_')
+    work_root = os.path.abspath(work_root)
+
+    results = []
+    for fmt in inps.formats:
+        for workers in inps.workers:
+            work_dir = os.path.join(work_root, f"{fmt}_workers_{workers}")
+            print(f"Running chain on {inps.dates} dates, IW {' '.join(inps.iws)} "
+                  f"with {workers} workers and {fmt} in {work_dir}")
+            results.extend(
+                run_chain(work_dir, inps.dates, inps.iws, workers, inps.cost,
+                          inps.subset, fmt))
+
+    print_results(results)
+    if len(inps.formats) > 1:
+        print_formats(results)
+
+    if inps.save:
+        with open(inps.save, 'w') as f:
+            json.dump({
+                'dates': inps.dates,
+                'iws': inps.iws,
+                'results': results
+            }, f, indent=2)
+
+    regressions = 0
+    if inps.baseline:
+        with open(inps.baseline, 'r') as f:
+            regressions = compare_baseline(results, json.load(f), inps.tolerance)
+
+    if not inps.work_dir:
+        shutil.rmtree(work_root)
+
+    sys.exit(1 if regressions else 0)
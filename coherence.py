@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import argparse
+import csv
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import product_format
+from dimap import DimapProduct, band_date, windows
+from gpt_resources import MEMORY_FRACTION, cpu_count, memory_info
+from ifg import IFG_XML
+
+# boxcar window of the Interferogram operator
+COH_WIN_AZ = int(re.search(r'<cohWinAz>(\d+)</cohWinAz>', IFG_XML).group(1))
+COH_WIN_RG = int(re.search(r'<cohWinRg>(\d+)</cohWinRg>', IFG_XML).group(1))
+BLOCK_LINES = 512
+HIST_BINS = 1000
+LOW_COHERENCE = 0.3
+# peak bytes a process holds per pixel of a block: complex master, slave
+# and cross products with the cumulative sums of their boxcars
+BLOCK_BYTES_PER_PIXEL = 150
+
+EXAMPLE = """Example:
+  python3 coherence.py /ly/coreg /ly/coherence
+  python3 coherence.py /ly/coreg /ly/coherence --jobs 8 --looks 4 20
+"""
+
+
+def cmdline_parser():
+    parser = argparse.ArgumentParser(
+        description='Estimate the coherence of every pair of the coregistered ' +
+        'products without SNAP,\nto find decorrelated pairs before exporting.',
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=EXAMPLE)
+
+    parser.add_argument('coreg_dir', help='directory of coregistered products')
+    parser.add_argument('output_dir', help='output directory, gets coherence.csv')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        help='number of processes, each holding about ' +
+                        f"{BLOCK_BYTES_PER_PIXEL} bytes per pixel\n" +
+                        'of a block, e.g. 2G for 512 lines of 25000 samples\n' +
+                        '(default: as many as fit into the available memory,\n' +
+                        'at most the number of CPUs)')
+    parser.add_argument('--window',
+                        type=int,
+                        nargs=2,
+                        default=[COH_WIN_AZ, COH_WIN_RG],
+                        metavar=('AZ', 'RG'),
+                        help='coherence window (default: %(default)s as in ifg.py)')
+    parser.add_argument('--looks',
+                        type=int,
+                        nargs=2,
+                        metavar=('AZ', 'RG'),
+                        help='also write each coherence multilooked by AZ x RG as ENVI')
+    parser.add_argument('--block-lines',
+                        type=int,
+                        default=BLOCK_LINES,
+                        help='azimuth lines per block (default: %(default)s)')
+    inps = parser.parse_args()
+
+    return inps
+
+
+def box_sum(a, size, axis):
+    """Sum a over a window of size along axis, clipped at the edges.
+
+    Uses a cumulative sum, so the cost does not grow with the window.
+    """
+    n = a.shape[axis]
+    c = np.cumsum(a, axis=axis)
+    c = np.concatenate([np.zeros_like(c.take([0], axis=axis)), c], axis=axis)
+    index = np.arange(n)
+    start = np.clip(index - (size - 1) // 2, 0, n)
+    stop = np.clip(index + size // 2 + 1, 0, n)
+
+    return c.take(stop, axis=axis) - c.take(start, axis=axis)
+
+
+def boxcar(a, win_az, win_rg):
+    return box_sum(box_sum(a, win_az, 0), win_rg, 1)
+
+
+def read_complex(product, i_band, window):
+    i = product.band(i_band).read(window).astype('f8')
+    q = product.band('q' + i_band[1:]).read(window).astype('f8')
+
+    return i + 1j * q
+
+
+def block_coherence(dim_path, master_band, slave_band, rows, win, looks):
+    """Return histogram, sum and count of the coherence of rows of a pair.
+
+    Rows are read with half a window of margin, so that blocks give the
+    same result as the whole image. Pixels where either image is zero are
+    left out; with looks the multilooked block is returned as well.
+    """
+    product = DimapProduct(dim_path)
+    row_start, row_stop = rows
+    pad_start = min(row_start, (win[0] - 1) // 2)
+    pad_stop = min(product.height - row_stop, win[0] // 2)
+    window = (row_start - pad_start, row_stop + pad_stop, 0, product.width)
+
+    master = read_complex(product, master_band, window)
+    slave = read_complex(product, slave_band, window)
+    cross = boxcar(master * np.conj(slave), *win)
+    power = boxcar(np.abs(master)**2, *win) * boxcar(np.abs(slave)**2, *win)
+    valid = (master != 0) & (slave != 0) & (power > 0)
+    coherence = np.full(master.shape, np.nan, dtype='f4')
+    coherence[valid] = np.abs(cross[valid]) / np.sqrt(power[valid])
+    coherence = coherence[pad_start:coherence.shape[0] - pad_stop]
+
+    values = coherence[np.isfinite(coherence)]
+    hist = np.histogram(np.clip(values, 0, 1), bins=HIST_BINS, range=(0, 1))[0]
+
+    low_res = None
+    if looks:
+        rows_out = coherence.shape[0] // looks[0]
+        cols_out = coherence.shape[1] // looks[1]
+        cells = coherence[0:rows_out * looks[0], 0:cols_out * looks[1]].reshape(
+            rows_out, looks[0], cols_out, looks[1])
+        with np.errstate(invalid='ignore'):
+            low_res = np.nanmean(cells, axis=(1, 3)).astype('f4')
+
+    return hist, float(values.sum(dtype='f8')), values.size, low_res
+
+
+def default_jobs(width, block_lines, win):
+    """Return the number of processes whose blocks fit into the available memory."""
+    block_mb = BLOCK_BYTES_PER_PIXEL * (block_lines + win[0]) * width / 2**20
+    available = memory_info()[1] * MEMORY_FRACTION
+
+    return max(1, min(cpu_count(), int(available // block_mb)))
+
+
+def product_pairs(dim_path):
+    """Return (name, master band, slave band) of every slave of a product."""
+    product = DimapProduct(dim_path)
+    masters = [b.name for b in product.find_bands(r'^i_.*_mst_')]
+    if not masters:
+        return []
+    master_band = masters[0]
+    # slaves of the same polarisation as the master
+    pol = re.search(r'_(HH|HV|VH|VV)_', master_band)
+    pairs = []
+    for band in product.find_bands(r'^i_.*_slv\d*_'):
+        if pol and pol.group(0) not in band.name:
+            continue
+        slave_date = band_date(band.name.rsplit('_', 1)[-1])
+        name = f"{product.master_date}_{slave_date}"
+        iws = ''.join(product.iws)
+        if iws:
+            name += f"_IW{iws}"
+        pairs.append((name, master_band, band.name))
+
+    return pairs
+
+
+def percentile(hist, fraction):
+    """Return the coherence below which fraction of the pixels of hist lie."""
+    cumulative = np.cumsum(hist)
+    if cumulative[-1] == 0:
+        return float('nan')
+
+    return (np.searchsorted(cumulative, fraction * cumulative[-1]) + 0.5) / HIST_BINS
+
+
+def write_envi(path, array):
+    """Write a float32 array as little endian ENVI .img with .hdr."""
+    array.astype('<f4').tofile(path)
+    with open(path[0:-4] + '.hdr', 'w') as f:
+        f.write(f"ENVI\ndescription = {{coherence.py}}\nsamples = {array.shape[1]}\n"
+                f"lines = {array.shape[0]}\nbands = 1\nheader offset = 0\n"
+                "file type = ENVI Standard\ndata type = 4\ninterleave = bsq\n"
+                "byte order = 0\n")
+
+
+if __name__ == "__main__":
+    # get inputs
+    inps = cmdline_parser()
+    coreg_dir = os.path.abspath(inps.coreg_dir)
+    output_dir = os.path.abspath(inps.output_dir)
+    win = inps.window
+    looks = inps.looks
+
+    # check inputs
+    if not os.path.isdir(coreg_dir):
+        sys.exit(f"Error, {coreg_dir} does not exist.")
+
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
+
+    dims = product_format.find_products(coreg_dir)
+    if len(dims) == 0:
+        sys.exit(f"Cannot find any product in {coreg_dir}")
+
+    if any(not dim.endswith('.dim') for dim in dims):
+        sys.exit("Error, coherence.py reads BEAM-DIMAP products only.")
+
+    block_lines = inps.block_lines
+    if looks:
+        # whole looks per block
+        block_lines = max(1, block_lines // looks[0]) * looks[0]
+
+    pairs = []
+    for dim in dims:
+        found = product_pairs(dim)
+        if not found:
+            print(f"No master and slave i/q bands in {os.path.basename(dim)}, skip it.")
+        pairs.extend((dim, *pair) for pair in found)
+    if not pairs:
+        sys.exit(f"No coregistered pair in {coreg_dir}")
+
+    num_jobs = inps.jobs
+    if num_jobs is None:
+        width = max(DimapProduct(dim).width for dim in set(p[0] for p in pairs))
+        num_jobs = default_jobs(width, block_lines, win)
+        print(f"Estimate coherence with {num_jobs} processes, blocks of {block_lines} "
+              f"lines of up to {width} samples.")
+
+    # one task per block of every pair, spread over the process pool
+    results = {}
+    with ProcessPoolExecutor(max_workers=max(1, num_jobs)) as executor:
+        for dim, name, master_band, slave_band in pairs:
+            product = DimapProduct(dim)
+            for row_start, row_stop, _, _ in windows(product.height, product.width,
+                                                      block_lines):
+                future = executor.submit(block_coherence, dim, master_band,
+                                         slave_band, (row_start, row_stop), win,
+                                         looks)
+                results.setdefault(name, []).append((row_start, future))
+
+        rows = []
+        for name, blocks in results.items():
+            hist = np.zeros(HIST_BINS, dtype='i8')
+            total = 0.0
+            count = 0
+            low_res = []
+            for _, future in sorted(blocks, key=lambda b: b[0]):
+                block_hist, block_sum, block_count, block_low_res = future.result()
+                hist += block_hist
+                total += block_sum
+                count += block_count
+                if looks:
+                    low_res.append(block_low_res)
+
+            mean = total / count if count else float('nan')
+            low = hist[0:int(LOW_COHERENCE * HIST_BINS)].sum() / count if count else 1.0
+            rows.append([
+                name, f"{mean:.4f}", f"{percentile(hist, 0.5):.4f}",
+                f"{percentile(hist, 0.1):.4f}", f"{percentile(hist, 0.9):.4f}",
+                f"{low:.4f}", count
+            ])
+            print(f"{name}: mean coherence {mean:.3f}, {100 * low:.1f}% of pixels "
+                  f"below {LOW_COHERENCE}")
+            if looks:
+                write_envi(os.path.join(output_dir, f"{name}_coh.img"),
+                           np.concatenate(low_res))
+
+    with open(os.path.join(output_dir, 'coherence.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['pair', 'mean', 'median', 'p10', 'p90',
+                         f"fraction_below_{LOW_COHERENCE}", 'pixels'])
+        writer.writerows(sorted(rows))
+    print(f"\nCoherence of {len(rows)} pairs written to "
+          f"{os.path.join(output_dir, 'coherence.csv')}")
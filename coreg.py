@@ -6,11 +6,14 @@
 ##################################
 
 import os
-import subprocess
 import sys
-import time
 import argparse
-import glob
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+import gpt_runner
+import prepare_dem
+import product_format
 
 COREG_XML = """<graph id="Graph">
   <version>1.0</version>
@@ -115,8 +118,290 @@ COREG_XML = """<graph id="Graph">
 </graph>
 """
 
+COREG_IFG_XML = """<graph id="Graph">
+  <version>1.0</version>
+  <node id="Read">
+    <operator>Read</operator>
+    <sources/>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <file>MASTER</file>
+    </parameters>
+  </node>
+  <node id="Read(2)">
+    <operator>Read</operator>
+    <sources/>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <file>SLAVE</file>
+    </parameters>
+  </node>
+  <node id="Back-Geocoding">
+    <operator>Back-Geocoding</operator>
+    <sources>
+      <sourceProduct refid="Read"/>
+      <sourceProduct.1 refid="Read(2)"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <demName>SRTM 3Sec</demName>
+      <demResamplingMethod>BILINEAR_INTERPOLATION</demResamplingMethod>
+      <externalDEMFile/>
+      <externalDEMNoDataValue>0.0</externalDEMNoDataValue>
+      <resamplingType>BILINEAR_INTERPOLATION</resamplingType>
+      <maskOutAreaWithoutElevation>false</maskOutAreaWithoutElevation>
+      <outputRangeAzimuthOffset>false</outputRangeAzimuthOffset>
+      <outputDerampDemodPhase>false</outputDerampDemodPhase>
+      <disableReramp>false</disableReramp>
+    </parameters>
+  </node>
+  <node id="Enhanced-Spectral-Diversity">
+    <operator>Enhanced-Spectral-Diversity</operator>
+    <sources>
+      <sourceProduct refid="Back-Geocoding"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <fineWinWidthStr>512</fineWinWidthStr>
+      <fineWinHeightStr>512</fineWinHeightStr>
+      <fineWinAccAzimuth>16</fineWinAccAzimuth>
+      <fineWinAccRange>16</fineWinAccRange>
+      <fineWinOversampling>128</fineWinOversampling>
+      <xCorrThreshold>0.1</xCorrThreshold>
+      <cohThreshold>0.2</cohThreshold>
+      <numBlocksPerOverlap>10</numBlocksPerOverlap>
+      <esdEstimator>Periodogram</esdEstimator>
+      <weightFunc>Inv Quadratic</weightFunc>
+      <temporalBaselineType>Number of images</temporalBaselineType>
+      <maxTemporalBaseline>4</maxTemporalBaseline>
+      <integrationMethod>L1 and L2</integrationMethod>
+      <doNotWriteTargetBands>false</doNotWriteTargetBands>
+      <useSuppliedRangeShift>false</useSuppliedRangeShift>
+      <overallRangeShift>0.0</overallRangeShift>
+      <useSuppliedAzimuthShift>false</useSuppliedAzimuthShift>
+      <overallAzimuthShift>0.0</overallAzimuthShift>
+    </parameters>
+  </node>
+  <node id="TOPSAR-Deburst">
+    <operator>TOPSAR-Deburst</operator>
+    <sources>
+      <sourceProduct refid="Enhanced-Spectral-Diversity"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <selectedPolarisations/>
+    </parameters>
+  </node>
+  <node id="Write">
+    <operator>Write</operator>
+    <sources>
+      <sourceProduct refid="TOPSAR-Deburst"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <file>OUTPUT_COREG_FILE</file>
+      <formatName>BEAM-DIMAP</formatName>
+    </parameters>
+  </node>
+  <node id="Interferogram">
+    <operator>Interferogram</operator>
+    <sources>
+      <sourceProduct refid="TOPSAR-Deburst"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <subtractFlatEarthPhase>true</subtractFlatEarthPhase>
+      <srpPolynomialDegree>5</srpPolynomialDegree>
+      <srpNumberPoints>501</srpNumberPoints>
+      <orbitDegree>3</orbitDegree>
+      <includeCoherence>true</includeCoherence>
+      <cohWinAz>2</cohWinAz>
+      <cohWinRg>10</cohWinRg>
+      <squarePixel>true</squarePixel>
+      <subtractTopographicPhase>true</subtractTopographicPhase>
+      <demName>SRTM 3Sec</demName>
+      <externalDEMFile/>
+      <externalDEMNoDataValue>0.0</externalDEMNoDataValue>
+      <externalDEMApplyEGM>true</externalDEMApplyEGM>
+      <tileExtensionPercent>100</tileExtensionPercent>
+      <outputElevation>true</outputElevation>
+      <outputLatLon>true</outputLatLon>
+    </parameters>
+  </node>
+  <node id="Write(2)">
+    <operator>Write</operator>
+    <sources>
+      <sourceProduct refid="Interferogram"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <file>OUTPUT_IFG_FILE</file>
+      <formatName>BEAM-DIMAP</formatName>
+    </parameters>
+  </node>
+  <applicationData id="Presentation">
+    <Description/>
+    <node id="Back-Geocoding">
+      <displayPosition x="190.0" y="146.0"/>
+    </node>
+    <node id="Enhanced-Spectral-Diversity">
+      <displayPosition x="347.0" y="147.0"/>
+    </node>
+    <node id="TOPSAR-Deburst">
+      <displayPosition x="566.0" y="147.0"/>
+    </node>
+    <node id="Read">
+      <displayPosition x="58.0" y="92.0"/>
+    </node>
+    <node id="Read(2)">
+      <displayPosition x="57.0" y="201.0"/>
+    </node>
+    <node id="Write">
+      <displayPosition x="726.0" y="148.0"/>
+    </node>
+    <node id="Interferogram">
+      <displayPosition x="726.0" y="230.0"/>
+    </node>
+    <node id="Write(2)">
+      <displayPosition x="886.0" y="230.0"/>
+    </node>
+  </applicationData>
+</graph>
+"""
+
+COREG_STACK_XML = """<graph id="Graph">
+  <version>1.0</version>
+  <node id="Read">
+    <operator>Read</operator>
+    <sources/>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <file>MASTER</file>
+    </parameters>
+  </node>
+SLAVE_READ_NODES  <node id="Back-Geocoding">
+    <operator>Back-Geocoding</operator>
+    <sources>
+      <sourceProduct refid="Read"/>
+SLAVE_SOURCES    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <demName>SRTM 3Sec</demName>
+      <demResamplingMethod>BILINEAR_INTERPOLATION</demResamplingMethod>
+      <externalDEMFile/>
+      <externalDEMNoDataValue>0.0</externalDEMNoDataValue>
+      <resamplingType>BILINEAR_INTERPOLATION</resamplingType>
+      <maskOutAreaWithoutElevation>false</maskOutAreaWithoutElevation>
+      <outputRangeAzimuthOffset>false</outputRangeAzimuthOffset>
+      <outputDerampDemodPhase>false</outputDerampDemodPhase>
+      <disableReramp>false</disableReramp>
+    </parameters>
+  </node>
+  <node id="Enhanced-Spectral-Diversity">
+    <operator>Enhanced-Spectral-Diversity</operator>
+    <sources>
+      <sourceProduct refid="Back-Geocoding"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <fineWinWidthStr>512</fineWinWidthStr>
+      <fineWinHeightStr>512</fineWinHeightStr>
+      <fineWinAccAzimuth>16</fineWinAccAzimuth>
+      <fineWinAccRange>16</fineWinAccRange>
+      <fineWinOversampling>128</fineWinOversampling>
+      <xCorrThreshold>0.1</xCorrThreshold>
+      <cohThreshold>0.2</cohThreshold>
+      <numBlocksPerOverlap>10</numBlocksPerOverlap>
+      <esdEstimator>Periodogram</esdEstimator>
+      <weightFunc>Inv Quadratic</weightFunc>
+      <temporalBaselineType>Number of images</temporalBaselineType>
+      <maxTemporalBaseline>MAX_TEMPORAL_BASELINE</maxTemporalBaseline>
+      <integrationMethod>L1 and L2</integrationMethod>
+      <doNotWriteTargetBands>false</doNotWriteTargetBands>
+      <useSuppliedRangeShift>false</useSuppliedRangeShift>
+      <overallRangeShift>0.0</overallRangeShift>
+      <useSuppliedAzimuthShift>false</useSuppliedAzimuthShift>
+      <overallAzimuthShift>0.0</overallAzimuthShift>
+    </parameters>
+  </node>
+  <node id="TOPSAR-Deburst">
+    <operator>TOPSAR-Deburst</operator>
+    <sources>
+      <sourceProduct refid="Enhanced-Spectral-Diversity"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <selectedPolarisations/>
+    </parameters>
+  </node>
+PAIR_NODES</graph>
+"""
+
+# nodes added to COREG_STACK_XML for the K-th slave
+STACK_READ_NODE = """  <node id="Read(READ_ID)">
+    <operator>Read</operator>
+    <sources/>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <file>SLAVE_FILE</file>
+    </parameters>
+  </node>
+"""
+
+STACK_SOURCE = """      <sourceProduct.SOURCE_INDEX refid="Read(READ_ID)"/>
+"""
+
+# master and the K-th slave of the stack as one pair product
+STACK_PAIR_NODES = """  <node id="BandSelect(K)">
+    <operator>BandSelect</operator>
+    <sources>
+      <sourceProduct refid="TOPSAR-Deburst"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <selectedPolarisations/>
+      <sourceBands/>
+      <bandNamePattern>BAND_PATTERN</bandNamePattern>
+    </parameters>
+  </node>
+  <node id="Write(K)">
+    <operator>Write</operator>
+    <sources>
+      <sourceProduct refid="BandSelect(K)"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <file>OUTPUT_COREG_FILE</file>
+      <formatName>BEAM-DIMAP</formatName>
+    </parameters>
+  </node>
+"""
+
+STACK_IFG_NODES = """  <node id="Interferogram(K)">
+    <operator>Interferogram</operator>
+    <sources>
+      <sourceProduct refid="BandSelect(K)"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <subtractFlatEarthPhase>true</subtractFlatEarthPhase>
+      <srpPolynomialDegree>5</srpPolynomialDegree>
+      <srpNumberPoints>501</srpNumberPoints>
+      <orbitDegree>3</orbitDegree>
+      <includeCoherence>true</includeCoherence>
+      <cohWinAz>2</cohWinAz>
+      <cohWinRg>10</cohWinRg>
+      <squarePixel>true</squarePixel>
+      <subtractTopographicPhase>true</subtractTopographicPhase>
+      <demName>SRTM 3Sec</demName>
+      <externalDEMFile/>
+      <externalDEMNoDataValue>0.0</externalDEMNoDataValue>
+      <externalDEMApplyEGM>true</externalDEMApplyEGM>
+      <tileExtensionPercent>100</tileExtensionPercent>
+      <outputElevation>true</outputElevation>
+      <outputLatLon>true</outputLatLon>
+    </parameters>
+  </node>
+  <node id="Write-Interferogram(K)">
+    <operator>Write</operator>
+    <sources>
+      <sourceProduct refid="Interferogram(K)"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <file>OUTPUT_IFG_FILE</file>
+      <formatName>BEAM-DIMAP</formatName>
+    </parameters>
+  </node>
+"""
+
 EXAMPLE = """Example:
   python3 coreg.py /ly/slc /ly/coreg 20201229
+  python3 coreg.py /ly/slc /ly/coreg 20201229 --jobs 4
+  python3 coreg.py /ly/slc /ly/coreg 20201229 --with-ifg /ly/ifg
 """
 
 
@@ -129,17 +414,177 @@ def cmdline_parser():
     parser.add_argument('slc_dir', help='slc directory')
     parser.add_argument('output_dir', help='output directory')
     parser.add_argument('master', help='master slc date for coregistration')
+    parser.add_argument('--with-ifg',
+                        dest='ifg_dir',
+                        metavar='IFG_DIR',
+                        help='also write the interferogram of each pair into\n' +
+                        'IFG_DIR from the same graph (replaces ifg.py)')
+    parser.add_argument('--dem',
+                        help='DEM GeoTIFF made by prepare_dem.py (default: SRTM 3Sec\n' +
+                        'downloaded by SNAP)')
+    add_stack_argument(parser)
+    gpt_runner.add_runner_arguments(parser)
+    product_format.add_format_argument(parser)
     inps = parser.parse_args()
 
     return inps
 
 
+def add_stack_argument(parser):
+    """Add --experimental-stack-size to the parser of a script running coregistration."""
+    parser.add_argument('--experimental-stack-size',
+                        dest='stack_size',
+                        type=int,
+                        default=1,
+                        metavar='N',
+                        help='EXPERIMENTAL, not yet verified on real products: coregister\n' +
+                        'N slaves to the master in one graph, so that the master\n' +
+                        'geometry is computed once per N slaves; needs more memory\n' +
+                        'per job, raise --heap or lower --jobs (default: 1)')
+
+
+def slave_groups(slaves, stack_size):
+    """Split slaves, sorted by date, into groups of at most stack_size."""
+    slaves = sorted(slaves, key=os.path.basename)
+    stack_size = max(1, stack_size)
+
+    return [slaves[i:i + stack_size] for i in range(0, len(slaves), stack_size)]
+
+
+def band_suffix(date):
+    """Return the suffix of the bands of a date in a stack, e.g. _18Jan2020."""
+    return '_' + datetime.strptime(date, '%Y%m%d').strftime('%d%b%Y')
+
+
+def keep_slave_metadata(paths, slave_date, written):
+    """Remove the Slave_Metadata of all slaves but slave_date from products.
+
+    paths are BEAM-DIMAP products written from a stack, at the paths
+    written maps them to. Used as a post step of coreg_stack_job.
+    """
+    for path in paths:
+        dim_path = written.get(path, path)
+        try:
+            tree = ET.parse(dim_path)
+        except ET.ParseError as e:
+            raise ValueError(f"Cannot read {dim_path}: {e}")
+
+        kept = 0
+        for element in tree.getroot().iter('MDElem'):
+            if element.get('name') != 'Slave_Metadata':
+                continue
+            for slave in element.findall('MDElem'):
+                first_line_time = slave.findtext("MDATTR[@name='first_line_time']") or ''
+                try:
+                    date = datetime.strptime(first_line_time.strip()[0:11].title(),
+                                             '%d-%b-%Y').strftime('%Y%m%d')
+                except ValueError:
+                    date = None
+                if date == slave_date:
+                    kept += 1
+                else:
+                    element.remove(slave)
+        if kept != 1:
+            raise ValueError(f"Found {kept} Slave_Metadata of {slave_date} in {dim_path}")
+
+        tree.write(dim_path + '.tmp', encoding='ISO-8859-1', xml_declaration=True)
+        os.replace(dim_path + '.tmp', dim_path)
+
+
+def coreg_job(master, slave, output_dir, xml_dir, ifg_dir=None):
+    """Return the job coregistering slave to master, optionally with its ifg."""
+    master_date = os.path.basename(master)[0:8]
+    slave_name = os.path.basename(slave)
+    slave_stem = product_format.product_stem(slave)
+
+    xml_data = COREG_IFG_XML if ifg_dir else COREG_XML
+    xml_data = xml_data.replace('MASTER', master)
+    xml_data = xml_data.replace('SLAVE', slave)
+    output_file = os.path.join(output_dir, f"{master_date}_{slave_stem}.dim")
+    xml_data = xml_data.replace('OUTPUT_COREG_FILE', output_file)
+
+    outputs = [output_file]
+    if ifg_dir:
+        # same name as the coreg product, as ifg.py would write it
+        ifg_file = os.path.join(ifg_dir, f"{master_date}_{slave_stem}.dim")
+        xml_data = xml_data.replace('OUTPUT_IFG_FILE', ifg_file)
+        outputs.append(ifg_file)
+        xml_name = f"{master_date}_{slave_stem}_coreg_ifg.xml"
+    else:
+        xml_name = f"{master_date}_{slave_stem}_coreg.xml"
+
+    xml_path = os.path.join(xml_dir, xml_name)
+    return gpt_runner.GptJob(slave_name, xml_path, xml_data, [master, slave],
+                             outputs)
+
+
+def coreg_stack_job(master, slaves, output_dir, xml_dir, ifg_dir=None):
+    """Return the job coregistering all slaves to master in one graph.
+
+    Back-Geocoding and ESD run once on the stack, whose master bands and
+    the bands of each slave are then written as the same per-pair products
+    as coreg_job writes, optionally with their ifgs. The metadata of the
+    other slaves is removed from each pair once gpt succeeded.
+    """
+    if len(slaves) == 1:
+        return coreg_job(master, slaves[0], output_dir, xml_dir, ifg_dir)
+
+    master_date = os.path.basename(master)[0:8]
+    read_nodes = ''
+    sources = ''
+    pair_nodes = ''
+    outputs = []
+    ifg_outputs = []
+    post_steps = []
+    for k, slave in enumerate(slaves, start=1):
+        slave_stem = product_format.product_stem(slave)
+        read_nodes += STACK_READ_NODE.replace('READ_ID', str(k + 1)).replace(
+            'SLAVE_FILE', slave)
+        sources += STACK_SOURCE.replace('SOURCE_INDEX', str(k)).replace(
+            'READ_ID', str(k + 1))
+
+        output_file = os.path.join(output_dir, f"{master_date}_{slave_stem}.dim")
+        pattern = f".*_mst_.*|.*{band_suffix(slave_stem[0:8])}"
+        nodes = STACK_PAIR_NODES.replace('(K)', f"({k})")
+        nodes = nodes.replace('BAND_PATTERN', pattern)
+        nodes = nodes.replace('OUTPUT_COREG_FILE', output_file)
+        outputs.append(output_file)
+        pair_files = [output_file]
+        if ifg_dir:
+            ifg_file = os.path.join(ifg_dir, f"{master_date}_{slave_stem}.dim")
+            ifg_nodes = STACK_IFG_NODES.replace('(K)', f"({k})")
+            nodes += ifg_nodes.replace('OUTPUT_IFG_FILE', ifg_file)
+            ifg_outputs.append(ifg_file)
+            pair_files.append(ifg_file)
+        pair_nodes += nodes
+        post_steps.append((keep_slave_metadata, [pair_files, slave_stem[0:8]]))
+
+    # ESD estimates the shifts over all pairs of images of the stack: with
+    # the master it has len(slaves) + 1 images, so a baseline of len(slaves)
+    # images, the number of images between the first and last, includes them all
+    xml_data = COREG_STACK_XML.replace('MAX_TEMPORAL_BASELINE', str(len(slaves)))
+    xml_data = xml_data.replace('SLAVE_READ_NODES', read_nodes)
+    xml_data = xml_data.replace('SLAVE_SOURCES', sources)
+    xml_data = xml_data.replace('PAIR_NODES', pair_nodes)
+    xml_data = xml_data.replace('<file>MASTER</file>', f"<file>{master}</file>")
+
+    first = product_format.product_stem(slaves[0])
+    suffix = '_coreg_ifg.xml' if ifg_dir else '_coreg.xml'
+    xml_path = os.path.join(xml_dir, f"{master_date}_{first}_stack{len(slaves)}{suffix}")
+    name = f"{first}..{product_format.product_stem(slaves[-1])} ({len(slaves)} slaves)"
+    job = gpt_runner.GptJob(name, xml_path, xml_data, [master] + slaves,
+                            outputs + ifg_outputs)
+    job.post_steps = post_steps
+    return job
+
+
 if __name__ == "__main__":
     # get inputs
     inps = cmdline_parser()
     slc_dir = os.path.abspath(inps.slc_dir)
     output_dir = os.path.abspath(inps.output_dir)
     master_date = inps.master
+    ifg_dir = os.path.abspath(inps.ifg_dir) if inps.ifg_dir else None
 
     # check inputs
     if not os.path.isdir(slc_dir):
@@ -148,47 +593,42 @@ if __name__ == "__main__":
     if not os.path.isdir(output_dir):
         os.mkdir(output_dir)
 
+    if ifg_dir and not os.path.isdir(ifg_dir):
+        os.mkdir(ifg_dir)
+
     xml_dir = os.path.join(output_dir, 'xml')
     if not os.path.isdir(xml_dir):
       os.mkdir(xml_dir)
 
-    dims = glob.glob(os.path.join(slc_dir, "*.dim"))
+    if inps.stack_size > 1 and (inps.queue or inps.format != 'BEAM-DIMAP'):
+        sys.exit('Error, --experimental-stack-size runs here only and writes '
+                 'BEAM-DIMAP, not with --queue or --format.')
+
+    dims = product_format.find_products(slc_dir)
     if len(dims) < 2:
         sys.exit(f"No enough slc file in {slc_dir}")
 
     slaves = [i for i in dims if master_date not in os.path.basename(i)]
+    stems = {product_format.product_stem(i): i for i in dims}
 
+    # slaves of the same subswath share a master
+    masters = {}
     for slave in slaves:
-        index = slaves.index(slave) + 1
-        slave_name = os.path.basename(slave)
-        print(f"\n[{index}/{len(slaves)}] Processing file: {slave_name}\n")
-
-        master = os.path.join(slc_dir, master_date + slave_name[8:])
-
-        xml_data = COREG_XML
-        xml_data = xml_data.replace('MASTER', master)
-        xml_data = xml_data.replace('SLAVE', slave)
-        output_file = os.path.join(output_dir, f"{master_date}_{slave_name}")
-        xml_data = xml_data.replace('OUTPUT_COREG_FILE', output_file)
-
-        xml_name = f"{master_date}_{slave_name[0:-4]}_coreg.xml"
-        xml_path = os.path.join(xml_dir, xml_name)
-        with open(xml_path, 'w+') as f:
-            f.write(xml_data)
-
-        args = ['gpt', xml_path]
-        process = subprocess.Popen(args,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-        time_start = time.time()
-
-        stdout = process.communicate()[0]
-        print(str(stdout, encoding='utf-8'))
-
-        time_delta = time.time() - time_start
-        print('Finished in {} seconds.'.format(time_delta))
-
-        if process.returncode != 0:
-            print('Error coregistration with file {}\n'.format(slave_name))
-        else:
-            print('Complete coregistration with file {}\n'.format(slave_name))
+        master_stem = master_date + product_format.product_stem(slave)[8:]
+        master = stems.get(master_stem, os.path.join(slc_dir, master_stem + '.dim'))
+        masters.setdefault(master, []).append(slave)
+
+    jobs = []
+    for master, iw_slaves in masters.items():
+        for group in slave_groups(iw_slaves, inps.stack_size):
+            jobs.append(coreg_stack_job(master, group, output_dir, xml_dir, ifg_dir))
+    product_format.use_format(jobs, inps.format)
+
+    if inps.dem:
+        dem_file = os.path.abspath(inps.dem)
+        if not os.path.isfile(dem_file):
+            sys.exit(f"Cannot find DEM {dem_file}")
+        for job in jobs:
+            prepare_dem.use_external_dem(job, dem_file)
+
+    gpt_runner.run_stage(jobs, inps, xml_dir)
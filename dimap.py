@@ -0,0 +1,555 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import argparse
+import math
+import os
+import re
+import sys
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# ENVI data type codes
+ENVI_DTYPES = {
+    1: 'u1', 2: 'i2', 3: 'i4', 4: 'f4', 5: 'f8', 6: 'c8', 9: 'c16',
+    12: 'u2', 13: 'u4', 14: 'i8', 15: 'u8'
+}
+# DIMAP DATA_TYPE names
+DIMAP_DTYPES = {
+    'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2', 'int32': 'i4',
+    'uint32': 'u4', 'int64': 'i8', 'float32': 'f4', 'float64': 'f8'
+}
+# dates in band names, e.g. i_IW1_VV_slv1_18Jan2020
+BAND_DATE_PATTERN = re.compile(r'_(\d{2}[A-Z][a-z]{2}\d{4})')
+BAND_IW_PATTERN = re.compile(r'_IW(\d)_')
+BLOCK_LINES = 1024
+
+EXAMPLE = """Example:
+  python3 dimap.py /ly/coreg/20200106_20200118_IW1.dim
+  python3 dimap.py /ly/ifg/20200106_20200118_IW1.dim --stats
+"""
+
+
+def cmdline_parser():
+    parser = argparse.ArgumentParser(
+        description='Show dimensions, dates and bands of a BEAM-DIMAP product ' +
+        'without SNAP.',
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=EXAMPLE)
+
+    parser.add_argument('dim_file', help='BEAM-DIMAP .dim file')
+    parser.add_argument('--stats',
+                        action='store_true',
+                        help='also read every band for its min, max and mean')
+    inps = parser.parse_args()
+
+    return inps
+
+
+def read_envi_header(hdr_path):
+    """Return the key = value entries of an ENVI header, lower case keys."""
+    header = {}
+    with open(hdr_path, 'r') as f:
+        text = f.read()
+    # values in braces may span lines
+    for key, value in re.findall(r'^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)', text,
+                                 re.MULTILINE):
+        header[key.lower()] = value.strip().strip('{}').strip()
+
+    return header
+
+
+def band_date(text):
+    """Return YYYYMMDD of a date like 18Jan2020 or 18-JAN-2020 10:00:01."""
+    for fmt, length in [('%d%b%Y', 9), ('%d-%b-%Y', 11)]:
+        try:
+            return datetime.strptime(text[0:length].title(), fmt).strftime('%Y%m%d')
+        except ValueError:
+            continue
+
+    return None
+
+
+class Band:
+    """One band of a product, memory mapped from its ENVI .img on first use.
+
+    Virtual bands, defined by an expression, have no img_path and no data.
+    """
+
+    def __init__(self, name, index, width, height, dtype, img_path=None,
+                 unit=None, no_data=None, expression=None):
+        self.name = name
+        self.index = index
+        self.width = width
+        self.height = height
+        self.dtype = np.dtype(dtype)
+        self.img_path = img_path
+        self.unit = unit
+        self.no_data = no_data
+        self.expression = expression
+        self.offset = 0
+        self._array = None
+
+        if img_path:
+            hdr_path = img_path[0:-4] + '.hdr'
+            if os.path.isfile(hdr_path):
+                header = read_envi_header(hdr_path)
+                # BEAM-DIMAP writes big endian unless the header says otherwise
+                order = '<' if header.get('byte order') == '0' else '>'
+                code = int(header.get('data type', 0))
+                if code in ENVI_DTYPES:
+                    self.dtype = np.dtype(order + ENVI_DTYPES[code])
+                self.offset = int(header.get('header offset', 0))
+
+    @property
+    def is_virtual(self):
+        return self.img_path is None
+
+    @property
+    def array(self):
+        """Return the band as a read only memory map of shape (height, width)."""
+        if self.is_virtual:
+            raise ValueError(f"Band {self.name} is virtual ({self.expression})")
+        if self._array is None:
+            self._array = np.memmap(self.img_path, dtype=self.dtype, mode='r',
+                                    offset=self.offset,
+                                    shape=(self.height, self.width))
+
+        return self._array
+
+    def read(self, window=None):
+        """Return a native byte order copy of the band or of a window.
+
+        window is (row_start, row_stop, col_start, col_stop).
+        """
+        if window is None:
+            window = (0, self.height, 0, self.width)
+        row_start, row_stop, col_start, col_stop = window
+
+        return self.array[row_start:row_stop,
+                          col_start:col_stop].astype(self.dtype.newbyteorder('='))
+
+    def blocks(self, block_lines=BLOCK_LINES):
+        """Yield (row_start, block) of block_lines full rows, as views of the map."""
+        for row_start, row_stop, _, _ in windows(self.height, self.width, block_lines):
+            yield row_start, self.array[row_start:row_stop]
+
+
+class TiePointGrid(Band):
+    """A tie-point grid, a coarse band sampled every step pixels from offset."""
+
+    def __init__(self, name, index, width, height, img_path, offset_x, offset_y,
+                 step_x, step_y):
+        super().__init__(name, index, width, height, '>f4', img_path)
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+        self.step_x = step_x
+        self.step_y = step_y
+
+    def interpolate(self, x, y):
+        """Return the bilinear value of the grid at pixel coordinates x, y."""
+        gx = min(max((x - self.offset_x) / self.step_x, 0), self.width - 1)
+        gy = min(max((y - self.offset_y) / self.step_y, 0), self.height - 1)
+        i = min(int(gx), max(self.width - 2, 0))
+        j = min(int(gy), max(self.height - 2, 0))
+        fx, fy = gx - i, gy - j
+        cell = self.read((j, min(j + 2, self.height), i, min(i + 2, self.width)))
+        cell = np.pad(cell, ((0, 2 - cell.shape[0]), (0, 2 - cell.shape[1])), mode='edge')
+
+        return float((cell[0, 0] * (1 - fx) + cell[0, 1] * fx) * (1 - fy) +
+                     (cell[1, 0] * (1 - fx) + cell[1, 1] * fx) * fy)
+
+
+def windows(height, width, block_lines=BLOCK_LINES, block_cols=None):
+    """Yield (row_start, row_stop, col_start, col_stop) covering a raster."""
+    block_cols = block_cols or width
+    for row_start in range(0, height, block_lines):
+        for col_start in range(0, width, block_cols):
+            yield (row_start, min(row_start + block_lines, height), col_start,
+                   min(col_start + block_cols, width))
+
+
+def element_attributes(element):
+    """Return {name: text} of the MDATTR children of a metadata element."""
+    if element is None:
+        return {}
+
+    return {a.get('name'): (a.text or '').strip() for a in element.findall('MDATTR')}
+
+
+def parse_utc(text):
+    """Return the datetime of a metadata time like 06-JAN-2020 10:00:01.123456."""
+    return datetime.strptime(text.strip().title(), '%d-%b-%Y %H:%M:%S.%f')
+
+
+def format_utc(time):
+    """Return a datetime as metadata time text, the inverse of parse_utc."""
+    return time.strftime('%d-%b-%Y %H:%M:%S.%f').upper()
+
+
+def set_attribute(element, name, value):
+    """Set the text of the MDATTR name of a metadata element, if it has one."""
+    for attribute in element.findall('MDATTR'):
+        if attribute.get('name') == name:
+            attribute.text = str(value)
+
+
+def orbit_vectors(element):
+    """Return [(time, x, y, z, vx, vy, vz)] of the state vectors of a metadata element."""
+    vectors = []
+    for orbit in element.iter('MDElem'):
+        if orbit.get('name') != 'Orbit_State_Vectors':
+            continue
+        for vector in orbit.findall('MDElem'):
+            values = element_attributes(vector)
+            vectors.append((parse_utc(values['time']),) + tuple(
+                float(values[key])
+                for key in ['x_pos', 'y_pos', 'z_pos', 'x_vel', 'y_vel', 'z_vel']))
+        break
+
+    return sorted(vectors)
+
+
+class DimapProduct:
+    """A BEAM-DIMAP product read from its .dim header.
+
+    Bands are Band objects by name, in the order of the header; the
+    Abstracted_Metadata attributes are in metadata, those of each slave in
+    slave_metadata, and their elements in metadata_element and
+    slave_elements. Tie-point grids are TiePointGrid objects by name.
+    """
+
+    def __init__(self, dim_path):
+        self.dim_path = dim_path
+        self.data_dir = dim_path[0:-4] + '.data'
+        self.root = ET.parse(dim_path).getroot()
+
+        self.name = self.root.findtext('DATASET_ID/DATASET_NAME') or \
+            os.path.basename(dim_path)[0:-4]
+        self.width = int(self.root.findtext('Raster_Dimensions/NCOLS'))
+        self.height = int(self.root.findtext('Raster_Dimensions/NROWS'))
+
+        self.metadata_element = None
+        self.slave_elements = {}
+        for element in self.root.iter('MDElem'):
+            if (element.get('name') == 'Abstracted_Metadata' and
+                    self.metadata_element is None):
+                self.metadata_element = element
+            elif element.get('name') == 'Slave_Metadata':
+                for slave in element.findall('MDElem'):
+                    self.slave_elements[slave.get('name')] = slave
+        self.metadata = element_attributes(self.metadata_element)
+        self.slave_metadata = {
+            name: element_attributes(element)
+            for name, element in self.slave_elements.items()
+        }
+
+        files = {}
+        for data_file in self.root.findall('Data_Access/Data_File'):
+            href = data_file.find('DATA_FILE_PATH').get('href')
+            files[int(data_file.findtext('BAND_INDEX'))] = os.path.join(
+                os.path.dirname(dim_path), href[0:-4] + '.img')
+
+        self.bands = {}
+        for info in self.root.findall('Image_Interpretation/Spectral_Band_Info'):
+            index = int(info.findtext('BAND_INDEX'))
+            name = info.findtext('BAND_NAME')
+            expression = info.findtext('EXPRESSION')
+            img_path = files.get(index, os.path.join(self.data_dir, name + '.img'))
+            if info.findtext('VIRTUAL_BAND') == 'true':
+                img_path = None
+            no_data = None
+            if info.findtext('NO_DATA_VALUE_USED') == 'true':
+                no_data = float(info.findtext('NO_DATA_VALUE'))
+            self.bands[name] = Band(
+                name, index,
+                int(info.findtext('BAND_RASTER_WIDTH') or self.width),
+                int(info.findtext('BAND_RASTER_HEIGHT') or self.height),
+                '>' + DIMAP_DTYPES.get(info.findtext('DATA_TYPE'), 'f4'),
+                img_path, info.findtext('PHYSICAL_UNIT'), no_data, expression)
+
+        tpg_files = {}
+        for tpg_file in self.root.findall('Data_Access/Tie_Point_Grid_File'):
+            href = tpg_file.find('TIE_POINT_GRID_FILE_PATH').get('href')
+            tpg_files[int(tpg_file.findtext('TPG_INDEX'))] = os.path.join(
+                os.path.dirname(dim_path), href[0:-4] + '.img')
+
+        self.tie_point_grids = {}
+        for info in self.root.findall('Tie_Point_Grids/Tie_Point_Grid_Info'):
+            index = int(info.findtext('TPG_INDEX'))
+            name = info.findtext('TPG_NAME')
+            self.tie_point_grids[name] = TiePointGrid(
+                name, index, int(info.findtext('NCOLS')), int(info.findtext('NROWS')),
+                tpg_files.get(index, os.path.join(self.data_dir, 'tie_point_grids',
+                                                  name + '.img')),
+                float(info.findtext('OFFSET_X')), float(info.findtext('OFFSET_Y')),
+                float(info.findtext('STEP_X')), float(info.findtext('STEP_Y')))
+
+    def band(self, name):
+        """Return the band called name."""
+        if name not in self.bands:
+            raise KeyError(f"No band {name} in {self.dim_path}")
+
+        return self.bands[name]
+
+    def find_bands(self, pattern):
+        """Return the bands whose name matches the regular expression pattern."""
+        return [b for name, b in self.bands.items() if re.search(pattern, name)]
+
+    @property
+    def dates(self):
+        """Return the sorted YYYYMMDD dates found in the band names."""
+        dates = set()
+        for name in self.bands:
+            for text in BAND_DATE_PATTERN.findall(name):
+                dates.add(band_date(text))
+        dates.discard(None)
+
+        return sorted(dates)
+
+    @property
+    def master_date(self):
+        """Return the YYYYMMDD date of the master, or of the product if single."""
+        date = band_date(self.metadata.get('first_line_time', ''))
+        if date is None and self.dates:
+            date = self.dates[0]
+
+        return date
+
+    @property
+    def slave_dates(self):
+        dates = set(self.dates)
+        for attributes in self.slave_metadata.values():
+            dates.add(band_date(attributes.get('first_line_time', '')))
+        dates.discard(None)
+        dates.discard(self.master_date)
+
+        return sorted(dates)
+
+    @property
+    def iws(self):
+        """Return the IW numbers of the product, as strings."""
+        iws = set(BAND_IW_PATTERN.findall('_'.join(self.bands) + '_'))
+        if not iws:
+            iws = set(re.findall(r'IW(\d)', self.metadata.get('SWATH', '')))
+
+        return sorted(iws)
+
+    def windows(self, block_lines=BLOCK_LINES, block_cols=None):
+        return windows(self.height, self.width, block_lines, block_cols)
+
+
+def subset_window(product, region):
+    """Return the window (row_start, row_stop, col_start, col_stop) of region.
+
+    region is (x, y, width, height) like the region of the Subset operator,
+    clipped to the raster.
+    """
+    x, y, width, height = region
+    window = (max(0, y), min(product.height, y + height), max(0, x),
+              min(product.width, x + width))
+    if window[0] >= window[1] or window[2] >= window[3]:
+        raise ValueError(f"Region {region} is outside of {product.width} x "
+                         f"{product.height} of {product.dim_path}")
+
+    return window
+
+
+def copy_header(hdr_path, output_path, width, height):
+    """Copy an ENVI header with the samples and lines of a window."""
+    with open(hdr_path, 'r') as f:
+        text = f.read()
+    text = re.sub(r'^(\s*samples\s*=\s*)\d+', rf'\g<1>{width}', text, flags=re.MULTILINE)
+    text = re.sub(r'^(\s*lines\s*=\s*)\d+', rf'\g<1>{height}', text, flags=re.MULTILINE)
+    with open(output_path, 'w') as f:
+        f.write(text)
+
+
+def copy_window(band, output_path, window, block_lines=BLOCK_LINES):
+    """Write a window of a band to output_path with header, in its own byte order.
+
+    Only the columns of the window are read from each row, block_lines
+    rows at a time.
+    """
+    row_start, row_stop, col_start, col_stop = window
+    with open(output_path + '.tmp', 'wb') as f:
+        for block_start in range(row_start, row_stop, block_lines):
+            block_stop = min(block_start + block_lines, row_stop)
+            f.write(np.ascontiguousarray(
+                band.array[block_start:block_stop, col_start:col_stop]).tobytes())
+    os.replace(output_path + '.tmp', output_path)
+
+    hdr_path = band.img_path[0:-4] + '.hdr'
+    if os.path.isfile(hdr_path):
+        copy_header(hdr_path, output_path[0:-4] + '.hdr', col_stop - col_start,
+                    row_stop - row_start)
+
+
+def subset_tie_point_grid(grid, output_path, window):
+    """Write the part of a tie-point grid covering window.
+
+    Return the new (ncols, nrows, offset_x, offset_y) of the grid, the
+    offsets relative to the window.
+    """
+    row_start, row_stop, col_start, col_stop = window
+    i0 = max(0, math.floor((col_start - grid.offset_x) / grid.step_x))
+    i1 = min(grid.width - 1, math.ceil((col_stop - grid.offset_x) / grid.step_x))
+    j0 = max(0, math.floor((row_start - grid.offset_y) / grid.step_y))
+    j1 = min(grid.height - 1, math.ceil((row_stop - grid.offset_y) / grid.step_y))
+    copy_window(grid, output_path, (j0, j1 + 1, i0, i1 + 1))
+
+    return (i1 - i0 + 1, j1 - j0 + 1, grid.offset_x + i0 * grid.step_x - col_start,
+            grid.offset_y + j0 * grid.step_y - row_start)
+
+
+def subset_metadata(element, window, grids):
+    """Update the Abstracted_Metadata attributes of an element to window.
+
+    Corner coordinates are interpolated from the latitude and longitude
+    tie-point grids of the source product, when it has them.
+    """
+    row_start, row_stop, col_start, col_stop = window
+    width, height = col_stop - col_start, row_stop - row_start
+    attributes = element_attributes(element)
+
+    set_attribute(element, 'num_output_lines', height)
+    set_attribute(element, 'num_samples_per_line', width)
+    if 'subset_offset_x' in attributes:
+        set_attribute(element, 'subset_offset_x',
+                      int(float(attributes['subset_offset_x'])) + col_start)
+        set_attribute(element, 'subset_offset_y',
+                      int(float(attributes['subset_offset_y'])) + row_start)
+
+    if 'first_line_time' in attributes and 'line_time_interval' in attributes:
+        interval = float(attributes['line_time_interval'])
+        first = parse_utc(attributes['first_line_time']) + timedelta(
+            seconds=row_start * interval)
+        set_attribute(element, 'first_line_time', format_utc(first))
+        set_attribute(element, 'last_line_time',
+                      format_utc(first + timedelta(seconds=(height - 1) * interval)))
+
+    # slant range images only, ground range keeps its first pixel time
+    if attributes.get('srgr_flag', '0') == '0' and 'range_spacing' in attributes:
+        set_attribute(element, 'slant_range_to_first_pixel',
+                      float(attributes.get('slant_range_to_first_pixel', 0)) +
+                      col_start * float(attributes['range_spacing']))
+
+    if 'latitude' in grids and 'longitude' in grids:
+        corners = {
+            'first_near': (col_start + 0.5, row_start + 0.5),
+            'first_far': (col_stop - 0.5, row_start + 0.5),
+            'last_near': (col_start + 0.5, row_stop - 0.5),
+            'last_far': (col_stop - 0.5, row_stop - 0.5),
+            'centre': (col_start + width / 2, row_start + height / 2),
+        }
+        for corner, (x, y) in corners.items():
+            lon_name = 'centre_lon' if corner == 'centre' else f"{corner}_long"
+            set_attribute(element, f"{corner}_lat", grids['latitude'].interpolate(x, y))
+            set_attribute(element, lon_name, grids['longitude'].interpolate(x, y))
+
+
+def subset_product(dim_path, output_path, region, block_lines=BLOCK_LINES):
+    """Write the pixel region of a product to output_path as BEAM-DIMAP.
+
+    region is (x, y, width, height) like the Subset operator. Bands are
+    copied from their memory maps, virtual bands keep their expression, and
+    the dimensions, tie-point grids and the metadata of master and slaves
+    are updated to the window. The .dim is written last, so an interrupted
+    subset leaves no product behind. Return the window.
+    """
+    product = DimapProduct(dim_path)
+    window = subset_window(product, region)
+    row_start, row_stop, col_start, col_stop = window
+    width, height = col_stop - col_start, row_stop - row_start
+    name = os.path.basename(output_path)[0:-4]
+    old_data = os.path.basename(product.data_dir)
+    new_data = name + '.data'
+    output_data_dir = output_path[0:-4] + '.data'
+    if os.path.isfile(output_path):
+        os.remove(output_path)
+
+    for band in product.bands.values():
+        if band.is_virtual:
+            continue
+        target = os.path.join(output_data_dir, os.path.relpath(band.img_path,
+                                                               product.data_dir))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        copy_window(band, target, window, block_lines)
+
+    root = product.root
+    tpg_infos = {info.findtext('TPG_NAME'): info
+                 for info in root.findall('Tie_Point_Grids/Tie_Point_Grid_Info')}
+    for grid_name, grid in product.tie_point_grids.items():
+        target = os.path.join(output_data_dir, os.path.relpath(grid.img_path,
+                                                               product.data_dir))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        ncols, nrows, offset_x, offset_y = subset_tie_point_grid(grid, target, window)
+        info = tpg_infos[grid_name]
+        info.find('NCOLS').text = str(ncols)
+        info.find('NROWS').text = str(nrows)
+        info.find('OFFSET_X').text = str(offset_x)
+        info.find('OFFSET_Y').text = str(offset_y)
+
+    if root.find('DATASET_ID/DATASET_NAME') is not None:
+        root.find('DATASET_ID/DATASET_NAME').text = name
+    root.find('Raster_Dimensions/NCOLS').text = str(width)
+    root.find('Raster_Dimensions/NROWS').text = str(height)
+    for info in root.findall('Image_Interpretation/Spectral_Band_Info'):
+        for tag, value in (('BAND_RASTER_WIDTH', width), ('BAND_RASTER_HEIGHT', height)):
+            if info.find(tag) is not None:
+                info.find(tag).text = str(value)
+    for path in root.iter():
+        href = path.get('href')
+        if href and href.startswith(old_data + '/'):
+            path.set('href', new_data + href[len(old_data):])
+
+    for element in [product.metadata_element] + list(product.slave_elements.values()):
+        if element is not None:
+            subset_metadata(element, window, product.tie_point_grids)
+    master = element_attributes(product.metadata_element)
+    for tag, key in (('PRODUCT_SCENE_RASTER_START_TIME', 'first_line_time'),
+                     ('PRODUCT_SCENE_RASTER_STOP_TIME', 'last_line_time')):
+        if root.find(f"Production/{tag}") is not None and key in master:
+            root.find(f"Production/{tag}").text = master[key]
+
+    ET.ElementTree(root).write(output_path + '.tmp', encoding='ISO-8859-1',
+                               xml_declaration=True)
+    os.replace(output_path + '.tmp', output_path)
+
+    return window
+
+
+if __name__ == "__main__":
+    inps = cmdline_parser()
+    dim_file = os.path.abspath(inps.dim_file)
+    if not os.path.isfile(dim_file):
+        sys.exit(f"Error, {dim_file} does not exist.")
+
+    product = DimapProduct(dim_file)
+    print(f"{product.name}: {product.width} x {product.height}, IW"
+          f"{''.join(product.iws) or '?'}, master {product.master_date}, "
+          f"slaves {' '.join(product.slave_dates) or '-'}")
+    for band in product.bands.values():
+        line = f"  {band.name:<40} {band.dtype.name:>8}  {band.unit or ''}"
+        if band.is_virtual:
+            line += f"  virtual: {band.expression}"
+        elif inps.stats:
+            low, high, total, count = np.inf, -np.inf, 0.0, 0
+            for _, block in band.blocks():
+                block = block[np.isfinite(block)] if block.dtype.kind == 'f' else block
+                if band.no_data is not None:
+                    block = block[block != band.no_data]
+                if block.size:
+                    low = min(low, block.min())
+                    high = max(high, block.max())
+                    total += float(block.sum(dtype='f8'))
+                    count += block.size
+            if count:
+                line += f"  min {low:.6g}  max {high:.6g}  mean {total / count:.6g}"
+        print(line)
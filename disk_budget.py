@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import os
+import shutil
+
+from gpt_resources import graph_profile, parse_size
+from job_manifest import path_signature
+from scratch import data_dir, remove_product
+
+
+def add_disk_arguments(parser):
+    """Add the options removing intermediate products to parser."""
+    parser.add_argument('--collect',
+                        action='store_true',
+                        help='remove each intermediate product (split, coreg, merge,\n' +
+                        'ifg) once all jobs reading it have succeeded')
+    parser.add_argument('--archive',
+                        metavar='DIR',
+                        help='move the intermediate products to DIR instead of\n' +
+                        'removing them, implies --collect')
+    parser.add_argument('--disk-budget',
+                        type=parse_size,
+                        help='space the products of the run may take, e.g. 2T; new\n' +
+                        'jobs wait while it or the free space would be exceeded,\n' +
+                        'implies --collect')
+
+
+def job_consumers(jobs):
+    """Return {path: jobs reading it} of jobs, batch jobs by their members."""
+    consumers = {}
+    for job in jobs:
+        for j in job.members or [job]:
+            for path in j.inputs:
+                consumers.setdefault(path, []).append(j)
+
+    return consumers
+
+
+def product_size(path):
+    """Return the size of a product in MB, 0 if it does not exist."""
+    signature = path_signature(path)
+
+    return signature[0] / 2**20 if signature else 0.0
+
+
+def existing_parent(path):
+    """Return path or its closest existing parent directory."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+
+    return path
+
+
+def move_product(path, target_dir):
+    """Move a product, or a .dim with its .data directory, to target_dir.
+
+    The .dim is moved last, so target_dir never has a header without data.
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    target = os.path.join(target_dir, os.path.basename(path))
+    remove_product(target)
+    if data_dir(path) and os.path.isdir(data_dir(path)):
+        shutil.move(data_dir(path), data_dir(target))
+    shutil.move(path, target)
+
+
+class DiskBudget:
+    """Removal of the intermediate products of a run, within a disk budget.
+
+    A product written by one job of the run and read by others is removed,
+    or moved to a subdirectory of archive_dir, once all jobs reading it have
+    succeeded. The manifest records it, so that a rerun does not redo the
+    job that wrote it while its readers are up to date. With a budget in
+    MB, a job waits while the products of the run, the expected outputs of
+    the running jobs and its own would exceed the budget or the free space
+    of the device it writes. A job always starts if no other job runs.
+    """
+
+    def __init__(self, jobs, manifest, budget=None, archive_dir=None):
+        self.manifest = manifest
+        self.budget = budget
+        self.archive_dir = archive_dir
+        self.consumers = job_consumers(jobs)
+        self.producers = {}
+        for job in jobs:
+            for j in job.members or [job]:
+                self.producers.update((path, j) for path in j.outputs)
+        self.sizes = {path: product_size(path) for path in self.producers}
+        self.input_sizes = {}
+        # MB read and written by the finished jobs of each profile
+        self.ratios = {}
+        self.waiting = set()
+        self.collected = 0.0
+
+        if budget is not None:
+            print(f"Disk budget {budget}M, products of the run take "
+                  f"{self.used():.0f}M now")
+
+    def used(self):
+        return sum(self.sizes.values())
+
+    def input_size(self, job):
+        """Return the MB of the inputs of job, measured once they all exist."""
+        if job not in self.input_sizes:
+            self.input_sizes[job] = sum(
+                product_size(path) for j in job.members or [job] for path in j.inputs)
+
+        return self.input_sizes[job]
+
+    def estimate(self, job):
+        """Return the expected MB of the outputs of job.
+
+        Uses the ratio of output to input size of the finished jobs of the
+        same profile, and the input size before any of them finished.
+        """
+        read, written = self.ratios.get(graph_profile(job.xml_data), (0.0, 0.0))
+        ratio = written / read if read else 1.0
+
+        return self.input_size(job) * ratio
+
+    def admit(self, job, active):
+        """Check whether the outputs of job fit next to those of the active jobs."""
+        if self.budget is None or not active or not job.outputs:
+            return True
+
+        estimate = self.estimate(job)
+        reserved = sum(self.estimate(j) for j in active)
+        free = shutil.disk_usage(existing_parent(job.outputs[0])).free / 2**20
+        if self.used() + reserved + estimate <= self.budget and \
+                reserved + estimate <= free:
+            return True
+
+        if job not in self.waiting:
+            self.waiting.add(job)
+            print(f"Wait with {job.name}, about {estimate:.0f}M more would exceed "
+                  f"the disk budget ({self.used():.0f}M used, {free:.0f}M free).")
+        return False
+
+    def finished(self, job):
+        """Measure the outputs of a succeeded job and collect the products it read."""
+        for j in job.members or [job]:
+            for path in j.outputs:
+                self.sizes[path] = product_size(path)
+            if not j.skipped:
+                profile = graph_profile(j.xml_data)
+                read, written = self.ratios.get(profile, (0.0, 0.0))
+                self.ratios[profile] = (read + self.input_size(j),
+                                        written + sum(self.sizes[p] for p in j.outputs))
+
+        for j in job.members or [job]:
+            for path in j.inputs:
+                self.collect(path)
+
+    def collect(self, path):
+        """Remove or archive path if it is an intermediate product all readers used."""
+        producer = self.producers.get(path)
+        readers = self.consumers.get(path, [])
+        if producer is None or not readers or not os.path.exists(path) or \
+                any(j.returncode != 0 for j in readers):
+            return
+
+        size = product_size(path)
+        name = os.path.join(os.path.basename(os.path.dirname(path)), os.path.basename(path))
+        if self.archive_dir:
+            target_dir = os.path.join(self.archive_dir,
+                                      os.path.basename(os.path.dirname(path)))
+            move_product(path, target_dir)
+            print(f"Archived {name} to {target_dir} ({size:.0f}M).")
+        else:
+            remove_product(path)
+            print(f"Removed {name}, read by all {len(readers)} "
+                  f"of its jobs ({size:.0f}M).")
+        self.manifest.collect(producer, path)
+        self.sizes[path] = 0.0
+        self.collected += size
+
+    def report(self):
+        """Print the space freed and the products left."""
+        print(f"Collected {self.collected:.0f}M of intermediate products, "
+              f"{self.used():.0f}M of products left.")
+
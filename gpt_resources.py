@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import os
+import re
+
+import product_format
+
+# heap limits in MB, share of the heap given to the tile cache and the
+# share of a device's I/O budget a job takes, lower for compute bound stages
+PROFILES = {
+    'coreg': {
+        'min_heap': 6144, 'max_heap': 32768, 'cache_fraction': 0.6, 'io_weight': 0.5
+    },
+    'split': {
+        'min_heap': 2048, 'max_heap': 8192, 'cache_fraction': 0.5, 'io_weight': 1.0
+    },
+    'merge': {
+        'min_heap': 4096, 'max_heap': 16384, 'cache_fraction': 0.6, 'io_weight': 1.0
+    },
+    'ifg': {
+        'min_heap': 4096, 'max_heap': 16384, 'cache_fraction': 0.6, 'io_weight': 0.5
+    },
+    'subset': {
+        'min_heap': 2048, 'max_heap': 8192, 'cache_fraction': 0.5, 'io_weight': 1.0
+    },
+    'export': {
+        'min_heap': 2048, 'max_heap': 8192, 'cache_fraction': 0.4, 'io_weight': 1.0
+    },
+    'default': {
+        'min_heap': 2048, 'max_heap': 16384, 'cache_fraction': 0.6, 'io_weight': 1.0
+    },
+}
+
+# first operator found decides the profile of a graph
+PROFILE_OPERATORS = [
+    ('Back-Geocoding', 'coreg'),
+    ('StampsExport', 'export'),
+    ('TOPSAR-Merge', 'merge'),
+    ('Interferogram', 'ifg'),
+    ('Subset', 'subset'),
+    ('TOPSAR-Split', 'split'),
+]
+
+# share of the available memory given to gpt jobs
+MEMORY_FRACTION = 0.85
+
+
+def add_resource_arguments(parser):
+    """Add the options overriding the automatic gpt sizing to parser."""
+    parser.add_argument('--heap',
+                        type=parse_size,
+                        help='JVM heap of each gpt job, e.g. 8G (default: from\n' +
+                        'available memory, --jobs and the stage)')
+    parser.add_argument('--tile-cache',
+                        type=parse_size,
+                        help='tile cache of each gpt job, e.g. 4G (default: part of heap)')
+    parser.add_argument('--gpt-threads',
+                        type=int,
+                        help='threads of each gpt job (default: CPUs / --jobs)')
+
+
+def add_io_arguments(parser):
+    """Add the options limiting the jobs per storage device to parser."""
+    parser.add_argument('--io-jobs',
+                        type=float,
+                        metavar='N',
+                        help='I/O budget of each storage device: at most N I/O bound\n' +
+                        'jobs (export, split, merge, subset) or 2N coreg and ifg\n' +
+                        'jobs read or write one device at once (default: no limit)')
+    parser.add_argument('--io-limit',
+                        type=parse_io_limit,
+                        action='append',
+                        default=[],
+                        metavar='PATH=N',
+                        help='I/O budget of the device holding PATH, overrides\n' +
+                        '--io-jobs, can be repeated')
+
+
+def parse_io_limit(value):
+    """Return (path, budget) of a value like /data=2."""
+    path, _, number = value.rpartition('=')
+    if not path:
+        raise ValueError(f"Cannot read I/O limit {value}")
+
+    return os.path.abspath(path), float(number)
+
+
+def parse_size(value):
+    """Return the size in MB of a value like 512M, 8G or 8192."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kKmMgGtT]?)[bB]?\s*', value)
+    if not match:
+        raise ValueError(f"Cannot read size {value}")
+    number, unit = float(match.group(1)), match.group(2).upper()
+    factor = {'K': 1 / 1024, '': 1, 'M': 1, 'G': 1024, 'T': 1024 * 1024}[unit]
+
+    return int(number * factor)
+
+
+def memory_info():
+    """Return (total, available) memory in MB."""
+    info = {}
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                info[key] = int(value.split()[0]) // 1024
+    except OSError:
+        pass
+
+    if 'MemTotal' not in info:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2**20
+        return total, total
+
+    return info['MemTotal'], info.get('MemAvailable', info.get('MemFree', 0))
+
+
+def cpu_count():
+    """Return the number of CPUs this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+def graph_profile(xml_data):
+    """Return the resource profile of a graph from its operators."""
+    for operator, profile in PROFILE_OPERATORS:
+        if f"<operator>{operator}</operator>" in xml_data:
+            return profile
+
+    return 'default'
+
+
+class GptSizing:
+    """Heap, tile cache and threads of gpt jobs running num_jobs at a time.
+
+    heap and tile_cache in MB and threads override the sizes derived from
+    the memory available when the object is created and the CPUs.
+    """
+
+    def __init__(self, num_jobs, heap=None, tile_cache=None, threads=None):
+        self.num_jobs = max(1, num_jobs)
+        self.heap = heap
+        self.tile_cache = tile_cache
+        self.threads = threads
+        self.total, self.available = memory_info()
+        self.cpus = cpu_count()
+        self.reported = set()
+
+    def sizing(self, profile):
+        """Return (heap, tile_cache, threads) in MB for a profile."""
+        limits = PROFILES[profile]
+        budget = int(self.available * MEMORY_FRACTION / self.num_jobs)
+        heap = self.heap or max(limits['min_heap'], min(limits['max_heap'], budget))
+        tile_cache = self.tile_cache or int(heap * limits['cache_fraction'])
+        threads = self.threads or max(1, self.cpus // self.num_jobs)
+
+        if profile not in self.reported:
+            self.reported.add(profile)
+            print(f"gpt {profile} jobs: heap {heap}M, tile cache {tile_cache}M, "
+                  f"{threads} threads ({self.num_jobs} jobs, {self.cpus} CPUs, "
+                  f"{self.available}M of {self.total}M memory available)")
+            if heap * self.num_jobs > self.available:
+                print(f"Warning: {self.num_jobs} {profile} jobs with {heap}M heap "
+                      "may exceed the available memory, consider fewer --jobs.")
+
+        return heap, tile_cache, threads
+
+    def gpt_options(self, xml_data):
+        """Return the gpt command line options for a graph, with those of its writers."""
+        heap, tile_cache, threads = self.sizing(graph_profile(xml_data))
+
+        return [f"-J-Xmx{heap}M", '-c', f"{tile_cache}M", '-q', str(threads)
+                ] + product_format.gpt_options(xml_data)
+
+
+def path_device(path):
+    """Return the device id of path, or of its closest existing parent."""
+    path = os.path.abspath(path)
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+
+def mount_point(path):
+    """Return the mount point of the filesystem holding path."""
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+
+    return path
+
+
+class IoLimits:
+    """Per device budget of the jobs reading or writing a device at once.
+
+    A job takes the io_weight of its profile from the budget of every
+    device of its inputs and outputs, and only starts if it fits all of
+    them. A job on idle devices always starts, even if it is larger
+    than a budget.
+    """
+
+    def __init__(self, budget=None, limits=()):
+        self.budget = budget
+        self.limits = {path_device(path): number for path, number in limits}
+        self.devices = {}
+
+    @property
+    def enabled(self):
+        return self.budget is not None or bool(self.limits)
+
+    def job_devices(self, job):
+        """Return {device: mount point} of the inputs and outputs of job."""
+        if job not in self.devices:
+            devices = {}
+            for j in [job] + job.members:
+                for path in j.inputs + j.outputs:
+                    device = path_device(path)
+                    if device is not None and device not in devices:
+                        devices[device] = mount_point(path)
+            self.devices[job] = devices
+
+        return self.devices[job]
+
+    def report(self, jobs):
+        """Print the budget of every device used by jobs."""
+        mounts = {}
+        for job in jobs:
+            mounts.update(self.job_devices(job))
+        for device, mount in sorted(mounts.items(), key=lambda m: m[1]):
+            budget = self.limits.get(device, self.budget)
+            print(f"I/O budget of {mount}: " +
+                  ('no limit' if budget is None else f"{budget:g}"))
+
+    def admit(self, job, running):
+        """Check whether job fits the budgets of its devices next to running jobs."""
+        weight = PROFILES[graph_profile(job.xml_data)]['io_weight']
+        for device in self.job_devices(job):
+            budget = self.limits.get(device, self.budget)
+            if budget is None:
+                continue
+            load = sum(PROFILES[graph_profile(j.xml_data)]['io_weight'] for j in running
+                       if device in self.job_devices(j))
+            if load and load + weight > budget:
+                return False
+
+        return True
@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import gzip
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import job_stats
+import scratch
+import snap_server
+from disk_budget import DiskBudget, job_consumers
+from gpt_resources import (GptSizing, IoLimits, add_io_arguments,
+                           add_resource_arguments)
+from job_manifest import JobManifest
+from work_queue import WorkQueue
+
+PROGRESS_PATTERN = re.compile(rb'(\d{1,3})%')
+LOG_TAIL_LINES = 20
+
+
+class GptJob:
+    """One gpt graph of a stage, written to xml_path and run by run_jobs.
+
+    A job only starts once all jobs in deps have succeeded. A batch job
+    made by batch_jobs runs the graphs of its members in one gpt process.
+    pre_steps are (function, args) called as function(*args) before gpt,
+    on the host running it. post_steps are (function, args) called as function(*args, written)
+    once gpt succeeded, with written as {output: local copy} of staged
+    outputs; they raise OSError or ValueError to fail the job. function is
+    a module level function and args are JSON values, so that they can be
+    queued.
+    """
+
+    def __init__(self, name, xml_path, xml_data, inputs=(), outputs=(), deps=()):
+        self.name = name
+        self.xml_path = xml_path
+        self.xml_data = xml_data
+        self.log_path = xml_path[0:-4] + '.log'
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.gpt_options = []
+        self.members = []
+        self.pre_steps = []
+        self.post_steps = []
+
+        self.returncode = None
+        self.skipped = False
+        self.blocked = False
+        self.time = 0.0
+        self.stats = {}
+
+
+def add_runner_arguments(parser):
+    """Add the options shared by all stage scripts to parser."""
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=1,
+                        help='number of gpt jobs to run in parallel (default: 1)')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='rerun jobs whose outputs are complete and up to date')
+    parser.add_argument('--compress-logs',
+                        action='store_true',
+                        help='gzip the gpt log of each job after it succeeded')
+    parser.add_argument('--queue',
+                        action='store_true',
+                        help='only add the jobs to the queue in xml/queue, to be\n' +
+                        'run by queue_worker.py on one or more nodes')
+    parser.add_argument('--snap-server',
+                        metavar='SOCKET',
+                        help='run the graphs on a running snap_server.py instead of\n' +
+                        'starting gpt for each job, gpt is used if it is not reachable')
+    add_resource_arguments(parser)
+    add_io_arguments(parser)
+    scratch.add_scratch_arguments(parser)
+
+
+def run_process(job, lock, index, total, xml_path=None):
+    """Run the graph of job in a new gpt process and record its resource use.
+
+    xml_path replaces the graph file of job, e.g. one on scratch copies.
+    """
+    args = ['gpt'] + job.gpt_options + [xml_path or job.xml_path]
+    time_start = time.time()
+    progress = None
+    with open(job.log_path, 'wb') as log:
+        process = subprocess.Popen(args,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        sampler = job_stats.ProcessSampler(process.pid)
+        sampler.start()
+        # gpt writes its progress as dots without newlines, so read chunks
+        while True:
+            chunk = process.stdout.read1(4096)
+            if not chunk:
+                break
+            log.write(chunk)
+            percents = PROGRESS_PATTERN.findall(chunk)
+            if percents and percents[-1] != progress:
+                progress = percents[-1]
+                with lock:
+                    print(f"[{index}/{total}] {job.name}: "
+                          f"{str(progress, encoding='ascii')}%")
+        rusage = job_stats.wait_process(process)
+        sampler.stop()
+    job.time = time.time() - time_start
+    job.returncode = process.returncode
+
+    job.stats = sampler.stats()
+    job.stats['user_time'] = round(rusage['user_time'], 3)
+    job.stats['sys_time'] = round(rusage['sys_time'], 3)
+    job.stats['peak_rss'] = max(job.stats['peak_rss'], rusage['peak_rss'])
+
+
+def run_on_server(job, lock, server, xml_path=None):
+    """Run the graph of job on a snap_server.py listening on server.
+
+    Return False, leaving job untouched, if the server cannot be reached
+    or stops while running the job.
+    """
+    time_start = time.time()
+    try:
+        job.returncode = snap_server.run_graph(server, xml_path or job.xml_path,
+                                               job.log_path)
+    except OSError as e:
+        with lock:
+            print(f"Cannot run {job.name} on {server} ({e}), starting gpt.")
+        return False
+    job.time = time.time() - time_start
+    job.stats = {}
+
+    return True
+
+
+def run_gpt(job, lock, index, total, compress_log=False, server=None, staging=None):
+    """Run gpt for job, streaming its output to the log file of the job.
+
+    The console only gets a status line whenever gpt reports a new
+    progress percentage, and the tail of the log if the job fails. With
+    server, the socket of a snap_server.py, the graph runs there instead,
+    and in a new gpt process if the server cannot be reached. With a
+    Scratch as staging, the graph runs on local copies of the inputs and
+    writes its outputs locally; the caller copies them back.
+    """
+    with lock:
+        print(f"[{index}/{total}] Start: {job.name}")
+
+    if os.path.isfile(job.log_path + '.gz'):
+        os.remove(job.log_path + '.gz')
+
+    try:
+        for function, args in job.pre_steps:
+            function(*args)
+    except (OSError, ValueError) as e:
+        job.returncode = 1
+        with open(job.log_path, 'w') as f:
+            f.write(f"Error before gpt: {e}\n")
+    else:
+        xml_path = staging.stage(job) if staging else None
+        if not (server and run_on_server(job, lock, server, xml_path)):
+            run_process(job, lock, index, total, xml_path)
+    if job.returncode == 0 and job.post_steps:
+        written = staging.written_outputs(job) if staging else {}
+        try:
+            for function, args in job.post_steps:
+                function(*args, written)
+        except (OSError, ValueError) as e:
+            job.returncode = 1
+            with open(job.log_path, 'a') as f:
+                f.write(f"\nError after gpt: {e}\n")
+    if staging and job.returncode != 0:
+        staging.release(job)
+    job.stats['output_size'] = job_stats.output_size(job)
+
+    with lock:
+        print('[{}/{}] Finished {} in {:.1f} seconds.'.format(
+            index, total, job.name, job.time))
+        if job.returncode != 0:
+            print('Error processing {}, see {}'.format(job.name, job.log_path))
+            with open(job.log_path, 'r', errors='replace') as f:
+                print(''.join(f.readlines()[-LOG_TAIL_LINES:]))
+        else:
+            print('Complete processing {}'.format(job.name))
+
+    if compress_log and job.returncode == 0:
+        with open(job.log_path, 'rb') as f_in:
+            with gzip.open(job.log_path + '.gz', 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        os.remove(job.log_path)
+
+    return job
+
+
+def add_batch_argument(parser):
+    """Add --batch-size to the parser of a stage of small independent jobs."""
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=1,
+                        help='number of products to process in one gpt graph; the\n' +
+                        'products of a failed batch are rerun one by one (default: 1)')
+
+
+def combine_graphs(xml_datas):
+    """Return one graph running all the graphs in xml_datas side by side.
+
+    The nodes of the k-th graph get the suffix _k so that ids stay unique.
+    """
+    graph = ET.Element('graph', id='Graph')
+    ET.SubElement(graph, 'version').text = '1.0'
+    for k, xml_data in enumerate(xml_datas, start=1):
+        for node in ET.fromstring(xml_data).findall('node'):
+            node.set('id', f"{node.get('id')}_{k}")
+            sources = node.find('sources')
+            for source in (sources if sources is not None else []):
+                if source.get('refid'):
+                    source.set('refid', f"{source.get('refid')}_{k}")
+                elif source.text and source.text.strip():
+                    source.text = f"{source.text.strip()}_{k}"
+            graph.append(node)
+    ET.indent(graph)
+
+    return ET.tostring(graph, encoding='unicode') + '\n'
+
+
+def batch_jobs(jobs, batch_size, manifest=None, force=False):
+    """Group independent jobs into batch jobs of up to batch_size graphs.
+
+    Jobs with dependencies or post_steps, and jobs the manifest records as
+    up to date, are kept as they are.
+    """
+    if batch_size <= 1:
+        return list(jobs)
+
+    single = []
+    free = []
+    for job in jobs:
+        if job.deps or job.post_steps or \
+                (manifest and not force and manifest.is_up_to_date(job)):
+            single.append(job)
+        else:
+            free.append(job)
+
+    batches = []
+    num_batches = (len(free) + batch_size - 1) // batch_size
+    for i in range(num_batches):
+        members = free[i * batch_size:(i + 1) * batch_size]
+        if len(members) == 1:
+            batches.append(members[0])
+            continue
+        xml_dir, xml_name = os.path.split(members[0].xml_path)
+        batch = GptJob(f"batch {i + 1}/{num_batches} ({len(members)} products)",
+                       os.path.join(xml_dir, 'batch_' + xml_name),
+                       combine_graphs(m.xml_data for m in members),
+                       [p for m in members for p in m.inputs],
+                       [p for m in members for p in m.outputs])
+        batch.members = members
+        batch.pre_steps = [step for m in members for step in m.pre_steps]
+        batches.append(batch)
+
+    return single + batches
+
+
+def job_levels(jobs):
+    """Return {job: length of the longest chain of dependencies of job}.
+
+    Covers jobs, their batch members and the jobs they depend on, each
+    computed once after its dependencies, without recursion.
+    """
+    levels = {}
+    for root in [j for job in jobs for j in [job] + job.members]:
+        stack = [root]
+        while stack:
+            job = stack[-1]
+            if job in levels:
+                stack.pop()
+                continue
+            todo = [dep for dep in job.deps if dep not in levels]
+            if todo:
+                stack.extend(todo)
+                continue
+            levels[job] = 1 + max((levels[dep] for dep in job.deps), default=-1)
+            stack.pop()
+
+    return levels
+
+
+def run_jobs(jobs,
+             num_jobs=1,
+             manifest=None,
+             force=False,
+             compress_logs=False,
+             sizing=None,
+             server=None,
+             io_limits=None,
+             staging=None,
+             disk_budget=None):
+    """Write the graph of each job and run them on at most num_jobs gpt processes.
+
+    A job is started as soon as its dependencies succeeded; the jobs
+    depending on a failed one are not run. With a manifest, jobs recorded
+    there as up to date are skipped unless force is set, and every
+    finished job is recorded. The gpt output of a job goes to the .log
+    file next to its graph. The members of a failed batch job are run
+    one by one. With a GptSizing, heap, tile cache and threads
+    of each gpt process are set for the stage of its graph. With server,
+    the socket of a snap_server.py, graphs are run there. With IoLimits,
+    a job waits while the storage devices it uses are busy, and later ready
+    jobs on other devices go first. With a Scratch as staging, outputs are
+    copied back while the next jobs run, and a job counts as finished, for
+    its dependents and the manifest, once they are back. With a DiskBudget,
+    intermediate products are removed once read and jobs wait for space.
+    """
+    xml_paths = [job.xml_path for job in jobs]
+    duplicates = sorted(set(p for p in xml_paths if xml_paths.count(p) > 1))
+    if duplicates:
+        raise ValueError(f"Jobs share graph files: {', '.join(duplicates)}")
+
+    for job in jobs:
+        for j in [job] + job.members:
+            with open(j.xml_path, 'w+') as f:
+                f.write(j.xml_data)
+
+    if io_limits:
+        io_limits.report(jobs)
+
+    consumers = job_consumers(jobs)
+    levels = job_levels(jobs)
+    lock = threading.Lock()
+    num_jobs = max(1, num_jobs)
+    pending = list(jobs)
+    running = {}
+    copying = {}
+    checked = set()
+    index = 0
+    total = len(jobs)
+    with ThreadPoolExecutor(max_workers=num_jobs) as executor:
+        while pending or running or copying:
+            for job in list(pending):
+                if any(dep.blocked or dep.returncode not in (None, 0)
+                       for dep in job.deps):
+                    job.blocked = True
+                    pending.remove(job)
+                    print(f"Skip {job.name}, a job it depends on failed.")
+
+            # run the jobs deepest in the dependency graph first, so that
+            # early products flow through the later stages
+            ready = [
+                j for j in pending
+                if all(d.returncode == 0 and d not in copying.values() for d in j.deps)
+            ]
+            ready.sort(key=lambda j: -levels[j])
+            for job in ready:
+                if len(running) >= num_jobs:
+                    break
+                if job not in checked:
+                    checked.add(job)
+                    if manifest and not force and manifest.is_up_to_date(job, consumers):
+                        pending.remove(job)
+                        index += 1
+                        job.skipped = True
+                        job.returncode = 0
+                        job.stats['output_size'] = job_stats.output_size(job)
+                        print(f"[{index}/{total}] Skip {job.name}, "
+                              "outputs are up to date.")
+                        if disk_budget:
+                            disk_budget.finished(job)
+                        continue
+                if io_limits and not io_limits.admit(job, running.values()):
+                    continue
+                if disk_budget and not disk_budget.admit(
+                        job, list(running.values()) + list(copying.values())):
+                    continue
+                pending.remove(job)
+                index += 1
+                if sizing:
+                    job.gpt_options = sizing.gpt_options(job.xml_data)
+                future = executor.submit(run_gpt, job, lock, index, total,
+                                         compress_logs, server, staging)
+                running[future] = job
+
+            if not running and not copying:
+                if pending and not ready:
+                    # dependencies outside of jobs that never ran
+                    for job in pending:
+                        job.blocked = True
+                    break
+                continue
+
+            finished, _ = wait(list(running) + list(copying),
+                               return_when=FIRST_COMPLETED)
+            for future in finished:
+                if future in copying:
+                    job = copying.pop(future)
+                    try:
+                        future.result()
+                    except OSError as e:
+                        job.returncode = 1
+                        print(f"Error copying the outputs of {job.name} back "
+                              f"from scratch: {e}")
+                    job.stats['output_size'] = job_stats.output_size(job)
+                else:
+                    job = running.pop(future)
+                    future.result()
+                    if staging and job.returncode == 0:
+                        copying[staging.copy_back(job)] = job
+                        continue
+                if job.members and job.returncode != 0:
+                    print(f"{job.name} failed, running its products one by one.")
+                    pending.extend(job.members)
+                    total += len(job.members)
+                    continue
+                for member in job.members:
+                    # the batch used its resources for all members alike
+                    member.returncode = 0
+                    member.time = job.time / len(job.members)
+                    member.stats = {
+                        key: value / len(job.members)
+                        for key, value in job.stats.items()
+                        if key in ['user_time', 'sys_time', 'read_bytes', 'write_bytes']
+                    }
+                    member.stats['peak_rss'] = job.stats.get('peak_rss', 0)
+                    member.stats['output_size'] = job_stats.output_size(member)
+                    if manifest:
+                        manifest.update(member)
+                if manifest and not job.members:
+                    manifest.update(job)
+                if disk_budget and job.returncode == 0:
+                    disk_budget.finished(job)
+
+    return jobs
+
+
+def enqueue_jobs(jobs, queue_dir, manifest=None, force=False):
+    """Write the graph of each job and add it to the work queue in queue_dir.
+
+    Jobs without dependencies that the manifest records as up to date are
+    put into the queue as done.
+    """
+    queue = WorkQueue(queue_dir)
+    for job in jobs:
+        with open(job.xml_path, 'w+') as f:
+            f.write(job.xml_data)
+        if (manifest and not force and not job.deps and
+                manifest.is_up_to_date(job)):
+            queue.enqueue(job, 'done')
+        else:
+            queue.enqueue(job)
+
+    counts = queue.counts()
+    print(f"Queued {counts['pending']} jobs ({counts['done']} up to date) in "
+          f"{queue_dir}.\nStart workers with: python3 queue_worker.py {queue_dir}")
+
+
+def run_stage(jobs, inps, xml_dir, batch_size=1, collect=False):
+    """Run the jobs of a stage script with the options of add_runner_arguments.
+
+    With batch_size above one, independent jobs are run in batches. With
+    collect, intermediate products are removed with the options of
+    disk_budget.add_disk_arguments.
+    """
+    manifest = JobManifest(os.path.join(xml_dir, 'manifest.json'))
+    if inps.queue:
+        enqueue_jobs(jobs, os.path.join(xml_dir, 'queue'), manifest, inps.force)
+        return
+
+    sizing = GptSizing(inps.jobs, inps.heap, inps.tile_cache, inps.gpt_threads)
+    io_limits = IoLimits(inps.io_jobs, inps.io_limit)
+    staging = scratch.Scratch(inps.scratch, inps.scratch_size) if inps.scratch else None
+    batches = batch_jobs(jobs, batch_size, manifest, inps.force)
+    disk_budget = DiskBudget(batches, manifest, inps.disk_budget,
+                             inps.archive) if collect else None
+    try:
+        run_jobs(batches, inps.jobs, manifest, inps.force, inps.compress_logs, sizing,
+                 inps.snap_server, io_limits if io_limits.enabled else None, staging,
+                 disk_budget)
+    finally:
+        if staging:
+            staging.close()
+    if disk_budget:
+        disk_budget.report()
+    job_stats.write_report(jobs, xml_dir)
+    print_summary(jobs)
+
+
+def print_summary(jobs):
+    """Print return code, timing and resource usage of every job."""
+    if not jobs:
+        return
+
+    fmt = job_stats.format_bytes
+    width = max(len(job.name) for job in jobs)
+    print('\nSummary:')
+    print(f"  {'job':<{width}}  {'code':>4}  {'seconds':>10}  {'cpu':>10}  "
+          f"{'peak rss':>9}  {'read':>9}  {'written':>9}  {'output':>9}")
+    for job in jobs:
+        if job.skipped:
+            code = 'skip'
+        elif job.blocked:
+            code = 'dep'
+        else:
+            code = '-' if job.returncode is None else job.returncode
+        stats = job_stats.job_record(job)
+        cpu = stats['user_time'] + stats['sys_time']
+        print(f"  {job.name:<{width}}  {code:>4}  {job.time:>10.1f}  {cpu:>10.1f}  "
+              f"{fmt(stats['peak_rss']):>9}  {fmt(stats['read_bytes']):>9}  "
+              f"{fmt(stats['write_bytes']):>9}  {fmt(stats['output_size']):>9}")
+
+    failed = [job for job in jobs if job.returncode != 0]
+    skipped = [job for job in jobs if job.skipped]
+    total_time = sum(job.time for job in jobs)
+    total_cpu = sum(
+        job.stats.get('user_time', 0) + job.stats.get('sys_time', 0)
+        for job in jobs)
+    peak_rss = max(job.stats.get('peak_rss', 0) for job in jobs)
+    total_read = sum(job.stats.get('read_bytes', 0) for job in jobs)
+    total_written = sum(job.stats.get('write_bytes', 0) for job in jobs)
+    print(f"\n{len(jobs) - len(failed)}/{len(jobs)} jobs succeeded "
+          f"({len(skipped)} up to date), {total_time:.1f} seconds of gpt time.")
+    print(f"CPU {total_cpu:.1f} seconds, largest peak RSS {fmt(peak_rss)}, "
+          f"read {fmt(total_read)}, written {fmt(total_written)}.")
+    if failed:
+        print('Failed: ' + ', '.join(job.name for job in failed))
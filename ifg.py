@@ -6,11 +6,12 @@
 ##################################
 
 import argparse
-import glob
 import os
-import subprocess
 import sys
-import time
+
+import gpt_runner
+import prepare_dem
+import product_format
 
 IFG_XML = """<graph id="Graph">
   <version>1.0</version>
@@ -72,6 +73,7 @@ IFG_XML = """<graph id="Graph">
 
 EXAMPLE = """Example:
   python3 ifg.py /ly/coreg /ly/ifg
+  python3 ifg.py /ly/coreg /ly/ifg --jobs 8
 """
 
 
@@ -83,11 +85,32 @@ def cmdline_parser():
 
     parser.add_argument('input_dir', help='input directory')
     parser.add_argument('output_dir', help='output directory')
+    parser.add_argument('--dem',
+                        help='DEM GeoTIFF made by prepare_dem.py (default: SRTM 3Sec\n' +
+                        'downloaded by SNAP)')
+    gpt_runner.add_runner_arguments(parser)
+    gpt_runner.add_batch_argument(parser)
+    product_format.add_format_argument(parser)
     inps = parser.parse_args()
 
     return inps
 
 
+def ifg_job(dim, output_dir, xml_dir):
+    """Return the job producing the interferogram of the coreg product dim."""
+    dim_name = os.path.basename(dim)
+    stem = product_format.product_stem(dim)
+
+    xml_data = IFG_XML
+    xml_data = xml_data.replace('COREG_FILE', dim)
+    output_file = os.path.join(output_dir, stem + '.dim')
+    xml_data = xml_data.replace('OUTPUT_IFG_FILE', output_file)
+
+    xml_name = stem + '_ifg.xml'
+    xml_path = os.path.join(xml_dir, xml_name)
+    return gpt_runner.GptJob(dim_name, xml_path, xml_data, [dim], [output_file])
+
+
 if __name__ == "__main__":
     # get inputs
     inps = cmdline_parser()
@@ -105,38 +128,18 @@ if __name__ == "__main__":
     if not os.path.isdir(xml_dir):
       os.mkdir(xml_dir)
 
-    dims = glob.glob(os.path.join(input_dir, "*.dim"))
+    dims = product_format.find_products(input_dir)
     if len(dims) == 0:
-        sys.exit(f"Cannot find any dim file in {input_dir}")
-
-    for dim in dims:
-        index = dims.index(dim) + 1
-        dim_name = os.path.basename(dim)
-        print(f"\n[{index}/{len(dims)}] Processing file: {dim_name}\n")
-
-        xml_data = IFG_XML
-        xml_data = xml_data.replace('COREG_FILE', dim)
-        output_file = os.path.join(output_dir, dim_name)
-        xml_data = xml_data.replace('OUTPUT_IFG_FILE', output_file)
-
-        xml_name = dim_name[0:-4] + '_ifg.xml'
-        xml_path = os.path.join(xml_dir, xml_name)
-        with open(xml_path, 'w+') as f:
-            f.write(xml_data)
-
-        args = ['gpt', xml_path]
-        process = subprocess.Popen(args,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-        time_start = time.time()
-
-        stdout = process.communicate()[0]
-        print(str(stdout, encoding='utf-8'))
-
-        time_delta = time.time() - time_start
-        print('Finished in {} seconds.'.format(time_delta))
-
-        if process.returncode != 0:
-            print('Error producting interferogram with file {}\n'.format(dim_name))
-        else:
-            print('Complete producting interferogram with file {}\n'.format(dim_name))
+        sys.exit(f"Cannot find any product in {input_dir}")
+
+    jobs = [ifg_job(dim, output_dir, xml_dir) for dim in dims]
+    product_format.use_format(jobs, inps.format)
+
+    if inps.dem:
+        dem_file = os.path.abspath(inps.dem)
+        if not os.path.isfile(dem_file):
+            sys.exit(f"Cannot find DEM {dem_file}")
+        for job in jobs:
+            prepare_dem.use_external_dem(job, dem_file)
+
+    gpt_runner.run_stage(jobs, inps, xml_dir, inps.batch_size)
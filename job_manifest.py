@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import hashlib
+import json
+import os
+import threading
+
+
+def path_signature(path):
+    """Return [size, mtime] of path, or None if it does not exist.
+
+    A BEAM-DIMAP .dim header is summed together with its .data directory,
+    and directories are summed over all their files.
+    """
+    paths = []
+    if os.path.isfile(path):
+        paths.append(path)
+    if path.endswith('.dim'):
+        data_dir = path[0:-4] + '.data'
+        if not os.path.isdir(data_dir):
+            return None
+        path = data_dir
+    if os.path.isdir(path):
+        for root, _, files in os.walk(path):
+            paths.extend(os.path.join(root, f) for f in files)
+    elif not paths:
+        return None
+
+    size = 0
+    mtime = 0.0
+    for p in paths:
+        stat = os.stat(p)
+        size += stat.st_size
+        mtime = max(mtime, stat.st_mtime)
+
+    return [size, round(mtime, 3)]
+
+
+def xml_hash(xml_data):
+    """Return the sha1 of a rendered graph."""
+    return hashlib.sha1(xml_data.encode('utf-8')).hexdigest()
+
+
+class JobManifest:
+    """Record of the completed jobs of a stage, kept as JSON in its xml directory.
+
+    A job is recorded by the name of its graph file with the signatures of
+    its inputs and outputs and the hash of its graph, so that a rerun can
+    skip the jobs whose outputs are complete and up to date. Outputs
+    removed after use, see collect, keep their recorded signatures.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.records = json.load(f)
+
+    def is_up_to_date(self, job, consumers=None):
+        """Check whether job completed before with the same inputs and graph.
+
+        An output that was collected counts only if consumers, {path: jobs
+        reading it}, has jobs reading it and they are all up to date.
+        """
+        record = self.records.get(os.path.basename(job.xml_path))
+        if record is None or record['returncode'] != 0 or not job.outputs:
+            return False
+
+        if record['xml_hash'] != xml_hash(job.xml_data):
+            return False
+
+        collected = self.collected()
+        for key, paths in (('inputs', job.inputs), ('outputs', job.outputs)):
+            if sorted(record[key]) != sorted(paths):
+                return False
+            for path in paths:
+                signature = path_signature(path)
+                if signature is None and path in collected:
+                    readers = (consumers or {}).get(path)
+                    if key == 'outputs' and not (readers and all(
+                            self.is_up_to_date(j, consumers) for j in readers)):
+                        return False
+                    signature = collected[path]
+                if signature is None or signature != record[key][path]:
+                    return False
+
+        return True
+
+    def collected(self):
+        """Return {path: signature} of the outputs removed after use."""
+        with self.lock:
+            return {
+                path: record['outputs'][path]
+                for record in self.records.values()
+                for path in record.get('collected', [])
+            }
+
+    def collect(self, job, path):
+        """Record that the output path of job was removed after use."""
+        with self.lock:
+            record = self.records.get(os.path.basename(job.xml_path))
+            if record is None or path not in record['outputs']:
+                return
+            record['collected'] = sorted(set(record.get('collected', [])) | {path})
+            self._save()
+
+    def update(self, job):
+        """Record the result of job and save the manifest."""
+        record = {
+            'inputs': {p: path_signature(p) for p in job.inputs},
+            'xml_hash': xml_hash(job.xml_data),
+            'outputs': {p: path_signature(p) for p in job.outputs},
+            'returncode': job.returncode,
+        }
+        with self.lock:
+            self.records[os.path.basename(job.xml_path)] = record
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.records, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
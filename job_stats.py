@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import csv
+import json
+import os
+import threading
+
+from job_manifest import path_signature
+
+SAMPLE_INTERVAL = 1.0
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+REPORT_FIELDS = [
+    'name', 'returncode', 'skipped', 'wall_time', 'user_time', 'sys_time',
+    'peak_rss', 'read_bytes', 'write_bytes', 'output_size'
+]
+
+
+def process_tree(pid):
+    """Return pid and the pids of all its descendants from /proc."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", 'r') as f:
+                # the command name in parentheses may contain spaces
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = [pid]
+    for p in pids:
+        pids.extend(children.get(p, []))
+
+    return pids
+
+
+def read_rss(pid):
+    """Return the resident set size of pid in bytes."""
+    with open(f"/proc/{pid}/statm", 'r') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+def read_io(pid):
+    """Return [read_bytes, write_bytes] of pid, as counted by the block layer."""
+    io = {}
+    with open(f"/proc/{pid}/io", 'r') as f:
+        for line in f:
+            key, value = line.split(':')
+            io[key] = int(value)
+
+    return [io.get('read_bytes', 0), io.get('write_bytes', 0)]
+
+
+class ProcessSampler(threading.Thread):
+    """Sample memory and disk I/O of a process tree until stop() is called.
+
+    The I/O counters of a process are kept from its last sample, so that
+    children which exit between samples are still accounted for.
+    """
+
+    def __init__(self, pid, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.peak_rss = 0
+        self.io = {}
+
+    def sample(self):
+        if not os.path.isdir('/proc'):
+            return
+
+        rss = 0
+        for pid in process_tree(self.pid):
+            try:
+                rss += read_rss(pid)
+                self.io[pid] = read_io(pid)
+            except (OSError, ValueError):
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.sample()
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+    def stats(self):
+        return {
+            'peak_rss': self.peak_rss,
+            'read_bytes': sum(io[0] for io in self.io.values()),
+            'write_bytes': sum(io[1] for io in self.io.values()),
+        }
+
+
+def wait_process(process):
+    """Wait for a Popen process and return the rusage of its tree.
+
+    os.wait4 gives the CPU times and peak RSS of this child alone, unlike
+    resource.getrusage(RUSAGE_CHILDREN) which mixes all concurrent jobs.
+    """
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    return {
+        'user_time': rusage.ru_utime,
+        'sys_time': rusage.ru_stime,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss': rusage.ru_maxrss * 1024,
+    }
+
+
+def output_size(job):
+    """Return the total size of the existing outputs of job in bytes."""
+    signatures = [path_signature(p) for p in job.outputs]
+    return sum(s[0] for s in signatures if s)
+
+
+def job_record(job):
+    """Return the report row of job."""
+    record = {
+        'name': job.name,
+        'returncode': job.returncode,
+        'skipped': job.skipped,
+        'wall_time': round(job.time, 3),
+    }
+    for field in REPORT_FIELDS:
+        record.setdefault(field, job.stats.get(field, 0))
+
+    return record
+
+
+def write_report(jobs, xml_dir):
+    """Write report.csv and report.json of a stage into xml_dir."""
+    records = [job_record(job) for job in jobs]
+
+    with open(os.path.join(xml_dir, 'report.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+
+    with open(os.path.join(xml_dir, 'report.json'), 'w') as f:
+        json.dump(records, f, indent=2)
+
+
+def format_bytes(size):
+    """Format a byte count with a binary unit."""
+    for unit in ['B', 'K', 'M', 'G']:
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+
+    return f"{size:.1f}T"
@@ -6,11 +6,11 @@
 ##################################
 
 import os
-import subprocess
 import sys
-import time
 import argparse
-import glob
+
+import gpt_runner
+import product_format
 
 MERGE_2IW_XML = """<graph id="Graph">
   <version>1.0</version>
@@ -133,6 +133,7 @@ MERGE_3IW_XML = """<graph id="Graph">
 
 EXAMPLE = """Example:
   python3 merge.py /ly/coreg /ly/coreg_merge
+  python3 merge.py /ly/coreg /ly/coreg_merge --jobs 4
 """
 
 
@@ -144,11 +145,36 @@ def cmdline_parser():
 
     parser.add_argument('input_dir', help='input directory')
     parser.add_argument('output_dir', help='output directory')
+    gpt_runner.add_runner_arguments(parser)
+    gpt_runner.add_batch_argument(parser)
+    product_format.add_format_argument(parser)
     inps = parser.parse_args()
 
     return inps
 
 
+def merge_job(pair, iw, iw_files, output_dir, xml_dir):
+    """Return the job merging the iw_files of the subswaths iw of pair."""
+    output_file = os.path.join(output_dir, f"{pair}_IW{''.join(iw)}.dim")
+
+    if len(iw) == 2:
+        xml_data = MERGE_2IW_XML
+        xml_data = xml_data.replace('IW1_FILE', iw_files[0])
+        xml_data = xml_data.replace('IW2_FILE', iw_files[1])
+        xml_data = xml_data.replace('OUTPUT_MERGED_FILE', output_file)
+
+    if len(iw) == 3:
+        xml_data = MERGE_3IW_XML
+        xml_data = xml_data.replace('IW1_FILE', iw_files[0])
+        xml_data = xml_data.replace('IW2_FILE', iw_files[1])
+        xml_data = xml_data.replace('IW3_FILE', iw_files[2])
+        xml_data = xml_data.replace('OUTPUT_MERGED_FILE', output_file)
+
+    xml_name = pair + '_merge.xml'
+    xml_path = os.path.join(xml_dir, xml_name)
+    return gpt_runner.GptJob(pair, xml_path, xml_data, iw_files, [output_file])
+
+
 if __name__ == "__main__":
     # get inputs
     inps = cmdline_parser()
@@ -166,65 +192,29 @@ if __name__ == "__main__":
     if not os.path.isdir(xml_dir):
       os.mkdir(xml_dir)
 
-    dims = glob.glob(os.path.join(input_dir, "*.dim"))
+    dims = product_format.find_products(input_dir)
     if len(dims) == 0:
-        sys.exit(f"Cannot find any dim file in {input_dir}")
+        sys.exit(f"Cannot find any product in {input_dir}")
+    stems = {product_format.product_stem(i): i for i in dims}
 
     # get IW
-    iw = [i[-5:-4] for i in dims]
+    iw = [i[-1] for i in stems]
     iw = sorted(list(set(iw)))
 
     # get master_slave
     pairs = [os.path.basename(i)[0:17] for i in dims]
     pairs = sorted(list(set(pairs)))
 
+    if len(iw) == 1:
+        sys.exit("No need to merge.")
+
+    jobs = []
     for pair in pairs:
-        if len(iw) == 1:
-            print("No need to merge.")
-
-        if len(iw) == 2:
-            iw1_file = os.path.join(input_dir, f"{pair}_IW{iw[0]}.dim")
-            iw2_file = os.path.join(input_dir, f"{pair}_IW{iw[1]}.dim")
-            output_file = os.path.join(output_dir, f"{pair}_IW{''.join(iw)}.dim")
-
-            xml_data = MERGE_2IW_XML
-            xml_data = xml_data.replace('IW1_FILE', iw1_file)
-            xml_data = xml_data.replace('IW2_FILE', iw2_file)
-            xml_data = xml_data.replace('OUTPUT_MERGED_FILE', output_file)
-
-        if len(iw) == 3:
-            iw1_file = os.path.join(input_dir, f"{pair}_IW{iw[0]}.dim")
-            iw2_file = os.path.join(input_dir, f"{pair}_IW{iw[1]}.dim")
-            iw3_file = os.path.join(input_dir, f"{pair}_IW{iw[2]}.dim")
-            output_file = os.path.join(output_dir, f"{pair}_IW{''.join(iw)}.dim")
-
-            xml_data = MERGE_3IW_XML
-            xml_data = xml_data.replace('IW1_FILE', iw1_file)
-            xml_data = xml_data.replace('IW2_FILE', iw2_file)
-            xml_data = xml_data.replace('IW3_FILE', iw3_file)
-            xml_data = xml_data.replace('OUTPUT_MERGED_FILE', output_file)
-
-        index = pairs.index(pair) + 1
-        print(f"\n[{index}/{len(pairs)}] Processing pair: {pair}\n")
-
-        xml_name = pair + '_merge.xml'
-        xml_path = os.path.join(xml_dir, xml_name)
-        with open(xml_path, 'w+') as f:
-            f.write(xml_data)
-
-        args = ['gpt', xml_path]
-        process = subprocess.Popen(args,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-        time_start = time.time()
-
-        stdout = process.communicate()[0]
-        print(str(stdout, encoding='utf-8'))
-
-        time_delta = time.time() - time_start
-        print('Finished in {} seconds.'.format(time_delta))
-
-        if process.returncode != 0:
-            print('Error merging pair {}\n'.format(pair))
-        else:
-            print('Complete merging pair {}\n'.format(pair))
+        iw_files = [
+            stems.get(f"{pair}_IW{i}", os.path.join(input_dir, f"{pair}_IW{i}.dim"))
+            for i in iw
+        ]
+        jobs.append(merge_job(pair, iw, iw_files, output_dir, xml_dir))
+    product_format.use_format(jobs, inps.format)
+
+    gpt_runner.run_stage(jobs, inps, xml_dir, inps.batch_size)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import argparse
+import bisect
+import os
+import re
+import shutil
+import sys
+from datetime import datetime, timedelta
+
+import s1_index
+
+EOF_PATTERN = re.compile(r'^(S1[ABCD])_OPER_AUX_(POEORB|RESORB)_OPOD_(\d{8}T\d{6})_'
+                         r'V(\d{8}T\d{6})_(\d{8}T\d{6})\.EOF(\.zip)?$')
+ORBIT_TYPES = {
+    'POEORB': 'Sentinel Precise (Auto Download)',
+    'RESORB': 'Sentinel Restituted (Auto Download)',
+}
+# orbit state vectors needed before and after the acquisition
+ORBIT_MARGIN = timedelta(seconds=60)
+# longest validity of an orbit file, POEORB cover about 26 hours
+MAX_VALIDITY = timedelta(days=2)
+SNAP_ORBIT_DIR = os.path.expanduser('~/.snap/auxdata/Orbits/Sentinel-1')
+
+EXAMPLE = """Example:
+  python3 orbit_index.py /ly/orbits /ly/zips
+  python3 split_orbit.py /ly/zips /ly/slc date.info --orbit-dir /ly/orbits
+"""
+
+
+def cmdline_parser():
+    parser = argparse.ArgumentParser(
+        description='Find the POEORB or RESORB file of every Sentinel-1 zip in a ' +
+        'local orbit\ndirectory and place it where SNAP looks, so that ' +
+        'Apply-Orbit-File does not\ndownload orbits.',
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=EXAMPLE)
+
+    parser.add_argument('orbit_dir', help='directory of EOF files, searched recursively')
+    parser.add_argument('zip_dir', help='Sentinel-1 TOPS zips directory')
+    parser.add_argument('--snap-orbit-dir',
+                        default=SNAP_ORBIT_DIR,
+                        help='orbit directory of SNAP (default: %(default)s)')
+    inps = parser.parse_args()
+
+    return inps
+
+
+def parse_time(text):
+    return datetime.strptime(text, '%Y%m%dT%H%M%S')
+
+
+class OrbitIndex:
+    """Orbit files of a directory tree by mission and type, sorted by validity start.
+
+    The tree is listed once; lookups are a binary search in memory.
+    """
+
+    def __init__(self, orbit_dir):
+        self.orbit_dir = orbit_dir
+        self.orbits = {}
+        for root, _, files in os.walk(orbit_dir):
+            for name in files:
+                match = EOF_PATTERN.match(name)
+                if not match:
+                    continue
+                mission, orbit_type, production, start, stop = match.groups()[0:5]
+                self.orbits.setdefault((mission, orbit_type), []).append(
+                    (parse_time(start), parse_time(stop), production,
+                     os.path.join(root, name)))
+        for orbits in self.orbits.values():
+            orbits.sort()
+        self.starts = {key: [o[0] for o in orbits] for key, orbits in self.orbits.items()}
+
+    def __len__(self):
+        return sum(len(orbits) for orbits in self.orbits.values())
+
+    def find(self, mission, start, stop):
+        """Return (orbit_type, path) of the orbit covering start to stop.
+
+        POEORB is preferred over RESORB, and the latest production among
+        files of the same type. Return None if no file covers the time.
+        """
+        start, stop = start - ORBIT_MARGIN, stop + ORBIT_MARGIN
+        for orbit_type in ORBIT_TYPES:
+            orbits = self.orbits.get((mission, orbit_type), [])
+            i = bisect.bisect_right(self.starts.get((mission, orbit_type), []), start)
+            found = []
+            # files starting before start, back to the longest validity
+            while i > 0 and orbits[i - 1][0] > start - MAX_VALIDITY:
+                i -= 1
+                if orbits[i][1] >= stop:
+                    found.append(orbits[i])
+            if found:
+                return orbit_type, max(found, key=lambda o: o[2])[3]
+
+        return None
+
+
+def zip_times(zip_files):
+    """Return mission, start and stop time of the zips of one date."""
+    times = []
+    for zip_file in zip_files:
+        match = s1_index.ZIP_PATTERN.match(os.path.basename(zip_file))
+        times.append((parse_time(f"{match.group(1)}T{match.group(2)}"),
+                      parse_time(f"{match.group(3)}T{match.group(4)}")))
+
+    return (os.path.basename(zip_files[0])[0:3], min(t[0] for t in times),
+            max(t[1] for t in times))
+
+
+def place_orbit(path, orbit_type, mission, month, snap_orbit_dir=None):
+    """Link an orbit file into the directory SNAP searches for month, as YYYYMM.
+
+    snap_orbit_dir defaults to SNAP_ORBIT_DIR of the host calling it.
+    """
+    target_dir = os.path.join(snap_orbit_dir or SNAP_ORBIT_DIR, orbit_type, mission,
+                              month[0:4], month[4:6])
+    target = os.path.join(target_dir, os.path.basename(path))
+    if os.path.exists(target):
+        return target
+
+    os.makedirs(target_dir, exist_ok=True)
+    try:
+        os.symlink(path, target)
+    except FileExistsError:
+        # linked by a job of another date at the same time
+        pass
+    except OSError:
+        shutil.copy2(path, target)
+
+    return target
+
+
+def use_local_orbit(job, orbits, snap_orbit_dir=None):
+    """Set the orbit type of the zips of job in its graph and place the orbit before gpt.
+
+    The orbit is placed by a pre step of job, on the host running it.
+    Return the orbit file, or None if orbits has none and SNAP will try to
+    download it.
+    """
+    zip_files = [p for p in job.inputs
+                 if s1_index.ZIP_PATTERN.match(os.path.basename(p))]
+    if not zip_files or '<operator>Apply-Orbit-File</operator>' not in job.xml_data:
+        return None
+
+    mission, start, stop = zip_times(zip_files)
+    found = orbits.find(mission, start, stop)
+    if found is None:
+        print(f"No orbit of {mission} {start:%Y%m%dT%H%M%S} in {orbits.orbit_dir}, "
+              "SNAP will try to download it.")
+        return None
+
+    orbit_type, path = found
+    job.pre_steps.append(
+        (place_orbit, [path, orbit_type, mission, f"{start:%Y%m}", snap_orbit_dir]))
+    job.xml_data = job.xml_data.replace(
+        f"<orbitType>{ORBIT_TYPES['POEORB']}</orbitType>",
+        f"<orbitType>{ORBIT_TYPES[orbit_type]}</orbitType>")
+    # a newer orbit file makes the job rerun
+    job.inputs.append(path)
+
+    return path
+
+
+if __name__ == "__main__":
+    inps = cmdline_parser()
+    orbit_dir = os.path.abspath(inps.orbit_dir)
+    zip_dir = os.path.abspath(inps.zip_dir)
+
+    if not os.path.isdir(orbit_dir):
+        sys.exit(f"Error, {orbit_dir} does not exist.")
+
+    if not os.path.isdir(zip_dir):
+        sys.exit(f"Error, {zip_dir} does not exist.")
+
+    orbits = OrbitIndex(orbit_dir)
+    print(f"{len(orbits)} orbit files in {orbit_dir}")
+
+    index_path = s1_index.default_index_path(zip_dir, orbit_dir)
+    zips = s1_index.zips_by_date(s1_index.update_index(zip_dir, index_path))
+    for date, zip_files in zips.items():
+        mission, start, stop = zip_times(zip_files)
+        found = orbits.find(mission, start, stop)
+        if found is None:
+            print(f"{date}  {mission}  no orbit file")
+            continue
+        orbit_type, path = found
+        place_orbit(path, orbit_type, mission, f"{start:%Y%m}", inps.snap_orbit_dir)
+        print(f"{date}  {mission}  {orbit_type}  {os.path.basename(path)}")
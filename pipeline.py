@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import argparse
+import os
+import sys
+
+import disk_budget
+import gpt_runner
+import orbit_index
+import prepare_dem
+import product_format
+import s1_index
+from coreg import coreg_job
+from ifg import ifg_job
+from merge import merge_job
+from psi_export import psi_export_job
+from split_orbit import aoi_slc_infos, read_slc_infos, split_orbit_job
+
+EXAMPLE = """Example:
+  python3 pipeline.py /ly/zips /ly/work date.info 20200118 --jobs 8
+  python3 pipeline.py /ly/zips /ly/work 20200118 --aoi 100.1 100.5 40.2 40.4
+  python3 pipeline.py /ly/zips /ly/work date.info 20200118 --disk-budget 2T
+"""
+
+
+def cmdline_parser():
+    parser = argparse.ArgumentParser(
+        description='Run split, coregistration, merge, interferogram and ' +
+        'StaMPS export\nas one dependency graph of gpt jobs.',
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=EXAMPLE)
+
+    parser.add_argument('zip_dir', help='Sentinel-1 TOPS zips directory')
+    parser.add_argument('work_dir',
+                        help='output directory, gets slc, coreg, merge, ifg ' +
+                        'and INSAR_{master}')
+    parser.add_argument('info_file',
+                        nargs='?',
+                        help='file including date IW first_burst last_burst,\n' +
+                        'with --aoi only its dates are used (default: all dates)')
+    parser.add_argument('master', help='master slc date for coregistration')
+    parser.add_argument('--aoi',
+                        nargs='+',
+                        help='lon_min lon_max lat_min lat_max or WKT polygon; select\n' +
+                        'the IWs and bursts covering it from the zip annotations')
+    parser.add_argument('--dem-tiles',
+                        metavar='TILE_DIR',
+                        help='build work_dir/dem/dem.tif from the DEM tiles in TILE_DIR\n' +
+                        'and use it instead of SRTM 3Sec downloaded by SNAP')
+    parser.add_argument('--orbit-dir',
+                        help='local directory of POEORB/RESORB EOF files to take the\n' +
+                        'orbits from instead of downloading them')
+    gpt_runner.add_runner_arguments(parser)
+    product_format.add_format_argument(parser)
+    disk_budget.add_disk_arguments(parser)
+    inps = parser.parse_args()
+
+    return inps
+
+
+def make_dir(path):
+    """Create path with its xml directory and return both."""
+    xml_dir = os.path.join(path, 'xml')
+    os.makedirs(xml_dir, exist_ok=True)
+
+    return path, xml_dir
+
+
+def pipeline_jobs(slc_infos, zips, work_dir, master_date):
+    """Return the jobs of the whole chain with their dependencies.
+
+    Jobs are split per date and IW, coreg per slave and IW, and merge, ifg
+    and export per pair; each depends on the jobs writing its inputs.
+    """
+    slc_dir, slc_xml = make_dir(os.path.join(work_dir, 'slc'))
+    coreg_dir, coreg_xml = make_dir(os.path.join(work_dir, 'coreg'))
+    ifg_dir, ifg_xml = make_dir(os.path.join(work_dir, 'ifg'))
+    export_dir, export_xml = make_dir(
+        os.path.join(work_dir, f"INSAR_{master_date}"))
+
+    jobs = []
+
+    # split and apply orbit per date and IW
+    split_jobs = {}
+    for date, iw, first_burst, last_burst in slc_infos:
+        zip_files = zips.get(date, [])
+        if len(zip_files) == 0:
+            print(f"Cannot find zip file of {date}, skip it.")
+            continue
+        job = split_orbit_job(zip_files, date, iw, first_burst, last_burst,
+                              slc_dir, slc_xml)
+        job.name = 'split ' + job.name
+        split_jobs[(date, iw)] = job
+        jobs.append(job)
+
+    iws = sorted(iw for date, iw in split_jobs if date == master_date)
+    if not iws:
+        sys.exit(f"No slc info of master {master_date}")
+    slaves = sorted(set(date for date, _ in split_jobs if date != master_date))
+
+    # coregistration per slave and IW, (job, product) per slave and IW
+    coreg_jobs = {}
+    for slave_date in slaves:
+        for iw in iws:
+            if (slave_date, iw) not in split_jobs:
+                continue
+            master_job = split_jobs[(master_date, iw)]
+            slave_job = split_jobs[(slave_date, iw)]
+            job = coreg_job(master_job.outputs[0], slave_job.outputs[0],
+                            coreg_dir, coreg_xml)
+            job.name = 'coreg ' + job.name
+            job.deps = [master_job, slave_job]
+            coreg_jobs[(slave_date, iw)] = (job, job.outputs[0])
+            jobs.append(job)
+
+    # merge per pair, then interferogram and export per pair
+    if len(iws) > 1:
+        merge_dir, merge_xml = make_dir(os.path.join(work_dir, 'merge'))
+
+    export_jobs = []
+    for slave_date in slaves:
+        pair = f"{master_date}_{slave_date}"
+        pair_coreg_jobs = [coreg_jobs.get((slave_date, iw)) for iw in iws]
+        if None in pair_coreg_jobs:
+            print(f"Not all of IW{''.join(iws)} for {slave_date}, skip pair {pair}.")
+            continue
+
+        if len(iws) > 1:
+            iw_files = [output for _, output in pair_coreg_jobs]
+            product_job = merge_job(pair, iws, iw_files, merge_dir, merge_xml)
+            product_job.name = 'merge ' + product_job.name
+            product_job.deps = [job for job, _ in pair_coreg_jobs]
+            jobs.append(product_job)
+            product = product_job.outputs[0]
+        else:
+            product_job, product = pair_coreg_jobs[0]
+
+        job = ifg_job(product, ifg_dir, ifg_xml)
+        job.name = 'ifg ' + job.name
+        job.deps = [product_job]
+        jobs.append(job)
+
+        export_job = psi_export_job(product, job.outputs[0], export_dir,
+                                    export_xml, master=not export_jobs)
+        export_job.name = 'export ' + export_job.name
+        export_job.deps = [product_job, job]
+        export_jobs.append(export_job)
+        jobs.append(export_job)
+
+    return jobs
+
+
+if __name__ == "__main__":
+    # get inputs
+    inps = cmdline_parser()
+    zip_dir = os.path.abspath(inps.zip_dir)
+    work_dir = os.path.abspath(inps.work_dir)
+    info_file = os.path.abspath(inps.info_file) if inps.info_file else None
+    master_date = inps.master
+
+    # check inputs
+    if not os.path.isdir(zip_dir):
+        sys.exit(f"Error, {zip_dir} does not exist.")
+
+    if info_file is None and inps.aoi is None:
+        sys.exit('Error, give an info_file or an AOI with --aoi.')
+
+    if info_file and not os.path.isfile(info_file):
+        sys.exit(f'Cannot find file {info_file}.')
+
+    collect = inps.collect or inps.archive is not None or inps.disk_budget is not None
+    if collect and inps.queue:
+        sys.exit('Error, --collect, --archive and --disk-budget need the jobs run here, '
+                 'not with --queue.')
+    if inps.archive:
+        inps.archive = os.path.abspath(inps.archive)
+
+    work_dir, xml_dir = make_dir(work_dir)
+
+    index_path = s1_index.default_index_path(zip_dir, xml_dir)
+    index = s1_index.update_index(zip_dir, index_path)
+
+    if inps.aoi:
+        try:
+            slc_infos = aoi_slc_infos(index, inps.aoi, info_file, xml_dir)
+        except ValueError as e:
+            sys.exit(f"Error, {e}")
+        if len(slc_infos) == 0:
+            sys.exit(f"No burst covers AOI {' '.join(inps.aoi)}")
+    else:
+        slc_infos = read_slc_infos(info_file)
+        if len(slc_infos) == 0:
+            sys.exit(f"No slc infos in {info_file}")
+
+    jobs = pipeline_jobs(slc_infos, s1_index.zips_by_date(index), work_dir,
+                         master_date)
+
+    if inps.dem_tiles:
+        dem_file = prepare_dem.prepare_dem(index, os.path.abspath(inps.dem_tiles),
+                                           os.path.join(work_dir, 'dem', 'dem.tif'),
+                                           slc_infos)
+        for job in jobs:
+            prepare_dem.use_external_dem(job, dem_file)
+    if inps.orbit_dir:
+        orbits = orbit_index.OrbitIndex(os.path.abspath(inps.orbit_dir))
+        for job in jobs:
+            orbit_index.use_local_orbit(job, orbits)
+
+    product_format.use_format(jobs, inps.format)
+    gpt_runner.run_stage(jobs, inps, xml_dir, collect=collect)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import argparse
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import sys
+import zipfile
+
+import s1_index
+from job_manifest import path_signature
+from split_orbit import read_slc_infos
+
+# SRTM N40E100.hgt(.zip), Copernicus ..._N40_00_E100_00_DEM.tif
+TILE_PATTERN = re.compile(r'([NS])(\d{2})(?:_00)?_?([EW])(\d{3})')
+TILE_EXTENSIONS = ('.hgt', '.tif', '.tiff', '.zip')
+
+# operator nodes of a graph, not their applicationData entries
+GRAPH_NODE = re.compile(r'<node id="[^"]*">\s*<operator>.*?</node>', re.DOTALL)
+EXTERNAL_DEM_FILE = re.compile(r'^([ \t]*)(<externalDEMFile>.*?</externalDEMFile>)',
+                               re.MULTILINE)
+
+EXAMPLE = """Example:
+  python3 prepare_dem.py /ly/zips /ly/srtm_tiles /ly/dem/dem.tif date.info
+  python3 coreg.py /ly/slc /ly/coreg 20200118 --dem /ly/dem/dem.tif
+  python3 ifg.py /ly/coreg /ly/ifg --dem /ly/dem/dem.tif
+"""
+
+
+def cmdline_parser():
+    parser = argparse.ArgumentParser(
+        description='Mosaic and crop local SRTM or Copernicus DEM tiles to the ' +
+        'stack footprint,\nfor the --dem option of the coregistration and ' +
+        'interferogram steps.',
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=EXAMPLE)
+
+    parser.add_argument('zip_dir', help='Sentinel-1 TOPS zips directory')
+    parser.add_argument('tile_dir', help='directory of 1 degree DEM tiles')
+    parser.add_argument('output_file', help='output DEM GeoTIFF')
+    parser.add_argument('info_file',
+                        nargs='?',
+                        help='file including date IW first_burst last_burst\n' +
+                        '(default: all bursts of all zips)')
+    parser.add_argument('--margin',
+                        type=float,
+                        default=0.05,
+                        help='degrees added around the footprint (default: 0.05)')
+    inps = parser.parse_args()
+
+    return inps
+
+
+def stack_bbox(index, slc_infos=None, margin=0.05):
+    """Return [lon_min, lon_max, lat_min, lat_max] around the bursts used.
+
+    slc_infos are [date, iw, first_burst, last_burst] lines; without them
+    all bursts of the index are used.
+    """
+    footprints = []
+    for date, iws in s1_index.date_bursts(index).items():
+        for iw, bursts in iws.items():
+            if slc_infos is None:
+                footprints.extend(bursts)
+                continue
+            for info_date, info_iw, first_burst, last_burst in slc_infos:
+                if info_date == date and f"IW{info_iw}" == iw:
+                    footprints.extend(bursts[int(first_burst) - 1:int(last_burst)])
+    if not footprints:
+        return None
+
+    return [
+        min(f[0] for f in footprints) - margin,
+        max(f[1] for f in footprints) + margin,
+        min(f[2] for f in footprints) - margin,
+        max(f[3] for f in footprints) + margin,
+    ]
+
+
+def tile_bounds(name):
+    """Return [lon_min, lon_max, lat_min, lat_max] of a 1 degree tile name."""
+    match = TILE_PATTERN.search(name)
+    if not match:
+        return None
+    lat = int(match.group(2)) * (1 if match.group(1) == 'N' else -1)
+    lon = int(match.group(4)) * (1 if match.group(3) == 'E' else -1)
+
+    return [lon, lon + 1, lat, lat + 1]
+
+
+def gdal_path(path):
+    """Return the path GDAL reads a tile from, looking into zipped tiles."""
+    if not path.endswith('.zip'):
+        return path
+    with zipfile.ZipFile(path) as z:
+        names = [n for n in z.namelist() if n.endswith(TILE_EXTENSIONS[:3])]
+    if not names:
+        return None
+
+    return f"/vsizip/{path}/{names[0]}"
+
+
+def find_tiles(tile_dir, bbox):
+    """Return the tiles of tile_dir overlapping bbox and the missing tile names."""
+    tiles = []
+    found = set()
+    for name in sorted(os.listdir(tile_dir)):
+        bounds = tile_bounds(name)
+        if not name.lower().endswith(TILE_EXTENSIONS) or bounds is None:
+            continue
+        # tiles only touching bbox are not needed
+        if (bounds[0] < bbox[1] and bbox[0] < bounds[1] and
+                bounds[2] < bbox[3] and bbox[2] < bounds[3]):
+            tiles.append(os.path.join(tile_dir, name))
+            found.add((bounds[0], bounds[2]))
+
+    missing = []
+    for lat in range(math.floor(bbox[2]), math.ceil(bbox[3])):
+        for lon in range(math.floor(bbox[0]), math.ceil(bbox[1])):
+            if (lon, lat) not in found:
+                missing.append(f"{'N' if lat >= 0 else 'S'}{abs(lat):02d}"
+                               f"{'E' if lon >= 0 else 'W'}{abs(lon):03d}")
+
+    return tiles, missing
+
+
+def build_dem(tiles, bbox, output_file):
+    """Mosaic tiles and crop them to bbox at their own resolution.
+
+    Heights stay relative to the geoid of the tiles, EGM96 for SRTM and
+    EGM2008 for Copernicus, and use_external_dem has SNAP apply EGM96 in
+    every node reading the DEM. For Copernicus tiles the heights are then
+    off by the difference of the two geoids, mostly below 1 m.
+    Voids become 0, the no-data value the graphs give SNAP.
+    """
+    sources = [gdal_path(t) for t in tiles]
+    vrt_file = output_file + '.vrt'
+    tmp_file = output_file + '.tmp.tif'
+    subprocess.run(['gdalbuildvrt', '-q', '-overwrite', '-resolution', 'highest',
+                    '-srcnodata', '-32768', '-vrtnodata', '0', vrt_file] +
+                   [s for s in sources if s],
+                   check=True)
+    subprocess.run(['gdal_translate', '-q', '-of', 'GTiff', '-projwin',
+                    str(bbox[0]), str(bbox[3]), str(bbox[1]), str(bbox[2]),
+                    '-a_nodata', '0', '-co', 'TILED=YES', '-co', 'COMPRESS=DEFLATE',
+                    '-co', 'BIGTIFF=IF_SAFER', vrt_file, tmp_file],
+                   check=True)
+    os.replace(tmp_file, output_file)
+    os.remove(vrt_file)
+
+
+def prepare_dem(index, tile_dir, output_file, slc_infos=None, margin=0.05):
+    """Build the DEM of a stack unless output_file already covers it.
+
+    The footprint and tiles of the last build are kept in output_file.json.
+    Return output_file.
+    """
+    if shutil.which('gdalbuildvrt') is None or shutil.which('gdal_translate') is None:
+        sys.exit('Error, prepare_dem.py needs gdalbuildvrt and gdal_translate (GDAL).')
+
+    bbox = stack_bbox(index, slc_infos, margin)
+    if bbox is None:
+        sys.exit('Error, no burst footprints in the index to build a DEM for.')
+    tiles, missing = find_tiles(tile_dir, bbox)
+    if not tiles:
+        sys.exit(f"Error, no DEM tile in {tile_dir} covers {bbox}")
+    if missing:
+        print(f"No tile of {', '.join(missing)} in {tile_dir}, left as no-data "
+              "(fine over sea).")
+
+    record = {
+        'bbox': [round(v, 6) for v in bbox],
+        'tiles': {t: path_signature(t) for t in tiles},
+    }
+    record_file = output_file + '.json'
+    if os.path.isfile(output_file) and os.path.isfile(record_file):
+        with open(record_file, 'r') as f:
+            if json.load(f) == record:
+                print(f"DEM {output_file} is up to date.")
+                return output_file
+
+    print(f"Build DEM {output_file} from {len(tiles)} tiles, lon {bbox[0]:.3f} "
+          f"to {bbox[1]:.3f}, lat {bbox[2]:.3f} to {bbox[3]:.3f}")
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    build_dem(tiles, bbox, output_file)
+    with open(record_file, 'w') as f:
+        json.dump(record, f, indent=2)
+
+    return output_file
+
+
+def apply_egm(node):
+    """Return node with externalDEMApplyEGM set to true, adding it if missing.
+
+    Back-Geocoding has no externalDEMApplyEGM in the graphs and defaults to
+    false, which would take the geoid heights of the DEM as ellipsoid heights.
+    """
+    if '<externalDEMApplyEGM>' in node:
+        return re.sub(r'<externalDEMApplyEGM>\w*</externalDEMApplyEGM>',
+                      '<externalDEMApplyEGM>true</externalDEMApplyEGM>', node)
+
+    return EXTERNAL_DEM_FILE.sub(
+        r'\1\2\n\1<externalDEMApplyEGM>true</externalDEMApplyEGM>', node, count=1)
+
+
+def use_external_dem(job, dem_file):
+    """Point the DEM of the graph of job to dem_file instead of auto-downloaded SRTM."""
+    xml_data = job.xml_data.replace('<demName>SRTM 3Sec</demName>',
+                                    '<demName>External DEM</demName>')
+    xml_data = xml_data.replace('<externalDEMFile/>',
+                                f"<externalDEMFile>{dem_file}</externalDEMFile>")
+    xml_data = GRAPH_NODE.sub(
+        lambda m: apply_egm(m.group(0)) if '<demName>External DEM</demName>' in m.group(0)
+        else m.group(0), xml_data)
+    if xml_data != job.xml_data:
+        job.xml_data = xml_data
+        job.inputs.append(dem_file)
+
+
+if __name__ == "__main__":
+    # get inputs
+    inps = cmdline_parser()
+    zip_dir = os.path.abspath(inps.zip_dir)
+    tile_dir = os.path.abspath(inps.tile_dir)
+    output_file = os.path.abspath(inps.output_file)
+    info_file = os.path.abspath(inps.info_file) if inps.info_file else None
+
+    # check inputs
+    if not os.path.isdir(zip_dir):
+        sys.exit(f"Error, {zip_dir} does not exist.")
+
+    if not os.path.isdir(tile_dir):
+        sys.exit(f"Error, {tile_dir} does not exist.")
+
+    if info_file and not os.path.isfile(info_file):
+        sys.exit(f'Cannot find file {info_file}.')
+
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    index_path = s1_index.default_index_path(zip_dir, os.path.dirname(output_file))
+    index = s1_index.update_index(zip_dir, index_path)
+    slc_infos = read_slc_infos(info_file) if info_file else None
+
+    prepare_dem(index, tile_dir, output_file, slc_infos, inps.margin)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import glob
+import os
+
+# SNAP writer formats of the intermediate products and their extensions
+FORMATS = {
+    'BEAM-DIMAP': '.dim',
+    'GeoTIFF-BigTIFF': '.tif',
+}
+# SNAP system properties of the writers, given to gpt as -D options
+FORMAT_PROPERTIES = {
+    'GeoTIFF-BigTIFF': {
+        'snap.dataio.bigtiff.compression.type': 'LZW',
+        'snap.dataio.bigtiff.tiling.width': '512',
+        'snap.dataio.bigtiff.tiling.height': '512',
+        'snap.dataio.bigtiff.force.bigtiff': 'true',
+    },
+}
+DEFAULT_FORMAT = 'BEAM-DIMAP'
+
+
+def add_format_argument(parser):
+    """Add the --format option of the intermediate products to parser."""
+    parser.add_argument('--format',
+                        choices=list(FORMATS),
+                        default=DEFAULT_FORMAT,
+                        help='format of the products written (default: %(default)s),\n' +
+                        'GeoTIFF-BigTIFF is LZW compressed and tiled; inputs are\n' +
+                        'read in any of them')
+
+
+def product_stem(path):
+    """Return the file name of a product without its format extension."""
+    name = os.path.basename(path)
+    for extension in FORMATS.values():
+        if name.endswith(extension):
+            return name[0:-len(extension)]
+
+    return name
+
+
+def product_path(path, fmt):
+    """Return path of a product with the extension of fmt."""
+    return os.path.join(os.path.dirname(path), product_stem(path) + FORMATS[fmt])
+
+
+def find_products(directory):
+    """Return the sorted products of directory in any of FORMATS.
+
+    If a product exists in several formats, e.g. after a rerun with
+    another --format, the newest one is used.
+    """
+    products = {}
+    for extension in FORMATS.values():
+        for path in glob.glob(os.path.join(directory, '*' + extension)):
+            stem = product_stem(path)
+            if stem not in products or \
+                    os.path.getmtime(path) > os.path.getmtime(products[stem]):
+                products[stem] = path
+
+    return sorted(products.values())
+
+
+def use_format(jobs, fmt):
+    """Make the Write nodes of jobs write fmt instead of BEAM-DIMAP.
+
+    The outputs of the jobs get the extension of fmt, also where later
+    jobs of the same run read them.
+    """
+    if fmt == DEFAULT_FORMAT:
+        return
+
+    renamed = {}
+    for job in jobs:
+        for path in job.outputs:
+            if path.endswith(FORMATS[DEFAULT_FORMAT]):
+                renamed[path] = product_path(path, fmt)
+
+    for job in jobs:
+        job.xml_data = job.xml_data.replace(
+            f"<formatName>{DEFAULT_FORMAT}</formatName>", f"<formatName>{fmt}</formatName>")
+        for old, new in renamed.items():
+            job.xml_data = job.xml_data.replace(old, new)
+        job.inputs = [renamed.get(p, p) for p in job.inputs]
+        job.outputs = [renamed.get(p, p) for p in job.outputs]
+
+
+def graph_formats(xml_data):
+    """Return the formats a graph writes."""
+    return [fmt for fmt in FORMATS if f"<formatName>{fmt}</formatName>" in xml_data]
+
+
+def gpt_options(xml_data):
+    """Return the gpt -D options of the writers of a graph."""
+    options = []
+    for fmt in graph_formats(xml_data):
+        options.extend(f"-D{key}={value}"
+                       for key, value in FORMAT_PROPERTIES.get(fmt, {}).items())
+
+    return options
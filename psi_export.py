@@ -6,11 +6,12 @@
 ##################################
 
 import argparse
-import glob
 import os
-import subprocess
+import shutil
 import sys
-import time
+
+import gpt_runner
+import product_format
 
 PSI_EXPORT_XML = """<graph id="Graph">
   <version>1.0</version>
@@ -57,6 +58,7 @@ PSI_EXPORT_XML = """<graph id="Graph">
 
 EXAMPLE = """Example:
   python3 psi_export.py /ly/coreg /ly/ifg ly/InSAR_20221229
+  python3 psi_export.py /ly/coreg /ly/ifg ly/InSAR_20221229 --jobs 4
 """
 
 
@@ -69,11 +71,70 @@ def cmdline_parser():
     parser.add_argument('coreg_dir', help='input coreg directory')
     parser.add_argument('ifg_dir', help='input ifg directory')
     parser.add_argument('output_dir', help='output directory')
+    gpt_runner.add_runner_arguments(parser)
     inps = parser.parse_args()
 
     return inps
 
 
+def pair_files(coreg_file):
+    """Return the files StampsExport writes for the pair of coreg_file, relative to its folder."""
+    dim_name = os.path.basename(coreg_file)
+    master_date, slave_date = dim_name[0:8], dim_name[9:17]
+    pair = f"{master_date}_{slave_date}"
+
+    return [
+        os.path.join('rslc', f"{slave_date}.rslc"),
+        os.path.join('rslc', f"{slave_date}.rslc.par"),
+        os.path.join('diff0', f"{pair}.diff"),
+        os.path.join('diff0', f"{pair}.base"),
+        os.path.join('geo', f"{pair}.lat"),
+        os.path.join('geo', f"{pair}.lon"),
+        os.path.join('dem', f"{pair}_dem.rdc"),
+    ]
+
+
+def move_pair_files(export_dir, output_dir, names, written):
+    """Move the pair files names from export_dir into output_dir and remove export_dir."""
+    for name in names:
+        target = os.path.join(output_dir, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(os.path.join(export_dir, name), target)
+    shutil.rmtree(export_dir)
+
+
+def psi_export_job(coreg_file, ifg_file, output_dir, xml_dir, master=False):
+    """Return the job exporting one coreg/ifg pair into the StaMPS output_dir.
+
+    Every StampsExport also writes the master rslc and rslc.par. Only the
+    master job exports straight into output_dir and has them as outputs;
+    the others export into a folder of their own in xml_dir, from which a
+    post step moves the pair files, so that pairs can run in parallel.
+    """
+    dim_name = os.path.basename(coreg_file)
+    stem = product_format.product_stem(coreg_file)
+    names = pair_files(coreg_file)
+    export_dir = output_dir if master else os.path.join(xml_dir, stem + '_export')
+
+    xml_data = PSI_EXPORT_XML
+    xml_data = xml_data.replace('COREG_FILE', coreg_file)
+    xml_data = xml_data.replace('IFG_FILE', ifg_file)
+    xml_data = xml_data.replace('OUTPUTFOLDER', export_dir)
+
+    outputs = [os.path.join(output_dir, name) for name in names]
+    if master:
+        rslc = os.path.join(output_dir, 'rslc', f"{dim_name[0:8]}.rslc")
+        outputs.extend([rslc, rslc + '.par'])
+
+    xml_name = stem + '_psi_export.xml'
+    xml_path = os.path.join(xml_dir, xml_name)
+    job = gpt_runner.GptJob(dim_name, xml_path, xml_data,
+                            [coreg_file, ifg_file], outputs)
+    if not master:
+        job.post_steps = [(move_pair_files, [export_dir, output_dir, names])]
+    return job
+
+
 if __name__ == "__main__":
     # get inputs
     inps = cmdline_parser()
@@ -95,39 +156,15 @@ if __name__ == "__main__":
     if not os.path.isdir(xml_dir):
       os.mkdir(xml_dir)
 
-    coreg_files = glob.glob(os.path.join(coreg_dir, "*.dim"))
+    coreg_files = product_format.find_products(coreg_dir)
+    ifg_files = {product_format.product_stem(i): i
+                 for i in product_format.find_products(ifg_dir)}
 
+    jobs = []
     for coreg_file in coreg_files:
-        index = coreg_files.index(coreg_file) + 1
-        dim_name = os.path.basename(coreg_file)
-        print(f"\n[{index}/{len(coreg_files)}] Processing file: {dim_name}\n")
-
-        xml_data = PSI_EXPORT_XML
-        xml_data = xml_data.replace('COREG_FILE', coreg_file)
-
-        ifg_file = os.path.join(ifg_dir, dim_name)
-        xml_data = xml_data.replace('IFG_FILE', ifg_file)
-
-        xml_data = xml_data.replace('OUTPUTFOLDER', output_dir)
-
-        xml_name = dim_name[0:-4] + '_psi_export.xml'
-        xml_path = os.path.join(xml_dir, xml_name)
-        with open(xml_path, 'w+') as f:
-            f.write(xml_data)
-
-        args = ['gpt', xml_path]
-        process = subprocess.Popen(args,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-        time_start = time.time()
-
-        stdout = process.communicate()[0]
-        print(str(stdout, encoding='utf-8'))
-
-        time_delta = time.time() - time_start
-        print('Finished in {} seconds.'.format(time_delta))
+        stem = product_format.product_stem(coreg_file)
+        ifg_file = ifg_files.get(stem, os.path.join(ifg_dir, stem + '.dim'))
+        jobs.append(psi_export_job(coreg_file, ifg_file, output_dir, xml_dir,
+                                   master=not jobs))
 
-        if process.returncode != 0:
-            print('Error exporting {}\n'.format(dim_name))
-        else:
-            print('Complete PSI export of {}\n'.format(dim_name))
+    gpt_runner.run_stage(jobs, inps, xml_dir)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import gpt_resources
+import gpt_runner
+import job_stats
+import scratch
+import work_queue
+
+EXAMPLE = """Example:
+  python3 coreg.py /ly/slc /ly/coreg 20201229 --queue
+  python3 queue_worker.py /ly/coreg/xml/queue --jobs 4    (on every node)
+"""
+
+
+def cmdline_parser():
+    parser = argparse.ArgumentParser(
+        description='Run gpt jobs from a queue shared by several nodes.',
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=EXAMPLE)
+
+    parser.add_argument('queue_dir', help='queue directory written by --queue')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=1,
+                        help='number of gpt jobs to run in parallel (default: 1)')
+    parser.add_argument('--wait',
+                        action='store_true',
+                        help='keep polling for new jobs when the queue is empty')
+    parser.add_argument('--poll',
+                        type=float,
+                        default=5,
+                        help='seconds between polls of the queue (default: 5)')
+    parser.add_argument('--heartbeat',
+                        type=float,
+                        default=work_queue.HEARTBEAT_INTERVAL,
+                        help='seconds between lease renewals (default: %(default)s)')
+    parser.add_argument('--lease-timeout',
+                        type=float,
+                        default=work_queue.LEASE_TIMEOUT,
+                        help='seconds without heartbeat after which a job of a\n' +
+                        'dead worker is requeued (default: %(default)s)')
+    parser.add_argument('--requeue-failed',
+                        action='store_true',
+                        help='move failed jobs back to pending before starting')
+    parser.add_argument('--compress-logs',
+                        action='store_true',
+                        help='gzip the gpt log of each job after it succeeded')
+    parser.add_argument('--snap-server',
+                        metavar='SOCKET',
+                        help='run the graphs on a snap_server.py of this node, gpt is\n' +
+                        'used if it is not reachable')
+    gpt_resources.add_resource_arguments(parser)
+    scratch.add_scratch_arguments(parser)
+    inps = parser.parse_args()
+
+    return inps
+
+
+def queue_job(entry):
+    """Return the GptJob of a queue entry."""
+    with open(entry['xml_path'], 'r') as f:
+        xml_data = f.read()
+
+    job = gpt_runner.GptJob(entry['name'], entry['xml_path'], xml_data,
+                            entry['inputs'], entry['outputs'])
+    job.pre_steps = [(work_queue.import_function(name), args)
+                     for name, args in entry.get('pre_steps', [])]
+    job.post_steps = [(work_queue.import_function(name), args)
+                      for name, args in entry.get('post_steps', [])]
+    return job
+
+
+if __name__ == "__main__":
+    inps = cmdline_parser()
+    queue_dir = os.path.abspath(inps.queue_dir)
+    if not os.path.isdir(queue_dir):
+        sys.exit(f"Error, {queue_dir} does not exist.")
+
+    queue = work_queue.WorkQueue(queue_dir, inps.lease_timeout)
+    worker = work_queue.worker_name()
+    if inps.requeue_failed:
+        queue.requeue_failed()
+
+    lock = threading.Lock()
+    num_jobs = max(1, inps.jobs)
+    sizing = gpt_resources.GptSizing(num_jobs, inps.heap, inps.tile_cache,
+                                     inps.gpt_threads)
+    staging = scratch.Scratch(inps.scratch, inps.scratch_size) if inps.scratch else None
+    running = {}
+    copying = {}
+    jobs = []
+    with ThreadPoolExecutor(max_workers=num_jobs) as executor:
+        while True:
+            for job_id in queue.requeue_expired():
+                print(f"Requeue {job_id}, its worker stopped sending heartbeats.")
+
+            while len(running) < num_jobs:
+                claimed = queue.claim(worker)
+                if claimed is None:
+                    break
+                job_id, entry = claimed
+                job = queue_job(entry)
+                job.gpt_options = sizing.gpt_options(job.xml_data)
+                jobs.append(job)
+                heartbeat = work_queue.Heartbeat(queue, job_id, entry['lease'],
+                                                 inps.heartbeat)
+                heartbeat.start()
+                total = sum(queue.counts().values())
+                future = executor.submit(gpt_runner.run_gpt, job, lock, len(jobs),
+                                         total, inps.compress_logs,
+                                         inps.snap_server, staging)
+                running[future] = (job_id, entry, job, heartbeat)
+
+            if not running and not copying:
+                counts = queue.counts()
+                if counts['pending'] == 0 and counts['running'] == 0 and not inps.wait:
+                    break
+                # waiting for jobs of other workers or for new jobs
+                time.sleep(inps.poll)
+                continue
+
+            finished, _ = wait(list(running) + list(copying), timeout=inps.poll,
+                               return_when=FIRST_COMPLETED)
+            for future in finished:
+                if future in copying:
+                    job_id, entry, job, heartbeat = copying.pop(future)
+                    try:
+                        future.result()
+                    except OSError as e:
+                        job.returncode = 1
+                        print(f"Error copying the outputs of {job.name} back "
+                              f"from scratch: {e}")
+                    job.stats['output_size'] = job_stats.output_size(job)
+                else:
+                    job_id, entry, job, heartbeat = running.pop(future)
+                    future.result()
+                    if staging and job.returncode == 0:
+                        # the lease is kept until the outputs are back
+                        copying[staging.copy_back(job)] = (job_id, entry, job,
+                                                           heartbeat)
+                        continue
+                heartbeat.stop()
+                entry['returncode'] = job.returncode
+                entry['time'] = job.time
+                entry['stats'] = job.stats
+                if not queue.finish(job_id, entry):
+                    print(f"Warning: {job_id} was requeued while running here.")
+
+    if staging:
+        staging.close()
+
+    counts = queue.counts()
+    print(f"\nWorker {worker} ran {len(jobs)} jobs. Queue: " +
+          ', '.join(f"{counts[s]} {s}" for s in work_queue.QUEUE_STATES))
+    gpt_runner.print_summary(jobs)
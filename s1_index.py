@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import argparse
+import json
+import os
+import re
+import sys
+import xml.etree.ElementTree as ET
+import zipfile
+
+INDEX_VERSION = 1
+ZIP_PATTERN = re.compile(r'^S1[ABCD]_.*_(\d{8})T(\d{6})_(\d{8})T(\d{6})_.*\.zip$')
+ANNOTATION_PATTERN = re.compile(
+    r'\.SAFE/annotation/s1[abcd]-iw(\d)-slc-(\w\w)-[^/]*\.xml$')
+
+# outer ring of a WKT polygon, holes are not needed for its bounding box
+WKT_POLYGON = re.compile(r'POLYGON\s*\(\s*\(([^()]*)\)(?:\s*,\s*\([^()]*\))*\s*\)',
+                         re.IGNORECASE)
+
+EXAMPLE = """Example:
+  python3 s1_index.py /ly/zips
+  python3 s1_index.py /ly/zips --index /ly/slc/xml/s1_index.json
+"""
+
+
+def cmdline_parser():
+    parser = argparse.ArgumentParser(
+        description='Index the Sentinel-1 TOPS zips of a directory by date, ' +
+        'slice and burst.',
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=EXAMPLE)
+
+    parser.add_argument('zip_dir', help='Sentinel-1 TOPS zips directory')
+    parser.add_argument('--index',
+                        help='index file (default: s1_index.json in zip_dir)')
+    inps = parser.parse_args()
+
+    return inps
+
+
+def local_name(tag):
+    """Return the tag of an element without its namespace."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def find_local(element, name):
+    """Return the first descendant of element named name in any namespace."""
+    for e in element.iter():
+        if local_name(e.tag) == name:
+            return e
+
+    return None
+
+
+def parse_manifest(data):
+    """Return acquisition times, slice and orbit of a manifest.safe."""
+    root = ET.fromstring(data)
+    info = {}
+    for name, key in [('startTime', 'start_time'), ('stopTime', 'stop_time'),
+                      ('sliceNumber', 'slice'), ('totalSlices', 'total_slices'),
+                      ('relativeOrbitNumber', 'relative_orbit'),
+                      ('pass', 'pass')]:
+        element = find_local(root, name)
+        if element is not None and element.text:
+            info[key] = element.text.strip()
+
+    for key in ['slice', 'total_slices', 'relative_orbit']:
+        if key in info:
+            info[key] = int(info[key])
+
+    return info
+
+
+def burst_footprints(root, lines_per_burst, num_bursts):
+    """Return [lon_min, lon_max, lat_min, lat_max] of every burst.
+
+    A burst spans the geolocation grid rows closest to its first and last
+    line.
+    """
+    rows = {}
+    for point in root.iter('geolocationGridPoint'):
+        line = int(point.findtext('line'))
+        rows.setdefault(line, []).append(
+            (float(point.findtext('longitude')), float(point.findtext('latitude'))))
+    grid_lines = sorted(rows)
+    if not grid_lines:
+        return []
+
+    footprints = []
+    for i in range(num_bursts):
+        first = min(grid_lines, key=lambda l: abs(l - i * lines_per_burst))
+        last = min(grid_lines, key=lambda l: abs(l - (i + 1) * lines_per_burst))
+        points = rows[first] + rows[last]
+        lons = [p[0] for p in points]
+        lats = [p[1] for p in points]
+        footprints.append([min(lons), max(lons), min(lats), max(lats)])
+
+    return footprints
+
+
+def parse_annotation(data):
+    """Return burst count, burst times and footprints of an annotation xml."""
+    root = ET.fromstring(data)
+    lines_per_burst = int(root.findtext('swathTiming/linesPerBurst'))
+    bursts = root.findall('swathTiming/burstList/burst')
+
+    return {
+        'bursts': len(bursts),
+        'burst_times': [b.findtext('azimuthTime') for b in bursts],
+        'footprints': burst_footprints(root, lines_per_burst, len(bursts)),
+    }
+
+
+def scan_zip(zip_path):
+    """Read the metadata of a Sentinel-1 zip without extracting the imagery."""
+    match = ZIP_PATTERN.match(os.path.basename(zip_path))
+    date, start_time = match.group(1), match.group(2)
+    entry = {'date': date, 'start': f"{date}T{start_time}", 'iws': {}}
+
+    try:
+        with zipfile.ZipFile(zip_path) as z:
+            for name in z.namelist():
+                if name.endswith('.SAFE/manifest.safe'):
+                    entry.update(parse_manifest(z.read(name)))
+                match = ANNOTATION_PATTERN.search(name)
+                # bursts are the same for every polarisation
+                if match and f"IW{match.group(1)}" not in entry['iws']:
+                    entry['iws'][f"IW{match.group(1)}"] = parse_annotation(
+                        z.read(name))
+    except (zipfile.BadZipFile, ET.ParseError, ValueError, TypeError) as e:
+        entry['error'] = str(e)
+
+    return entry
+
+
+def default_index_path(zip_dir, fallback_dir):
+    """Return s1_index.json in zip_dir, or in fallback_dir if zip_dir is read-only."""
+    if os.access(zip_dir, os.W_OK):
+        return os.path.join(zip_dir, 's1_index.json')
+
+    return os.path.join(fallback_dir, 's1_index.json')
+
+
+def update_index(zip_dir, index_path=None):
+    """Scan zip_dir once and return its index, rescanning only changed zips.
+
+    The index is saved to index_path, by default s1_index.json in zip_dir.
+    """
+    if index_path is None:
+        index_path = os.path.join(zip_dir, 's1_index.json')
+
+    index = {'version': INDEX_VERSION, 'zips': {}}
+    if os.path.isfile(index_path):
+        with open(index_path, 'r') as f:
+            old_index = json.load(f)
+        if old_index.get('version') == INDEX_VERSION:
+            index = old_index
+
+    zips = {}
+    changed = False
+    with os.scandir(zip_dir) as entries:
+        for e in entries:
+            if not ZIP_PATTERN.match(e.name):
+                continue
+            stat = e.stat()
+            entry = index['zips'].get(e.name)
+            if (entry is None or entry['size'] != stat.st_size or
+                    entry['mtime'] != stat.st_mtime):
+                entry = scan_zip(e.path)
+                entry['size'] = stat.st_size
+                entry['mtime'] = stat.st_mtime
+                changed = True
+            zips[e.name] = entry
+
+    if changed or len(zips) != len(index['zips']):
+        index['zips'] = zips
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, index_path)
+
+    index['zip_dir'] = zip_dir
+    return index
+
+
+def zips_by_date(index):
+    """Return {date: [zip paths ordered by start time]} of an index."""
+    dates = {}
+    for name, entry in sorted(index['zips'].items(), key=lambda i: i[1]['start']):
+        dates.setdefault(entry['date'], []).append(
+            os.path.join(index['zip_dir'], name))
+
+    return dates
+
+
+def parse_aoi(values):
+    """Return [lon_min, lon_max, lat_min, lat_max] of a bbox or WKT polygon.
+
+    values are either four numbers or the words of a WKT POLYGON, of which
+    the bounding box of the outer ring is used.
+    """
+    text = ' '.join(values).strip()
+    match = WKT_POLYGON.fullmatch(text)
+    if match is None:
+        try:
+            bbox = [float(v) for v in text.split()]
+        except ValueError:
+            bbox = []
+        if len(bbox) != 4 or bbox[0] > bbox[1] or bbox[2] > bbox[3]:
+            raise ValueError(f"Cannot read AOI {text}, give lon_min lon_max lat_min "
+                             "lat_max or a WKT POLYGON")
+        return bbox
+
+    points = []
+    for point in match.group(1).split(','):
+        try:
+            coordinates = [float(v) for v in point.split()]
+        except ValueError:
+            coordinates = []
+        if len(coordinates) != 2:
+            raise ValueError(f"Cannot read point '{point.strip()}' of AOI {text}")
+        points.append(coordinates)
+    if len(points) < 4 or points[0] != points[-1]:
+        raise ValueError(f"AOI {text} is not a closed ring of at least 4 points")
+    lons, lats = [p[0] for p in points], [p[1] for p in points]
+
+    return [min(lons), max(lons), min(lats), max(lats)]
+
+
+def intersects(footprint, aoi):
+    """Check whether two [lon_min, lon_max, lat_min, lat_max] boxes overlap."""
+    return (footprint[0] <= aoi[1] and aoi[0] <= footprint[1] and
+            footprint[2] <= aoi[3] and aoi[2] <= footprint[3])
+
+
+def date_bursts(index, dates=None):
+    """Return {date: {iw: [burst footprints]}} of an index.
+
+    Bursts are numbered over the slices of a date in acquisition order, as
+    after SliceAssembly.
+    """
+    bursts = {}
+    for date, zip_paths in zips_by_date(index).items():
+        if dates is not None and date not in dates:
+            continue
+        for zip_path in zip_paths:
+            entry = index['zips'][os.path.basename(zip_path)]
+            if 'error' in entry:
+                print(f"Cannot read bursts of {os.path.basename(zip_path)}: "
+                      f"{entry['error']}")
+            for iw, info in entry['iws'].items():
+                bursts.setdefault(date, {}).setdefault(iw, []).extend(
+                    info['footprints'])
+
+    return bursts
+
+
+def select_bursts(index, aoi, dates=None):
+    """Return [date, iw, first_burst, last_burst] lines covering aoi.
+
+    Every date gets the subswaths that any date needs, so that all dates
+    can be coregistered and merged alike.
+    """
+    bursts = date_bursts(index, dates)
+    hits = {}
+    for date, iws in bursts.items():
+        for iw, footprints in iws.items():
+            numbers = [i + 1 for i, f in enumerate(footprints) if intersects(f, aoi)]
+            if numbers:
+                hits[(date, iw)] = numbers
+
+    slc_infos = []
+    needed_iws = sorted(set(iw for _, iw in hits))
+    for date in sorted(bursts):
+        for iw in needed_iws:
+            if (date, iw) not in hits:
+                print(f"No burst of {iw} of {date} covers the AOI, skip it.")
+                continue
+            numbers = hits[(date, iw)]
+            slc_infos.append([date, iw[2:], str(min(numbers)), str(max(numbers))])
+
+    return slc_infos
+
+
+if __name__ == "__main__":
+    inps = cmdline_parser()
+    zip_dir = os.path.abspath(inps.zip_dir)
+    if not os.path.isdir(zip_dir):
+        sys.exit(f"Error, {zip_dir} does not exist.")
+
+    index = update_index(zip_dir, inps.index)
+    by_date = zips_by_date(index)
+    print(f"{len(index['zips'])} zips of {len(by_date)} dates in {zip_dir}\n")
+    for date, zip_paths in by_date.items():
+        for zip_path in zip_paths:
+            entry = index['zips'][os.path.basename(zip_path)]
+            bursts = ' '.join(f"{iw}:{info['bursts']}"
+                              for iw, info in sorted(entry['iws'].items()))
+            note = f" ({entry['error']})" if 'error' in entry else ''
+            print(f"{date}  slice {entry.get('slice', '?')}  {bursts}{note}")
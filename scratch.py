@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import product_format
+from gpt_resources import graph_profile, parse_size
+from job_manifest import path_signature
+
+# share of the free space of the scratch directory used by default
+FREE_FRACTION = 0.9
+
+
+def add_scratch_arguments(parser):
+    """Add the options of local scratch staging to parser."""
+    parser.add_argument('--scratch',
+                        metavar='DIR',
+                        help='run gpt on local copies of the inputs in DIR, e.g. a\n' +
+                        'node local SSD, and copy the outputs back in the background')
+    parser.add_argument('--scratch-size',
+                        type=parse_size,
+                        help='space used in --scratch, e.g. 500G (default: 90%% of its\n' +
+                        'free space)')
+
+
+def data_dir(path):
+    """Return the .data directory of a BEAM-DIMAP .dim, or None."""
+    return path[0:-4] + '.data' if path.endswith('.dim') else None
+
+
+def remove_product(path):
+    """Remove a product, the .dim first so that no header without data is left."""
+    if os.path.isfile(path):
+        os.remove(path)
+    if data_dir(path) and os.path.isdir(data_dir(path)):
+        shutil.rmtree(data_dir(path))
+
+
+def copy_product(src, dst):
+    """Copy a product file, or a .dim with its .data directory.
+
+    The .data directory is copied to a temporary name and renamed, and
+    the .dim is written last, so dst is either complete or has no .dim.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.isfile(dst):
+        os.remove(dst)
+
+    if data_dir(src) and os.path.isdir(data_dir(src)):
+        tmp_dir = data_dir(dst) + '.tmp'
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        shutil.copytree(data_dir(src), tmp_dir)
+        if os.path.isdir(data_dir(dst)):
+            shutil.rmtree(data_dir(dst))
+        os.rename(tmp_dir, data_dir(dst))
+
+    shutil.copy2(src, dst + '.tmp')
+    os.replace(dst + '.tmp', dst)
+
+
+class Scratch:
+    """Local copies of the inputs and outputs of jobs in a scratch directory.
+
+    Inputs are copied once and shared by the jobs reading them; outputs are
+    written locally and copied back by one background thread, after which
+    they serve as staged copies for the jobs reading them next. The
+    expected size of the outputs of a job is reserved from its start until
+    they are copied back. Copies no job uses are removed, least recently
+    used first, to stay within capacity MB. Inputs and outputs that do not
+    fit are read and written in place.
+    """
+
+    def __init__(self, scratch_dir, capacity=None):
+        self.scratch_dir = os.path.abspath(scratch_dir)
+        os.makedirs(os.path.join(self.scratch_dir, 'xml'), exist_ok=True)
+        if capacity is None:
+            capacity = int(shutil.disk_usage(self.scratch_dir).free / 2**20 *
+                           FREE_FRACTION)
+        self.capacity = capacity
+        self.entries = {}
+        self.jobs = {}
+        # MB reserved for the outputs of each job until they are copied back
+        self.reserved = {}
+        # MB read and written by the copied back jobs of each profile
+        self.ratios = {}
+        self.condition = threading.Condition()
+        self.copier = ThreadPoolExecutor(max_workers=1)
+        print(f"Scratch {self.scratch_dir}: up to {self.capacity}M of copies")
+
+    def local_path(self, path):
+        """Return the path of the local copy of path, one directory per source directory."""
+        source_dir = os.path.dirname(os.path.abspath(path))
+        key = hashlib.sha1(source_dir.encode('utf-8')).hexdigest()[0:12]
+
+        return os.path.join(self.scratch_dir, key, os.path.basename(path))
+
+    def used(self):
+        return (sum(entry['size'] for entry in self.entries.values()) +
+                sum(self.reserved.values()))
+
+    def input_size(self, job):
+        """Return the MB of the existing inputs of job."""
+        signatures = [path_signature(path) for path in job.inputs]
+
+        return sum(s[0] for s in signatures if s) / 2**20
+
+    def estimate(self, job):
+        """Return the expected MB of the outputs of job.
+
+        Uses the ratio of output to input size of the copied back jobs of
+        the same profile, and the input size before any of them finished.
+        """
+        read, written = self.ratios.get(graph_profile(job.xml_data), (0.0, 0.0))
+        ratio = written / read if read else 1.0
+
+        return self.input_size(job) * ratio
+
+    def reserve(self, size):
+        """Remove unused copies until size MB fit, return whether they do.
+
+        Called with the condition held.
+        """
+        unused = sorted((entry['used'], path) for path, entry in self.entries.items()
+                        if entry['refs'] == 0 and entry['state'] == 'ready')
+        while self.used() + size > self.capacity and unused:
+            _, path = unused.pop(0)
+            remove_product(self.entries.pop(path)['local'])
+
+        return self.used() + size <= self.capacity
+
+    def stage_input(self, path):
+        """Return the local copy of the input path, or None if it does not fit."""
+        signature = path_signature(path)
+        if signature is None:
+            return None
+
+        with self.condition:
+            while self.entries.get(path, {}).get('state') == 'copying':
+                self.condition.wait()
+            entry = self.entries.get(path)
+            if entry and entry['signature'] == signature:
+                entry['refs'] += 1
+                entry['used'] = time.time()
+                return entry['local']
+            if entry and entry['refs'] == 0:
+                remove_product(self.entries.pop(path)['local'])
+            elif entry:
+                # changed while other jobs read the old copy
+                return None
+
+            size = signature[0] / 2**20
+            if not self.reserve(size):
+                return None
+            local = self.local_path(path)
+            self.entries[path] = {
+                'local': local, 'signature': signature, 'size': size, 'refs': 1,
+                'used': time.time(), 'state': 'copying'
+            }
+
+        try:
+            copy_product(path, local)
+            state = 'ready'
+        except OSError as e:
+            print(f"Cannot stage {path} to {local} ({e}), reading it in place.")
+            remove_product(local)
+            state = None
+        with self.condition:
+            if state:
+                self.entries[path]['state'] = state
+            else:
+                del self.entries[path]
+            self.condition.notify_all()
+
+        return local if state else None
+
+    def stage(self, job):
+        """Stage the inputs of job and return the path of its graph on local copies.
+
+        Products written by the graph go to the scratch directory too. If
+        the scratch directory cannot be written, the job is released and
+        its own graph on the real paths is returned.
+        """
+        xml_data = job.xml_data
+        inputs = []
+        outputs = {}
+        with self.condition:
+            self.jobs[job] = (inputs, outputs)
+        try:
+            for path in job.inputs:
+                if path not in xml_data or not os.path.exists(path):
+                    continue
+                local = self.stage_input(path)
+                if local:
+                    inputs.append(path)
+                    xml_data = xml_data.replace(path, local)
+
+            staged_outputs = [
+                path for path in job.outputs
+                if path in xml_data and path.endswith(tuple(product_format.FORMATS.values()))
+            ]
+            if staged_outputs:
+                size = self.estimate(job)
+                with self.condition:
+                    fits = self.reserve(size)
+                    if fits:
+                        self.reserved[job] = size
+                if not fits:
+                    print(f"No room for about {size:.0f}M of outputs of {job.name} in "
+                          f"{self.scratch_dir}, writing them in place.")
+                    staged_outputs = []
+            for path in staged_outputs:
+                local = self.local_path(path)
+                with self.condition:
+                    entry = self.entries.pop(path, None)
+                if entry:
+                    # an older copy of the product being rewritten
+                    remove_product(entry['local'])
+                remove_product(local)
+                os.makedirs(os.path.dirname(local), exist_ok=True)
+                outputs[path] = local
+                xml_data = xml_data.replace(path, local)
+
+            xml_path = os.path.join(self.scratch_dir, 'xml', os.path.basename(job.xml_path))
+            with open(xml_path, 'w') as f:
+                f.write(xml_data)
+        except OSError as e:
+            print(f"Cannot stage {job.name} in {self.scratch_dir} ({e}), running it in place.")
+            try:
+                self.release(job)
+            except OSError:
+                pass
+            return job.xml_path
+
+        return xml_path
+
+    def written_outputs(self, job):
+        """Return {output: local copy} of the staged outputs of job."""
+        with self.condition:
+            return dict(self.jobs.get(job, ([], {}))[1])
+
+    def release(self, job, keep_outputs=False):
+        """Release the inputs of job and remove its local outputs unless kept.
+
+        The space reserved for kept outputs is released by copy_back.
+        """
+        with self.condition:
+            inputs, outputs = self.jobs.pop(job, ([], {}))
+            for path in inputs:
+                if path in self.entries:
+                    self.entries[path]['refs'] -= 1
+                    self.entries[path]['used'] = time.time()
+            if not keep_outputs:
+                self.reserved.pop(job, None)
+        if not keep_outputs:
+            for local in outputs.values():
+                remove_product(local)
+
+        return outputs
+
+    def copy_back(self, job):
+        """Copy the local outputs of job to their real paths in the background.
+
+        Return the future of the copy, which raises OSError if it failed.
+        """
+        return self.copier.submit(self._copy_back, job)
+
+    def _copy_back(self, job):
+        outputs = self.release(job, keep_outputs=True)
+        try:
+            written = 0.0
+            for path, local in outputs.items():
+                if not os.path.exists(local):
+                    continue
+                try:
+                    copy_product(local, path)
+                except OSError:
+                    for local in outputs.values():
+                        remove_product(local)
+                    raise
+                # the local output is now a staged copy of the product
+                size = path_signature(local)[0] / 2**20
+                written += size
+                with self.condition:
+                    self.entries[path] = {
+                        'local': local, 'signature': path_signature(path),
+                        'size': size, 'refs': 0, 'used': time.time(), 'state': 'ready'
+                    }
+            with self.condition:
+                profile = graph_profile(job.xml_data)
+                read, total = self.ratios.get(profile, (0.0, 0.0))
+                self.ratios[profile] = (read + self.input_size(job), total + written)
+        finally:
+            with self.condition:
+                self.reserved.pop(job, None)
+                self.reserve(0)
+
+    def close(self):
+        """Wait for the copies back and remove all local copies and graphs."""
+        self.copier.shutdown(wait=True)
+        with self.condition:
+            for entry in self.entries.values():
+                remove_product(entry['local'])
+            self.entries = {}
+        shutil.rmtree(os.path.join(self.scratch_dir, 'xml'), ignore_errors=True)
+        for name in os.listdir(self.scratch_dir):
+            path = os.path.join(self.scratch_dir, name)
+            if os.path.isdir(path) and not os.listdir(path):
+                os.rmdir(path)
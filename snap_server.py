@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import product_format
+
+EXAMPLE = """Example:
+  python3 snap_server.py /tmp/snap.sock --jobs 2 &
+  python3 ifg.py /ly/coreg /ly/ifg --jobs 2 --snap-server /tmp/snap.sock
+  python3 snap_server.py /tmp/snap.sock --stop
+"""
+
+
+def cmdline_parser():
+    parser = argparse.ArgumentParser(
+        description='Keep one SNAP JVM running and execute the graphs sent ' +
+        'by the stage scripts\nwith --snap-server, saving the gpt startup of ' +
+        'every job.',
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=EXAMPLE)
+
+    parser.add_argument('socket_path', help='unix socket to listen on')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=1,
+                        help='number of graphs to run at once (default: 1)')
+    parser.add_argument('--tile-cache',
+                        help='tile cache of the JVM, e.g. 8G (default: SNAP setting)')
+    parser.add_argument('--threads',
+                        type=int,
+                        help='threads of the JVM tile scheduler (default: SNAP setting)')
+    parser.add_argument('--stop',
+                        action='store_true',
+                        help='stop the server listening on socket_path')
+    inps = parser.parse_args()
+
+    return inps
+
+
+def send_request(socket_path, request):
+    """Send a request to the server and return its reply.
+
+    Raise OSError if the server cannot be reached or stops before replying.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall(json.dumps(request).encode() + b'\n')
+        with s.makefile('r') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError(f"{socket_path} closed the connection")
+
+    return json.loads(line)
+
+
+def run_graph(socket_path, xml_path, log_path):
+    """Run a graph file on the server and return its return code."""
+    reply = send_request(socket_path, {'xml_path': xml_path, 'log_path': log_path})
+
+    return reply['returncode']
+
+
+class SnapServer:
+    """Run graph files in the JVM of esa_snappy, one thread per graph."""
+
+    def __init__(self, snappy, num_jobs=1):
+        self.num_jobs = max(1, num_jobs)
+        jpy = snappy.jpy
+        self.FileReader = jpy.get_type('java.io.FileReader')
+        self.GraphIO = jpy.get_type('org.esa.snap.core.gpf.graph.GraphIO')
+        self.GraphProcessor = jpy.get_type('org.esa.snap.core.gpf.graph.GraphProcessor')
+        self.ProgressMonitor = jpy.get_type('com.bc.ceres.core.ProgressMonitor')
+        self.JAI = jpy.get_type('javax.media.jai.JAI')
+        self.System = jpy.get_type('java.lang.System')
+        self.stop_event = threading.Event()
+
+    def configure(self, tile_cache=None, threads=None):
+        """Set tile cache size in MB, tile scheduler threads and writer properties.
+
+        The writer properties of every format are set at once, gpt gets
+        them per graph.
+        """
+        for properties in product_format.FORMAT_PROPERTIES.values():
+            for key, value in properties.items():
+                self.System.setProperty(key, value)
+        jai = self.JAI.getDefaultInstance()
+        if tile_cache:
+            jai.getTileCache().setMemoryCapacity(tile_cache * 2**20)
+        if threads:
+            jai.getTileScheduler().setParallelism(threads)
+
+    def execute(self, xml_path, log_path):
+        """Run one graph file, writing errors to log_path like gpt would."""
+        time_start = time.time()
+        with open(log_path, 'w') as log:
+            log.write(f"Executing processing graph {xml_path}\n")
+            log.flush()
+            try:
+                reader = self.FileReader(xml_path)
+                try:
+                    graph = self.GraphIO.read(reader)
+                finally:
+                    reader.close()
+                self.GraphProcessor().executeGraph(graph, self.ProgressMonitor.NULL)
+                returncode = 0
+            except Exception:
+                log.write(traceback.format_exc())
+                returncode = 1
+            finally:
+                # cached tiles of finished products are never read again
+                self.JAI.getDefaultInstance().getTileCache().flush()
+            log.write(f"Processing completed in {time.time() - time_start:.3f} "
+                      "seconds\n" if returncode == 0 else "Processing failed\n")
+
+        return returncode
+
+    def handle(self, conn):
+        with conn, conn.makefile('rw') as f:
+            try:
+                request = json.loads(f.readline())
+            except ValueError:
+                return
+            if request.get('command') == 'stop':
+                self.stop_event.set()
+                reply = {'returncode': 0}
+            else:
+                print(f"Run {request['xml_path']}")
+                reply = {'returncode': self.execute(request['xml_path'],
+                                                    request['log_path'])}
+            f.write(json.dumps(reply) + '\n')
+
+    def serve(self, socket_path):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.bind(socket_path)
+            s.listen()
+            s.settimeout(1)
+            with ThreadPoolExecutor(max_workers=self.num_jobs) as executor:
+                while not self.stop_event.is_set():
+                    try:
+                        conn, _ = s.accept()
+                    except socket.timeout:
+                        continue
+                    conn.settimeout(None)
+                    executor.submit(self.handle, conn)
+        os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    inps = cmdline_parser()
+    socket_path = os.path.abspath(inps.socket_path)
+
+    if inps.stop:
+        try:
+            send_request(socket_path, {'command': 'stop'})
+        except OSError as e:
+            sys.exit(f"Error, cannot reach {socket_path}: {e}")
+        sys.exit(0)
+
+    try:
+        import esa_snappy as snappy
+    except ImportError:
+        try:
+            import snappy
+        except ImportError:
+            sys.exit('Error, snap_server.py needs esa_snappy (or snappy) configured ' +
+                     'for the SNAP installation.')
+
+    from gpt_resources import parse_size
+
+    server = SnapServer(snappy, inps.jobs)
+    server.configure(parse_size(inps.tile_cache) if inps.tile_cache else None,
+                     inps.threads)
+    print(f"SNAP server listening on {socket_path} ({server.num_jobs} graphs at once)")
+    server.serve(socket_path)
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import argparse
+import os
+import sys
+
+import gpt_runner
+import orbit_index
+import prepare_dem
+import product_format
+import s1_index
+from split_orbit import read_slc_infos
+
+SPLIT_ORBIT_COREG_XML = """<graph id="Graph">
+  <version>1.0</version>
+  <node id="Read">
+    <operator>Read</operator>
+    <sources/>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <file>MASTER</file>
+    </parameters>
+  </node>
+  <node id="Read(2)">
+    <operator>Read</operator>
+    <sources/>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <file>INPUTFILE</file>
+    </parameters>
+  </node>
+  <node id="TOPSAR-Split">
+    <operator>TOPSAR-Split</operator>
+    <sources>
+      <sourceProduct refid="Read(2)"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <subswath>IW</subswath>
+      <selectedPolarisations>VV</selectedPolarisations>
+      <firstBurstIndex>FIRSTBURST</firstBurstIndex>
+      <lastBurstIndex>LASTBURST</lastBurstIndex>
+      <wktAoi/>
+    </parameters>
+  </node>
+  <node id="Apply-Orbit-File">
+    <operator>Apply-Orbit-File</operator>
+    <sources>
+      <sourceProduct refid="TOPSAR-Split"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <orbitType>Sentinel Precise (Auto Download)</orbitType>
+      <polyDegree>3</polyDegree>
+      <continueOnFail>false</continueOnFail>
+    </parameters>
+  </node>
+  <node id="Back-Geocoding">
+    <operator>Back-Geocoding</operator>
+    <sources>
+      <sourceProduct refid="Read"/>
+      <sourceProduct.1 refid="Apply-Orbit-File"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <demName>SRTM 3Sec</demName>
+      <demResamplingMethod>BILINEAR_INTERPOLATION</demResamplingMethod>
+      <externalDEMFile/>
+      <externalDEMNoDataValue>0.0</externalDEMNoDataValue>
+      <resamplingType>BILINEAR_INTERPOLATION</resamplingType>
+      <maskOutAreaWithoutElevation>false</maskOutAreaWithoutElevation>
+      <outputRangeAzimuthOffset>false</outputRangeAzimuthOffset>
+      <outputDerampDemodPhase>false</outputDerampDemodPhase>
+      <disableReramp>false</disableReramp>
+    </parameters>
+  </node>
+  <node id="Enhanced-Spectral-Diversity">
+    <operator>Enhanced-Spectral-Diversity</operator>
+    <sources>
+      <sourceProduct refid="Back-Geocoding"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <fineWinWidthStr>512</fineWinWidthStr>
+      <fineWinHeightStr>512</fineWinHeightStr>
+      <fineWinAccAzimuth>16</fineWinAccAzimuth>
+      <fineWinAccRange>16</fineWinAccRange>
+      <fineWinOversampling>128</fineWinOversampling>
+      <xCorrThreshold>0.1</xCorrThreshold>
+      <cohThreshold>0.2</cohThreshold>
+      <numBlocksPerOverlap>10</numBlocksPerOverlap>
+      <esdEstimator>Periodogram</esdEstimator>
+      <weightFunc>Inv Quadratic</weightFunc>
+      <temporalBaselineType>Number of images</temporalBaselineType>
+      <maxTemporalBaseline>4</maxTemporalBaseline>
+      <integrationMethod>L1 and L2</integrationMethod>
+      <doNotWriteTargetBands>false</doNotWriteTargetBands>
+      <useSuppliedRangeShift>false</useSuppliedRangeShift>
+      <overallRangeShift>0.0</overallRangeShift>
+      <useSuppliedAzimuthShift>false</useSuppliedAzimuthShift>
+      <overallAzimuthShift>0.0</overallAzimuthShift>
+    </parameters>
+  </node>
+  <node id="TOPSAR-Deburst">
+    <operator>TOPSAR-Deburst</operator>
+    <sources>
+      <sourceProduct refid="Enhanced-Spectral-Diversity"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <selectedPolarisations/>
+    </parameters>
+  </node>
+  <node id="Write">
+    <operator>Write</operator>
+    <sources>
+      <sourceProduct refid="TOPSAR-Deburst"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <file>OUTPUT_COREG_FILE</file>
+      <formatName>BEAM-DIMAP</formatName>
+    </parameters>
+  </node>
+  <applicationData id="Presentation">
+    <Description/>
+    <node id="Read">
+      <displayPosition x="330.0" y="40.0"/>
+    </node>
+    <node id="Read(2)">
+      <displayPosition x="37.0" y="201.0"/>
+    </node>
+    <node id="TOPSAR-Split">
+      <displayPosition x="162.0" y="201.0"/>
+    </node>
+    <node id="Apply-Orbit-File">
+      <displayPosition x="300.0" y="201.0"/>
+    </node>
+    <node id="Back-Geocoding">
+      <displayPosition x="460.0" y="146.0"/>
+    </node>
+    <node id="Enhanced-Spectral-Diversity">
+      <displayPosition x="617.0" y="147.0"/>
+    </node>
+    <node id="TOPSAR-Deburst">
+      <displayPosition x="836.0" y="147.0"/>
+    </node>
+    <node id="Write">
+      <displayPosition x="996.0" y="148.0"/>
+    </node>
+  </applicationData>
+</graph>
+"""
+
+ASSEMBLY_SPLIT_ORBIT_COREG_XML = """<graph id="Graph">
+  <version>1.0</version>
+  <node id="Read">
+    <operator>Read</operator>
+    <sources/>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <file>MASTER</file>
+    </parameters>
+  </node>
+  <node id="ProductSet-Reader">
+    <operator>ProductSet-Reader</operator>
+    <sources/>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <fileList>FILELIST</fileList>
+    </parameters>
+  </node>
+  <node id="SliceAssembly">
+    <operator>SliceAssembly</operator>
+    <sources>
+      <sourceProduct.2 refid="ProductSet-Reader"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <selectedPolarisations>VV</selectedPolarisations>
+    </parameters>
+  </node>
+  <node id="TOPSAR-Split">
+    <operator>TOPSAR-Split</operator>
+    <sources>
+      <sourceProduct refid="SliceAssembly"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <subswath>IW</subswath>
+      <selectedPolarisations/>
+      <firstBurstIndex>FIRSTBURST</firstBurstIndex>
+      <lastBurstIndex>LASTBURST</lastBurstIndex>
+      <wktAoi/>
+    </parameters>
+  </node>
+  <node id="Apply-Orbit-File">
+    <operator>Apply-Orbit-File</operator>
+    <sources>
+      <sourceProduct refid="TOPSAR-Split"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <orbitType>Sentinel Precise (Auto Download)</orbitType>
+      <polyDegree>3</polyDegree>
+      <continueOnFail>false</continueOnFail>
+    </parameters>
+  </node>
+  <node id="Back-Geocoding">
+    <operator>Back-Geocoding</operator>
+    <sources>
+      <sourceProduct refid="Read"/>
+      <sourceProduct.1 refid="Apply-Orbit-File"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <demName>SRTM 3Sec</demName>
+      <demResamplingMethod>BILINEAR_INTERPOLATION</demResamplingMethod>
+      <externalDEMFile/>
+      <externalDEMNoDataValue>0.0</externalDEMNoDataValue>
+      <resamplingType>BILINEAR_INTERPOLATION</resamplingType>
+      <maskOutAreaWithoutElevation>false</maskOutAreaWithoutElevation>
+      <outputRangeAzimuthOffset>false</outputRangeAzimuthOffset>
+      <outputDerampDemodPhase>false</outputDerampDemodPhase>
+      <disableReramp>false</disableReramp>
+    </parameters>
+  </node>
+  <node id="Enhanced-Spectral-Diversity">
+    <operator>Enhanced-Spectral-Diversity</operator>
+    <sources>
+      <sourceProduct refid="Back-Geocoding"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <fineWinWidthStr>512</fineWinWidthStr>
+      <fineWinHeightStr>512</fineWinHeightStr>
+      <fineWinAccAzimuth>16</fineWinAccAzimuth>
+      <fineWinAccRange>16</fineWinAccRange>
+      <fineWinOversampling>128</fineWinOversampling>
+      <xCorrThreshold>0.1</xCorrThreshold>
+      <cohThreshold>0.2</cohThreshold>
+      <numBlocksPerOverlap>10</numBlocksPerOverlap>
+      <esdEstimator>Periodogram</esdEstimator>
+      <weightFunc>Inv Quadratic</weightFunc>
+      <temporalBaselineType>Number of images</temporalBaselineType>
+      <maxTemporalBaseline>4</maxTemporalBaseline>
+      <integrationMethod>L1 and L2</integrationMethod>
+      <doNotWriteTargetBands>false</doNotWriteTargetBands>
+      <useSuppliedRangeShift>false</useSuppliedRangeShift>
+      <overallRangeShift>0.0</overallRangeShift>
+      <useSuppliedAzimuthShift>false</useSuppliedAzimuthShift>
+      <overallAzimuthShift>0.0</overallAzimuthShift>
+    </parameters>
+  </node>
+  <node id="TOPSAR-Deburst">
+    <operator>TOPSAR-Deburst</operator>
+    <sources>
+      <sourceProduct refid="Enhanced-Spectral-Diversity"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <selectedPolarisations/>
+    </parameters>
+  </node>
+  <node id="Write">
+    <operator>Write</operator>
+    <sources>
+      <sourceProduct refid="TOPSAR-Deburst"/>
+    </sources>
+    <parameters class="com.bc.ceres.binding.dom.XppDomElement">
+      <file>OUTPUT_COREG_FILE</file>
+      <formatName>BEAM-DIMAP</formatName>
+    </parameters>
+  </node>
+  <applicationData id="Presentation">
+    <Description/>
+    <node id="Read">
+      <displayPosition x="330.0" y="40.0"/>
+    </node>
+    <node id="ProductSet-Reader">
+      <displayPosition x="15.0" y="271.0"/>
+    </node>
+    <node id="SliceAssembly">
+      <displayPosition x="30.0" y="201.0"/>
+    </node>
+    <node id="TOPSAR-Split">
+      <displayPosition x="162.0" y="201.0"/>
+    </node>
+    <node id="Apply-Orbit-File">
+      <displayPosition x="300.0" y="201.0"/>
+    </node>
+    <node id="Back-Geocoding">
+      <displayPosition x="460.0" y="146.0"/>
+    </node>
+    <node id="Enhanced-Spectral-Diversity">
+      <displayPosition x="617.0" y="147.0"/>
+    </node>
+    <node id="TOPSAR-Deburst">
+      <displayPosition x="836.0" y="147.0"/>
+    </node>
+    <node id="Write">
+      <displayPosition x="996.0" y="148.0"/>
+    </node>
+  </applicationData>
+</graph>
+"""
+
+EXAMPLE = """Example:
+  python3 split_orbit.py /ly/zips /ly/slc master.info
+  python3 split_coreg.py /ly/zips /ly/slc /ly/coreg date.info 20200118 --jobs 4
+"""
+
+
+def cmdline_parser():
+    parser = argparse.ArgumentParser(
+        description='Split, apply orbit and coregister Sentinel-1 TOPS slaves ' +
+        'directly from zips\nwith ESD using SNAP, without writing slave slcs.',
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=EXAMPLE)
+
+    parser.add_argument('zip_dir', help='Sentinel-1 TOPS zips directory')
+    parser.add_argument('slc_dir',
+                        help='slc directory with the master split by split_orbit.py')
+    parser.add_argument('output_dir', help='output directory')
+    parser.add_argument('info_file',
+                        help='file including date IW first_burst last_burst')
+    parser.add_argument('master', help='master slc date for coregistration')
+    parser.add_argument('--dem',
+                        help='DEM GeoTIFF made by prepare_dem.py (default: SRTM 3Sec\n' +
+                        'downloaded by SNAP)')
+    parser.add_argument('--orbit-dir',
+                        help='local directory of POEORB/RESORB EOF files to take the\n' +
+                        'orbits from instead of downloading them')
+    gpt_runner.add_runner_arguments(parser)
+    product_format.add_format_argument(parser)
+    inps = parser.parse_args()
+
+    return inps
+
+
+if __name__ == "__main__":
+    # get inputs
+    inps = cmdline_parser()
+    zip_dir = os.path.abspath(inps.zip_dir)
+    slc_dir = os.path.abspath(inps.slc_dir)
+    output_dir = os.path.abspath(inps.output_dir)
+    info_file = os.path.abspath(inps.info_file)
+    master_date = inps.master
+
+    # check inputs
+    if not os.path.isdir(zip_dir):
+        sys.exit(f"Error, {zip_dir} does not exist.")
+
+    if not os.path.isdir(slc_dir):
+        sys.exit(f"Error, {slc_dir} does not exist.")
+
+    if not os.path.isfile(info_file):
+        sys.exit(f'Cannot find file {info_file}.')
+
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
+
+    xml_dir = os.path.join(output_dir, 'xml')
+    if not os.path.isdir(xml_dir):
+        os.mkdir(xml_dir)
+
+    # slave slc infos, the master is read from slc_dir
+    slc_infos = [i for i in read_slc_infos(info_file) if i[0] != master_date]
+    if len(slc_infos) == 0:
+        sys.exit(f"No slave slc infos in {info_file}")
+
+    index_path = s1_index.default_index_path(zip_dir, xml_dir)
+    zips = s1_index.zips_by_date(s1_index.update_index(zip_dir, index_path))
+
+    slcs = {product_format.product_stem(i): i for i in product_format.find_products(slc_dir)}
+
+    jobs = []
+    for slc_info in slc_infos:
+        date, iw, first_burst, last_burst = slc_info
+
+        master = slcs.get(f"{master_date}_IW{iw}",
+                          os.path.join(slc_dir, f"{master_date}_IW{iw}.dim"))
+        if not os.path.isfile(master):
+            sys.exit(f"Cannot find master {master}, run split_orbit.py first.")
+
+        zip_files = zips.get(date, [])
+        if len(zip_files) == 0:
+            print(f"Cannot find zip file of {date}, skip it.")
+            continue
+
+        if len(zip_files) == 1:
+            xml_data = SPLIT_ORBIT_COREG_XML
+            xml_data = xml_data.replace('INPUTFILE', zip_files[0])
+        else:
+            xml_data = ASSEMBLY_SPLIT_ORBIT_COREG_XML
+            xml_data = xml_data.replace('FILELIST', ','.join(zip_files))
+
+        output_file = os.path.join(output_dir, f"{master_date}_{date}_IW{iw}.dim")
+        xml_data = xml_data.replace('<subswath>IW</subswath>',
+                                    f"<subswath>IW{iw}</subswath>")
+        xml_data = xml_data.replace('MASTER', master)
+        xml_data = xml_data.replace('FIRSTBURST', first_burst)
+        xml_data = xml_data.replace('LASTBURST', last_burst)
+        xml_data = xml_data.replace('OUTPUT_COREG_FILE', output_file)
+
+        xml_name = f"{master_date}_{date}_IW{iw}_split_coreg.xml"
+        xml_path = os.path.join(xml_dir, xml_name)
+        jobs.append(
+            gpt_runner.GptJob(f"{date}_IW{iw}", xml_path, xml_data,
+                              zip_files + [master], [output_file]))
+
+    if inps.dem:
+        dem_file = os.path.abspath(inps.dem)
+        if not os.path.isfile(dem_file):
+            sys.exit(f"Cannot find DEM {dem_file}")
+        for job in jobs:
+            prepare_dem.use_external_dem(job, dem_file)
+
+    if inps.orbit_dir:
+        orbits = orbit_index.OrbitIndex(os.path.abspath(inps.orbit_dir))
+        for job in jobs:
+            orbit_index.use_local_orbit(job, orbits)
+
+    product_format.use_format(jobs, inps.format)
+    gpt_runner.run_stage(jobs, inps, xml_dir)
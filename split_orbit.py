@@ -6,12 +6,14 @@
 ##################################
 
 import argparse
-import glob
 import os
 import re
-import subprocess
 import sys
-import time
+
+import gpt_runner
+import orbit_index
+import product_format
+import s1_index
 
 SPLIT_ORBIT_XML = """<graph id="Graph">
   <version>1.0</version>
@@ -134,6 +136,9 @@ ASSEMBLY_SPLIT_ORBIT_XML = """<graph id="Graph">
 
 EXAMPLE = """Example:
   python3 split_orbit.py /ly/zips /ly/slc date.info
+  python3 split_orbit.py /ly/zips /ly/slc date.info --jobs 6
+  python3 split_orbit.py /ly/zips /ly/slc --aoi 100.1 100.5 40.2 40.4
+  python3 split_orbit.py /ly/zips /ly/slc date.info --aoi "POLYGON ((...))"
 """
 
 
@@ -146,18 +151,87 @@ def cmdline_parser():
     parser.add_argument('zip_dir', help='Sentinel-1 TOPS zips directory')
     parser.add_argument('output_dir', help='output slc directory')
     parser.add_argument('info_file',
-                        help='file including date IW first_burst last_burst')
+                        nargs='?',
+                        help='file including date IW first_burst last_burst,\n' +
+                        'with --aoi only its dates are used (default: all dates)')
+    parser.add_argument('--aoi',
+                        nargs='+',
+                        help='lon_min lon_max lat_min lat_max or WKT polygon; select\n' +
+                        'the IWs and bursts covering it from the zip annotations')
+    parser.add_argument('--orbit-dir',
+                        help='local directory of POEORB/RESORB EOF files to take the\n' +
+                        'orbits from instead of downloading them')
+    gpt_runner.add_runner_arguments(parser)
+    product_format.add_format_argument(parser)
     inps = parser.parse_args()
 
     return inps
 
 
+def read_slc_infos(info_file):
+    """Read [date, iw, first_burst, last_burst] lines of info_file."""
+    slc_infos = []
+    with open(info_file, 'r') as f:
+        for line in f.readlines():
+            if re.search(r'\d{8}', line) and not line.startswith('#'):
+                slc_infos.append(line.strip().split())
+
+    return slc_infos
+
+
+def aoi_slc_infos(index, aoi, info_file, xml_dir):
+    """Return the slc infos covering aoi and save them to xml_dir/aoi_date.info."""
+    dates = None
+    if info_file:
+        dates = set(i[0] for i in read_slc_infos(info_file))
+
+    slc_infos = s1_index.select_bursts(index, s1_index.parse_aoi(aoi), dates)
+    with open(os.path.join(xml_dir, 'aoi_date.info'), 'w') as f:
+        f.write('# date IW first_burst last_burst, selected for AOI ' +
+                ' '.join(aoi) + '\n')
+        for slc_info in slc_infos:
+            f.write(' '.join(slc_info) + '\n')
+
+    return slc_infos
+
+
+def split_orbit_job(zip_files, date, iw, first_burst, last_burst, output_dir,
+                    xml_dir):
+    """Return the job splitting one subswath of the zips of date."""
+    output_name = date + '_IW' + iw + '.dim'
+    output_path = os.path.join(output_dir, output_name)
+
+    if len(zip_files) == 1:
+        xml_data = SPLIT_ORBIT_XML
+        xml_data = xml_data.replace('IW', 'IW' + iw)
+        xml_data = xml_data.replace('INPUTFILE', zip_files[0])
+        xml_data = xml_data.replace('OUTPUTFILE', output_path)
+        xml_data = xml_data.replace('FIRSTBURST', first_burst)
+        xml_data = xml_data.replace('LASTBURST', last_burst)
+
+        xml_name = f"{date}_IW{iw}_split_orbit.xml"
+    else:
+        file_list = ','.join(zip_files)
+        xml_data = ASSEMBLY_SPLIT_ORBIT_XML
+        xml_data = xml_data.replace('IW', 'IW' + iw)
+        xml_data = xml_data.replace('FILELIST', file_list)
+        xml_data = xml_data.replace('OUTPUTFILE', output_path)
+        xml_data = xml_data.replace('FIRSTBURST', first_burst)
+        xml_data = xml_data.replace('LASTBURST', last_burst)
+
+        xml_name = f"{date}_IW{iw}_assembly_split_orbit.xml"
+
+    xml_path = os.path.join(xml_dir, xml_name)
+    return gpt_runner.GptJob(f"{date}_IW{iw}", xml_path, xml_data, zip_files,
+                             [output_path])
+
+
 if __name__ == "__main__":
     # get inputs
     inps = cmdline_parser()
     zip_dir = os.path.abspath(inps.zip_dir)
     output_dir = os.path.abspath(inps.output_dir)
-    info_file = os.path.abspath(inps.info_file)
+    info_file = os.path.abspath(inps.info_file) if inps.info_file else None
 
     # check inputs
     if not os.path.isdir(zip_dir):
@@ -166,73 +240,52 @@ if __name__ == "__main__":
     if not os.path.isdir(output_dir):
         os.mkdir(output_dir)
 
-    if not os.path.isfile(info_file):
+    if info_file is None and inps.aoi is None:
+        sys.exit('Error, give an info_file or an AOI with --aoi.')
+
+    if info_file and not os.path.isfile(info_file):
         sys.exit(f'Cannot find file {info_file}.')
 
     xml_dir = os.path.join(output_dir, 'xml')
     if not os.path.isdir(xml_dir):
       os.mkdir(xml_dir)
 
-    # get slc infos
-    slc_infos = []
-    with open(info_file, 'r') as f:
-        for line in f.readlines():
-            if re.search(r'\d{8}', line) and not line.startswith('#'):
-                slc_infos.append(line.strip().split())
+    # one scan of zip_dir for all dates
+    index_path = s1_index.default_index_path(zip_dir, xml_dir)
+    index = s1_index.update_index(zip_dir, index_path)
+    zips = s1_index.zips_by_date(index)
 
-    if len(slc_infos) == 0:
-        sys.exit(f"No slc infos in {info_file}")
+    # get slc infos
+    if inps.aoi:
+        try:
+            slc_infos = aoi_slc_infos(index, inps.aoi, info_file, xml_dir)
+        except ValueError as e:
+            sys.exit(f"Error, {e}")
+        if len(slc_infos) == 0:
+            sys.exit(f"No burst covers AOI {' '.join(inps.aoi)}")
+    else:
+        slc_infos = read_slc_infos(info_file)
+        if len(slc_infos) == 0:
+            sys.exit(f"No slc infos in {info_file}")
 
     # split and apply orbit
+    jobs = []
     for slc_info in slc_infos:
         date, iw, first_burst, last_burst = slc_info
 
-        zip_files = glob.glob(os.path.join(zip_dir, f"S1*{date}*.zip"))
-
-        index = slc_infos.index(slc_info) + 1
-        print(f"\n[{index}/{len(slc_infos)}] SLC for IW{iw}: {date}\n")
-
-        output_name = date + '_IW' + iw + '.dim'
-        output_path = os.path.join(output_dir, output_name)
-
-        if len(zip_files) == 1:
-            xml_data = SPLIT_ORBIT_XML
-            xml_data = xml_data.replace('IW', 'IW' + iw)
-            xml_data = xml_data.replace('INPUTFILE', zip_files[0])
-            xml_data = xml_data.replace('OUTPUTFILE', output_path)
-            xml_data = xml_data.replace('FIRSTBURST', first_burst)
-            xml_data = xml_data.replace('LASTBURST', last_burst)
-
-            xml_path = os.path.join(xml_dir, date + '_split_orbit.xml')
-        else:
-            file_list = ','.join(zip_files)
-            xml_data = ASSEMBLY_SPLIT_ORBIT_XML
-            xml_data = xml_data.replace('IW', 'IW' + iw)
-            xml_data = xml_data.replace('FILELIST', file_list)
-            xml_data = xml_data.replace('OUTPUTFILE', output_path)
-            xml_data = xml_data.replace('FIRSTBURST', first_burst)
-            xml_data = xml_data.replace('LASTBURST', last_burst)
-
-            xml_path = os.path.join(xml_dir,
-                                    date + '_assembly_split_orbit.xml')
-
-        with open(xml_path, 'w+') as f:
-            f.write(xml_data)
-
-        args = ["gpt", xml_path]
-        process = subprocess.Popen(args,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-
-        time_start = time.time()
+        zip_files = zips.get(date, [])
+        if len(zip_files) == 0:
+            print(f"Cannot find zip file of {date}, skip it.")
+            continue
 
-        stdout = process.communicate()[0]
-        print(str(stdout, encoding='utf-8'))
+        jobs.append(
+            split_orbit_job(zip_files, date, iw, first_burst, last_burst,
+                            output_dir, xml_dir))
 
-        time_delta = time.time() - time_start
-        print('Finished in {} seconds.\n'.format(time_delta))
+    if inps.orbit_dir:
+        orbits = orbit_index.OrbitIndex(os.path.abspath(inps.orbit_dir))
+        for job in jobs:
+            orbit_index.use_local_orbit(job, orbits)
 
-        if process.returncode != 0:
-            print('Error processing {}.\n'.format(date))
-        else:
-            print('Processing {} completed.\n'.format(date))
+    product_format.use_format(jobs, inps.format)
+    gpt_runner.run_stage(jobs, inps, xml_dir)
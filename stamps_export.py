@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import argparse
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+
+import product_format
+from dimap import DimapProduct, band_date, element_attributes, orbit_vectors, parse_utc
+
+BLOCK_LINES = 1024
+WGS84_A = 6378137.0
+WGS84_B = 6356752.3141
+SPEED_OF_LIGHT = 299792458.0
+# files compared as text, with numbers within this relative tolerance
+PAR_EXTENSIONS = ('.par', '.base')
+PAR_TOLERANCE = 1e-6
+
+EXAMPLE = """Example:
+  python3 stamps_export.py /ly/coreg /ly/ifg /ly/INSAR_20200106 --jobs 8
+  python3 stamps_export.py /ly/coreg /ly/ifg /ly/native --compare /ly/INSAR_20200106
+"""
+
+
+def cmdline_parser():
+    parser = argparse.ArgumentParser(
+        description='Export coreg and ifg products to the StaMPS PSI layout ' +
+        'without SNAP,\nlike psi_export.py does with the StampsExport operator.',
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=EXAMPLE)
+
+    parser.add_argument('coreg_dir', help='input coreg directory')
+    parser.add_argument('ifg_dir', help='input ifg directory')
+    parser.add_argument('output_dir', help='output directory')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='number of pairs to export at once (default: number of CPUs)')
+    parser.add_argument('--compare',
+                        metavar='SNAP_DIR',
+                        help='compare the files written with those psi_export.py wrote\n' +
+                        'to SNAP_DIR, byte for byte for rasters')
+    parser.add_argument('--block-lines',
+                        type=int,
+                        default=BLOCK_LINES,
+                        help='azimuth lines per block (default: %(default)s)')
+    inps = parser.parse_args()
+
+    return inps
+
+
+def write_raster(path, bands, dtype, block_lines=BLOCK_LINES):
+    """Stream bands into one big endian StaMPS raster, block by block.
+
+    Two bands (i, q) are interleaved as FCOMPLEX, one band is written as
+    FLOAT. The file appears under its name only when complete.
+    """
+    height, width = bands[0].height, bands[0].width
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for row_start in range(0, height, block_lines):
+            window = (row_start, min(row_start + block_lines, height), 0, width)
+            if len(bands) == 2:
+                block = np.empty((window[1] - window[0], width), dtype='>c8')
+                block.real = bands[0].array[window[0]:window[1]]
+                block.imag = bands[1].array[window[0]:window[1]]
+            else:
+                block = bands[0].array[window[0]:window[1]].astype(dtype)
+            f.write(block.tobytes())
+    os.replace(tmp_path, path)
+
+
+def seconds_of_day(time):
+    return time.hour * 3600 + time.minute * 60 + time.second + time.microsecond / 1e6
+
+
+def interpolate_orbit(vectors, time):
+    """Return position and velocity at time from a cubic fit of the state vectors."""
+    t0 = vectors[0][0]
+    t = np.array([(v[0] - t0).total_seconds() for v in vectors])
+    x = (time - t0).total_seconds()
+    # the nearest vectors around time
+    nearest = np.argsort(np.abs(t - x))[0:min(len(t), 8)]
+    state = np.array([vectors[i][1:7] for i in nearest])
+    degree = min(3, len(nearest) - 1)
+    offsets = t[nearest] - x
+    # fit in units of the span of the vectors for a well conditioned fit
+    scale = max(np.abs(offsets).max(), 1.0)
+    values = [np.polyval(np.polyfit(offsets / scale, state[:, k], degree), 0)
+              for k in range(6)]
+
+    return np.array(values[0:3]), np.array(values[3:6])
+
+
+def earth_radius(position):
+    """Return the WGS84 radius below a geocentric position."""
+    latitude = np.arcsin(position[2] / np.linalg.norm(position))
+
+    return WGS84_A * WGS84_B / np.hypot(WGS84_B * np.cos(latitude),
+                                        WGS84_A * np.sin(latitude))
+
+
+def scene_times(attributes):
+    start = parse_utc(attributes['first_line_time'])
+    stop = parse_utc(attributes['last_line_time'])
+
+    return start, start + (stop - start) / 2, stop
+
+
+def rslc_par(attributes, vectors, width, height):
+    """Return the Gamma SLC parameter file of an image from its metadata."""
+    start, center, stop = scene_times(attributes)
+    near_range = float(attributes['slant_range_to_first_pixel'])
+    range_spacing = float(attributes['range_spacing'])
+    position, _ = interpolate_orbit(vectors, center)
+    incidence = (float(attributes['incidence_near']) +
+                 float(attributes['incidence_far'])) / 2
+    interval = (vectors[1][0] - vectors[0][0]).total_seconds() if len(vectors) > 1 else 0
+
+    lines = [
+        'Gamma Interferometric SAR Processor (ISP) - Image Parameter File',
+        '',
+        f"title:     {attributes.get('PRODUCT', '')}",
+        f"sensor:    {attributes.get('MISSION', '')} {attributes.get('SWATH', '')} "
+        f"{attributes.get('mds1_tx_rx_polar', '')}",
+        f"date:      {start:%Y %m %d %H %M} {start.second + start.microsecond / 1e6:.4f}",
+        f"start_time:            {seconds_of_day(start):.6f}   s",
+        f"center_time:           {seconds_of_day(center):.6f}   s",
+        f"end_time:              {seconds_of_day(stop):.6f}   s",
+        f"azimuth_line_time:     {float(attributes['line_time_interval']):.7e}   s",
+        'line_header_size:                  0',
+        f"range_samples:                 {width}",
+        f"azimuth_lines:                 {height}",
+        f"range_looks:                       {attributes.get('range_looks', 1)}",
+        f"azimuth_looks:                     {attributes.get('azimuth_looks', 1)}",
+        'image_format:               FCOMPLEX',
+        'image_geometry:             SLANT_RANGE',
+        'range_scale_factor:     1.0000000e+00',
+        'azimuth_scale_factor:   1.0000000e+00',
+        f"center_latitude:         {float(attributes['centre_lat']):.7f}   degrees",
+        f"center_longitude:        {float(attributes['centre_lon']):.7f}   degrees",
+        f"heading:                 {float(attributes['centre_heading']):.7f}   degrees",
+        f"range_pixel_spacing:         {range_spacing:.6f}   m",
+        f"azimuth_pixel_spacing:       {float(attributes['azimuth_spacing']):.6f}   m",
+        f"near_range_slc:           {near_range:.4f}  m",
+        f"center_range_slc:         {near_range + range_spacing * (width // 2):.4f}  m",
+        f"far_range_slc:            {near_range + range_spacing * (width - 1):.4f}  m",
+        f"incidence_angle:              {incidence:.4f}   degrees",
+        f"radar_frequency:        {float(attributes['radar_frequency']) * 1e6:.7e}   Hz",
+        f"adc_sampling_rate:      {float(attributes['range_sampling_rate']) * 1e6:.7e}   Hz",
+        f"chirp_bandwidth:        {float(attributes['range_bandwidth']) * 1e6:.7e}   Hz",
+        f"prf:                    {float(attributes['pulse_repetition_frequency']):.7f}  Hz",
+        f"azimuth_proc_bandwidth:   {float(attributes['azimuth_bandwidth']):.5f}   Hz",
+        f"sar_to_earth_center:          {np.linalg.norm(position):.4f}   m",
+        f"earth_radius_below_sensor:    {earth_radius(position):.4f}   m",
+        f"earth_semi_major_axis:        {WGS84_A:.4f}   m",
+        f"earth_semi_minor_axis:        {WGS84_B:.4f}   m",
+        f"number_of_state_vectors:             {len(vectors)}",
+        f"time_of_first_state_vector:    {seconds_of_day(vectors[0][0]):.6f}   s",
+        f"state_vector_interval:         {interval:.6f}   s",
+    ]
+    for i, vector in enumerate(vectors, start=1):
+        lines.append(f"state_vector_position_{i}:  {vector[1]:.4f}  {vector[2]:.4f}  "
+                     f"{vector[3]:.4f}   m   m   m")
+        lines.append(f"state_vector_velocity_{i}:  {vector[4]:.5f}  {vector[5]:.5f}  "
+                     f"{vector[6]:.5f}   m/s m/s m/s")
+
+    return '\n'.join(lines) + '\n\n'
+
+
+def tcn_baseline(master_vectors, slave_vectors, time, slave_time):
+    """Return the baseline of the slave orbit to the master at time in TCN.
+
+    T is along the master track, N normal to it pointing away from the
+    earth center and C completes the right handed frame. The slave
+    position is taken at its closest approach to the master position,
+    searched from slave_time, the same scene time on the slave orbit.
+    """
+    position, velocity = interpolate_orbit(master_vectors, time)
+    t = velocity / np.linalg.norm(velocity)
+    n = position - np.dot(position, t) * t
+    n /= np.linalg.norm(n)
+    c = np.cross(n, t)
+
+    for _ in range(10):
+        slave_position, slave_velocity = interpolate_orbit(slave_vectors, slave_time)
+        step = (np.dot(position - slave_position, slave_velocity) /
+                np.dot(slave_velocity, slave_velocity))
+        slave_time = slave_time + timedelta(seconds=step)
+        if abs(step) < 1e-6:
+            break
+    slave_position, _ = interpolate_orbit(slave_vectors, slave_time)
+    baseline = slave_position - position
+
+    return np.array([np.dot(baseline, t), np.dot(baseline, c), np.dot(baseline, n)])
+
+
+def base_file(master_attributes, master_vectors, slave_attributes, slave_vectors):
+    """Return the Gamma baseline file of a pair at the master scene center."""
+    start, center, stop = scene_times(master_attributes)
+    # master time to slave time of the same position along the track
+    shift = scene_times(slave_attributes)[1] - center
+    baseline = tcn_baseline(master_vectors, slave_vectors, center, center + shift)
+    duration = (stop - start).total_seconds()
+    rate = (tcn_baseline(master_vectors, slave_vectors, stop, stop + shift) -
+            tcn_baseline(master_vectors, slave_vectors, start, start + shift)) / duration
+    rate[0] = 0.0
+
+    return (f"initial_baseline(TCN):     {baseline[0]:.7f}  {baseline[1]:.7f}  "
+            f"{baseline[2]:.7f}   m   m   m\n"
+            f"initial_baseline_rate:     {rate[0]:.7f}  {rate[1]:.7f}  "
+            f"{rate[2]:.7f}   m/s m/s m/s\n"
+            "precision_baseline(TCN):   0.0000000  0.0000000  0.0000000   m   m   m\n"
+            "precision_baseline_rate:   0.0000000  0.0000000  0.0000000   m/s m/s m/s\n"
+            "unwrap_phase_constant:   0.00000     radians\n\n")
+
+
+def write_text(path, text):
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+
+def slave_attributes(coreg, slave_date=None):
+    """Return the metadata attributes and state vectors of the slave of coreg.
+
+    A pair written from a stack keeps the metadata of all its slaves, so
+    the one acquired on slave_date is taken.
+    """
+    for name, attributes in coreg.slave_metadata.items():
+        if band_date(attributes.get('first_line_time', '')) == slave_date:
+            return attributes, orbit_vectors(coreg.slave_elements[name])
+    element = next(iter(coreg.slave_elements.values()))
+
+    return element_attributes(element), orbit_vectors(element)
+
+
+def pair_bands(coreg, ifg):
+    """Return the band names of master, slave and interferogram of a pair."""
+    masters = coreg.find_bands(r'^i_.*_mst_')
+    if not masters:
+        raise KeyError(f"No master i band in {coreg.dim_path}")
+    master = masters[0].name
+    pol = re.search(r'_(HH|HV|VH|VV)_', master)
+    pol = pol.group(0) if pol else '_'
+    slaves = [b.name for b in coreg.find_bands(r'^i_.*_slv\d*_') if pol in b.name]
+    if not slaves:
+        raise KeyError(f"No slave i band of {pol.strip('_')} in {coreg.dim_path}")
+    ifg_bands = [b.name for b in ifg.find_bands(r'^i_ifg_') if pol in b.name]
+    if not ifg_bands:
+        raise KeyError(f"No i_ifg band of {pol.strip('_')} in {ifg.dim_path}")
+
+    return master, slaves[0], ifg_bands[0]
+
+
+def complex_bands(product, i_band):
+    return [product.band(i_band), product.band('q' + i_band[1:])]
+
+
+def export_master(coreg_file, output_dir, block_lines=BLOCK_LINES):
+    """Write rslc and rslc.par of the master of a coreg product."""
+    coreg = DimapProduct(coreg_file)
+    master_band = coreg.find_bands(r'^i_.*_mst_')[0].name
+    path = os.path.join(output_dir, 'rslc', f"{coreg.master_date}.rslc")
+    write_raster(path, complex_bands(coreg, master_band), '>c8', block_lines)
+    write_text(path + '.par',
+               rslc_par(coreg.metadata, orbit_vectors(coreg.metadata_element),
+                        coreg.width, coreg.height))
+
+    return [path, path + '.par']
+
+
+def export_pair(coreg_file, ifg_file, output_dir, block_lines=BLOCK_LINES):
+    """Write the slave rslc, diff, baseline, geo and dem files of one pair."""
+    coreg = DimapProduct(coreg_file)
+    ifg = DimapProduct(ifg_file)
+    master_band, slave_band, ifg_band = pair_bands(coreg, ifg)
+    master_date = coreg.master_date
+    slave_date = band_date(slave_band.rsplit('_', 1)[-1])
+    pair = f"{master_date}_{slave_date}"
+    attributes, vectors = slave_attributes(coreg, slave_date)
+
+    rslc = os.path.join(output_dir, 'rslc', f"{slave_date}.rslc")
+    diff = os.path.join(output_dir, 'diff0', f"{pair}.diff")
+    base = os.path.join(output_dir, 'diff0', f"{pair}.base")
+    lat = os.path.join(output_dir, 'geo', f"{pair}.lat")
+    lon = os.path.join(output_dir, 'geo', f"{pair}.lon")
+    dem = os.path.join(output_dir, 'dem', f"{pair}_dem.rdc")
+
+    write_raster(rslc, complex_bands(coreg, slave_band), '>c8', block_lines)
+    write_text(rslc + '.par', rslc_par(attributes, vectors, coreg.width, coreg.height))
+    write_raster(diff, complex_bands(ifg, ifg_band), '>c8', block_lines)
+    write_text(base, base_file(coreg.metadata, orbit_vectors(coreg.metadata_element),
+                               attributes, vectors))
+    write_raster(lat, [ifg.band('orthorectifiedLat')], '>f4', block_lines)
+    write_raster(lon, [ifg.band('orthorectifiedLon')], '>f4', block_lines)
+    write_raster(dem, [ifg.band('elevation')], '>f4', block_lines)
+
+    return [rslc, rslc + '.par', diff, base, lat, lon, dem]
+
+
+def compare_text(path, other):
+    """Return the lines of two parameter files whose values differ."""
+    def entries(p):
+        with open(p, 'r') as f:
+            return dict(line.split(':', 1) for line in f if ':' in line)
+
+    def same(a, b):
+        a, b = a.split(), b.split()
+        if len(a) != len(b):
+            return False
+        for x, y in zip(a, b):
+            try:
+                if not np.isclose(float(x), float(y), rtol=PAR_TOLERANCE, atol=1e-9):
+                    return False
+            except ValueError:
+                if x != y:
+                    return False
+        return True
+
+    mine, theirs = entries(path), entries(other)
+    return [f"{key}: {mine.get(key, '-').strip()} != {theirs.get(key, '-').strip()}"
+            for key in sorted(set(mine) | set(theirs))
+            if not same(mine.get(key, ''), theirs.get(key, ''))]
+
+
+def compare_raster(path, other, chunk=2**24):
+    """Return the number of differing bytes of two files, None if sizes differ."""
+    if os.path.getsize(path) != os.path.getsize(other):
+        return None
+    differ = 0
+    with open(path, 'rb') as f, open(other, 'rb') as g:
+        while True:
+            a, b = f.read(chunk), g.read(chunk)
+            if not a:
+                break
+            differ += int(np.count_nonzero(np.frombuffer(a, 'u1') != np.frombuffer(b, 'u1')))
+
+    return differ
+
+
+def compare_outputs(paths, output_dir, snap_dir):
+    """Print how each written file compares to SNAP's; return True if all match.
+
+    Rasters must be identical and parameter files equal within
+    PAR_TOLERANCE; a file missing in snap_dir counts as a difference.
+    """
+    all_same = True
+    for path in sorted(paths):
+        relative = os.path.relpath(path, output_dir)
+        other = os.path.join(snap_dir, relative)
+        if not os.path.isfile(other):
+            all_same = False
+            print(f"  {relative}: missing in {snap_dir}")
+            continue
+        if path.endswith(PAR_EXTENSIONS):
+            diffs = compare_text(path, other)
+            if diffs:
+                all_same = False
+            print(f"  {relative}: " + ('same values' if not diffs else
+                                       f"{len(diffs)} values differ"))
+            for line in diffs:
+                print(f"      {line}")
+            continue
+        differ = compare_raster(path, other)
+        if differ == 0:
+            print(f"  {relative}: identical")
+        else:
+            all_same = False
+            print(f"  {relative}: " + ('size differs' if differ is None else
+                                       f"{differ} bytes differ"))
+
+    return all_same
+
+
+if __name__ == "__main__":
+    # get inputs
+    inps = cmdline_parser()
+    coreg_dir = os.path.abspath(inps.coreg_dir)
+    ifg_dir = os.path.abspath(inps.ifg_dir)
+    output_dir = os.path.abspath(inps.output_dir)
+
+    # check inputs
+    if not os.path.isdir(coreg_dir):
+        sys.exit(f"Error, {coreg_dir} does not exist.")
+
+    if not os.path.isdir(ifg_dir):
+        sys.exit(f"Error, {ifg_dir} does not exist.")
+
+    if inps.compare and not os.path.isdir(inps.compare):
+        sys.exit(f"Error, {inps.compare} does not exist.")
+
+    for folder in ['rslc', 'diff0', 'geo', 'dem']:
+        os.makedirs(os.path.join(output_dir, folder), exist_ok=True)
+
+    coreg_files = product_format.find_products(coreg_dir)
+    ifg_files = {product_format.product_stem(i): i
+                 for i in product_format.find_products(ifg_dir)}
+    if any(not p.endswith('.dim') for p in coreg_files + list(ifg_files.values())):
+        sys.exit("Error, stamps_export.py reads BEAM-DIMAP products only.")
+
+    pairs = []
+    for coreg_file in coreg_files:
+        stem = product_format.product_stem(coreg_file)
+        ifg_file = ifg_files.get(stem, os.path.join(ifg_dir, stem + '.dim'))
+        if not os.path.isfile(ifg_file):
+            print(f"Cannot find {ifg_file}, skip {os.path.basename(coreg_file)}.")
+            continue
+        pairs.append((coreg_file, ifg_file))
+    if not pairs:
+        sys.exit(f"No coreg and ifg products in {coreg_dir} and {ifg_dir}")
+
+    # the master rslc once, the pairs in parallel
+    paths = []
+    with ProcessPoolExecutor(max_workers=max(1, inps.jobs)) as executor:
+        futures = {executor.submit(export_master, pairs[0][0], output_dir,
+                                   inps.block_lines): 'master'}
+        for coreg_file, ifg_file in pairs:
+            futures[executor.submit(export_pair, coreg_file, ifg_file, output_dir,
+                                    inps.block_lines)] = os.path.basename(coreg_file)
+        failed = []
+        for future, name in futures.items():
+            try:
+                paths.extend(future.result())
+            except (KeyError, ValueError, OSError) as e:
+                failed.append(name)
+                print(f"Error exporting {name}: {e}")
+                continue
+            print(f"Exported {name}")
+
+    print(f"\n{len(pairs) + 1 - len(failed)}/{len(pairs) + 1} of the master and pairs "
+          f"exported to {output_dir}")
+    if failed:
+        print('Failed: ' + ', '.join(failed))
+    if inps.compare:
+        print(f"\nComparison with {inps.compare}:")
+        if not compare_outputs(paths, output_dir, os.path.abspath(inps.compare)):
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
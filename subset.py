@@ -6,11 +6,16 @@
 ##################################
 
 import argparse
-import glob
 import os
-import subprocess
 import sys
 import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import gpt_runner
+import job_stats
+import product_format
+from job_manifest import JobManifest
 
 SUBSET_RDC_XML = """<graph id="Graph">
   <version>1.0</version>
@@ -117,6 +122,8 @@ SUBSET_GEO_XML = """<graph id="Graph">
 EXAMPLE = """Example:
   python3 subset.py /ly/coreg /ly/coreg_subset geo 100 101 40 41
   python3 subset.py /ly/coreg /ly/coreg_subset rdc 1 1000 1 1000
+  python3 subset.py /ly/coreg /ly/coreg_subset rdc 1 1000 1 1000 --jobs 8
+  python3 subset.py /ly/coreg /ly/coreg_subset rdc 1 1000 1 1000 --native
 """
 
 
@@ -134,11 +141,73 @@ def cmdline_parser():
                         'for rdc: start_x, end_x, start_y, end_y',
                         type=float,
                         nargs=4)
+    parser.add_argument('--native',
+                        action='store_true',
+                        help='for rdc: copy the window of every band without gpt ' +
+                        '(needs numpy)')
+    gpt_runner.add_runner_arguments(parser)
+    gpt_runner.add_batch_argument(parser)
+    product_format.add_format_argument(parser)
     inps = parser.parse_args()
 
     return inps
 
 
+def native_subset(dim, output_file, region, log_path):
+    """Subset one product with dimap.subset_product, return (returncode, seconds).
+
+    A traceback goes to log_path like the gpt output of a job.
+    """
+    import dimap  # needs numpy, only for --native
+
+    start = time.time()
+    if os.path.isfile(log_path):
+        os.remove(log_path)
+    try:
+        dimap.subset_product(dim, output_file, region)
+        returncode = 0
+    except Exception:
+        with open(log_path, 'w') as f:
+            f.write(traceback.format_exc())
+        returncode = 1
+
+    return returncode, time.time() - start
+
+
+def run_native(jobs, inps, xml_dir, region):
+    """Run the rdc subset jobs in a process pool instead of gpt.
+
+    The jobs are recorded in the manifest like gpt jobs, so reruns skip
+    products that are up to date whichever way they were made.
+    """
+    manifest = JobManifest(os.path.join(xml_dir, 'manifest.json'))
+    with ProcessPoolExecutor(max_workers=max(1, inps.jobs)) as executor:
+        futures = {}
+        for job in jobs:
+            with open(job.xml_path, 'w+') as f:
+                f.write(job.xml_data)
+            if not inps.force and manifest.is_up_to_date(job):
+                job.skipped = True
+                job.returncode = 0
+                print(f"Skip {job.name}, output is up to date.")
+                continue
+            futures[job] = executor.submit(native_subset, job.inputs[0],
+                                           job.outputs[0], region, job.log_path)
+
+        for index, (job, future) in enumerate(futures.items(), 1):
+            job.returncode, job.time = future.result()
+            job.stats['output_size'] = job_stats.output_size(job)
+            manifest.update(job)
+            if job.returncode == 0:
+                print(f"[{index}/{len(futures)}] Finished {job.name} in "
+                      f"{job.time:.1f} seconds.")
+            else:
+                print(f"Error processing {job.name}, see {job.log_path}")
+
+    job_stats.write_report(jobs, xml_dir)
+    gpt_runner.print_summary(jobs)
+
+
 if __name__ == "__main__":
     # get inputs
     inps = cmdline_parser()
@@ -161,9 +230,16 @@ if __name__ == "__main__":
     if flag not in ['geo', 'rdc']:
         sys.exit("Error flag, please set flag to geo or rdc.")
 
-    dims = glob.glob(os.path.join(input_dir, "*.dim"))
+    if inps.native and (flag != 'rdc' or inps.queue):
+        sys.exit("Error, --native only works with rdc and without --queue.")
+
+    dims = product_format.find_products(input_dir)
     if len(dims) == 0:
-        sys.exit(f"Cannot find any dim file in {input_dir}")
+        sys.exit(f"Cannot find any product in {input_dir}")
+
+    if inps.native and (inps.format != 'BEAM-DIMAP' or
+                        any(not dim.endswith('.dim') for dim in dims)):
+        sys.exit("Error, --native reads and writes BEAM-DIMAP products only.")
 
     if flag == 'geo':
         region = [str(i) for i in region]
@@ -177,35 +253,26 @@ if __name__ == "__main__":
 
     xml_data = xml_data.replace('POLYGON', polygon)
 
+    jobs = []
     for dim in dims:
-        index = dims.index(dim) + 1
         dim_name = os.path.basename(dim)
-        print(f"\n[{index}/{len(dims)}] Processing file: {dim_name}\n")
+        stem = product_format.product_stem(dim)
 
         xml_data_out = xml_data
         xml_data_out = xml_data_out.replace('INPUT_FILE', dim)
 
-        output_file = os.path.join(output_dir, dim_name)
+        output_file = os.path.join(output_dir, stem + '.dim')
         xml_data_out = xml_data_out.replace('OUTPUT_FILE', output_file)
 
-        xml_name = dim_name[0:-4] + '_subset.xml'
+        xml_name = stem + '_subset.xml'
         xml_path = os.path.join(xml_dir, xml_name)
-        with open(xml_path, 'w+') as f:
-            f.write(xml_data_out)
+        jobs.append(
+            gpt_runner.GptJob(dim_name, xml_path, xml_data_out, [dim],
+                              [output_file]))
+    product_format.use_format(jobs, inps.format)
 
-        args = ['gpt', xml_path]
-        process = subprocess.Popen(args,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-        time_start = time.time()
-
-        stdout = process.communicate()[0]
-        print(str(stdout, encoding='utf-8'))
-
-        time_delta = time.time() - time_start
-        print('Finished in {} seconds.'.format(time_delta))
-
-        if process.returncode != 0:
-            print('Error subset with file {}\n'.format(dim_name))
-        else:
-            print('Complete subset with file {}\n'.format(dim_name))
\ No newline at end of file
+    if inps.native:
+        # the same rectangle x, y, width, height the Subset graph gets
+        run_native(jobs, inps, xml_dir, [int(i) for i in polygon.split(',')])
+    else:
+        gpt_runner.run_stage(jobs, inps, xml_dir, inps.batch_size)
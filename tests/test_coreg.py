@@ -0,0 +1,92 @@
+import re
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import coreg
+
+MASTER = '/ly/slc/20200106_IW1.dim'
+SLAVES = ['/ly/slc/20200118_IW1.dim', '/ly/slc/20200130_IW1.dim',
+          '/ly/slc/20200211_IW1.dim']
+SLAVE_SUFFIXES = ['_slv1_18Jan2020', '_slv2_30Jan2020', '_slv3_11Feb2020']
+
+# bands of a Back-Geocoding, ESD and Deburst product of SLAVES, named as SNAP
+# names the master and the numbered slaves of a stack
+STACK_BANDS = [
+    f"{kind}_IW1_VV{suffix}"
+    for suffix in ['_mst_06Jan2020'] + SLAVE_SUFFIXES
+    for kind in ['i', 'q', 'Intensity']
+]
+
+
+def graph_nodes(xml_data):
+    return {node.get('id'): node for node in ET.fromstring(xml_data).findall('node')}
+
+
+def test_stack_job_selects_master_and_one_slave_per_pair():
+    job = coreg.coreg_stack_job(MASTER, SLAVES, '/ly/coreg', '/ly/coreg/xml', '/ly/ifg')
+    nodes = graph_nodes(job.xml_data)
+    assert nodes['Enhanced-Spectral-Diversity'].findtext(
+        'parameters/maxTemporalBaseline') == str(len(SLAVES))
+
+    for k, (slave, suffix) in enumerate(zip(SLAVES, SLAVE_SUFFIXES), start=1):
+        pattern = nodes[f"BandSelect({k})"].findtext('parameters/bandNamePattern')
+        # BandSelect keeps the bands whose whole name matches
+        selected = [b for b in STACK_BANDS if re.fullmatch(pattern, b)]
+        assert selected == [b for b in STACK_BANDS if '_mst_' in b or b.endswith(suffix)]
+
+        pair = f"20200106_{slave[8:16]}_IW1.dim"
+        assert nodes[f"Write({k})"].findtext('parameters/file') == f"/ly/coreg/{pair}"
+        assert nodes[f"Interferogram({k})"].find('sources/sourceProduct').get(
+            'refid') == f"BandSelect({k})"
+        assert nodes[f"Write-Interferogram({k})"].findtext(
+            'parameters/file') == f"/ly/ifg/{pair}"
+        assert job.outputs[k - 1] == f"/ly/coreg/{pair}"
+        assert job.outputs[len(SLAVES) + k - 1] == f"/ly/ifg/{pair}"
+
+
+DIM = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<Dimap_Document name="20200106_20200130_IW1.dim">
+  <Dataset_Sources>
+    <MDElem name="metadata">
+      <MDElem name="Abstracted_Metadata">
+        <MDATTR name="first_line_time">06-JAN-2020 10:58:44.123456</MDATTR>
+      </MDElem>
+      <MDElem name="Slave_Metadata">
+        <MDElem name="20200118_IW1">
+          <MDATTR name="first_line_time">18-JAN-2020 10:58:44.123456</MDATTR>
+        </MDElem>
+        <MDElem name="20200130_IW1">
+          <MDATTR name="first_line_time">30-JAN-2020 10:58:44.123456</MDATTR>
+        </MDElem>
+      </MDElem>
+    </MDElem>
+  </Dataset_Sources>
+</Dimap_Document>
+"""
+
+
+def test_stack_job_keeps_only_the_pair_slave_metadata(tmp_path):
+    job = coreg.coreg_stack_job(MASTER, SLAVES, str(tmp_path), str(tmp_path))
+    dim_path = job.outputs[1]
+    local = str(tmp_path / 'local.dim')
+    with open(local, 'w') as f:
+        f.write(DIM)
+
+    # the post step of the second pair, on its local copy
+    function, args = job.post_steps[1]
+    function(*args, {dim_path: local})
+
+    root = ET.parse(local).getroot()
+    slaves = root.find(".//MDElem[@name='Slave_Metadata']").findall('MDElem')
+    assert [s.get('name') for s in slaves] == ['20200130_IW1']
+    assert root.find(".//MDElem[@name='Abstracted_Metadata']") is not None
+
+
+def test_keep_slave_metadata_fails_without_the_slave(tmp_path):
+    local = str(tmp_path / 'local.dim')
+    with open(local, 'w') as f:
+        f.write(DIM)
+
+    with pytest.raises(ValueError):
+        coreg.keep_slave_metadata([local], '20200211', {})
@@ -0,0 +1,15 @@
+import gpt_runner
+
+
+def test_job_levels_of_a_long_chain():
+    jobs = []
+    for i in range(5000):
+        job = gpt_runner.GptJob(f"job {i}", f"/ly/xml/job_{i}.xml", '')
+        job.deps = jobs[-1:]
+        jobs.append(job)
+    side = gpt_runner.GptJob('side', '/ly/xml/side.xml', '', deps=[jobs[0], jobs[2]])
+
+    levels = gpt_runner.job_levels(jobs + [side])
+
+    assert [levels[j] for j in jobs] == list(range(5000))
+    assert levels[side] == 3
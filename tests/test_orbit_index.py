@@ -0,0 +1,36 @@
+import os
+
+import gpt_runner
+import orbit_index
+import queue_worker
+import work_queue
+
+ZIP = 'S1A_IW_SLC__1SDV_20220105T104925_20220105T104952_041322_04E9B7_1A2B.zip'
+EOF_NAME = 'S1A_OPER_AUX_POEORB_OPOD_20220125T081613_V20220104T225942_20220106T005942.EOF'
+XML_DATA = ("<operator>Apply-Orbit-File</operator>"
+            "<orbitType>Sentinel Precise (Auto Download)</orbitType>")
+
+
+def test_orbit_is_placed_by_the_queued_job(tmp_path):
+    orbit_dir = tmp_path / 'orbits'
+    orbit_dir.mkdir()
+    (orbit_dir / EOF_NAME).write_text('')
+    snap_orbit_dir = str(tmp_path / 'snap')
+    job = gpt_runner.GptJob('split', str(tmp_path / 'split.xml'), XML_DATA,
+                            [str(tmp_path / ZIP)])
+
+    path = orbit_index.use_local_orbit(job, orbit_index.OrbitIndex(str(orbit_dir)),
+                                       snap_orbit_dir)
+    assert path == str(orbit_dir / EOF_NAME)
+    # nothing is placed on the host planning the jobs
+    assert not os.path.exists(snap_orbit_dir)
+
+    (tmp_path / 'split.xml').write_text(job.xml_data)
+    queue = work_queue.WorkQueue(str(tmp_path / 'queue'))
+    queue.enqueue(job)
+    _, entry = queue.claim('worker')
+    for function, args in queue_worker.queue_job(entry).pre_steps:
+        function(*args)
+
+    target = os.path.join(snap_orbit_dir, 'POEORB', 'S1A', '2022', '01', EOF_NAME)
+    assert os.path.realpath(target) == path
@@ -0,0 +1,52 @@
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import coreg
+import gpt_runner
+import ifg
+import prepare_dem
+import split_coreg
+
+DEM_FILE = '/ly/dem/dem.tif'
+DEM_OPERATORS = ('Back-Geocoding', 'Interferogram')
+
+
+def template_job(xml_data):
+    return gpt_runner.GptJob('job', '/ly/xml/job.xml', xml_data)
+
+
+def graph_jobs():
+    yield template_job(coreg.COREG_XML)
+    yield template_job(coreg.COREG_IFG_XML)
+    yield coreg.coreg_stack_job('/ly/slc/20200118_IW1.dim',
+                                ['/ly/slc/20200130_IW1.dim', '/ly/slc/20200211_IW1.dim'],
+                                '/ly/coreg', '/ly/coreg/xml', '/ly/ifg')
+    yield template_job(split_coreg.SPLIT_ORBIT_COREG_XML)
+    yield template_job(split_coreg.ASSEMBLY_SPLIT_ORBIT_COREG_XML)
+    yield template_job(ifg.IFG_XML)
+
+
+@pytest.mark.parametrize('job', list(graph_jobs()), ids=lambda job: job.xml_path)
+def test_external_dem_applies_egm_in_every_dem_node(job):
+    prepare_dem.use_external_dem(job, DEM_FILE)
+
+    root = ET.fromstring(job.xml_data)
+    nodes = [n for n in root.iter('node') if n.findtext('operator') in DEM_OPERATORS]
+    assert nodes
+    for node in nodes:
+        parameters = node.find('parameters')
+        assert parameters.findtext('demName') == 'External DEM'
+        assert parameters.findtext('externalDEMFile') == DEM_FILE
+        assert [e.text for e in parameters.iter('externalDEMApplyEGM')] == ['true']
+    assert job.inputs[-1] == DEM_FILE
+
+
+def test_external_dem_forces_egm_on():
+    job = template_job(ifg.IFG_XML.replace(
+        '<externalDEMApplyEGM>true</externalDEMApplyEGM>',
+        '<externalDEMApplyEGM>false</externalDEMApplyEGM>'))
+    prepare_dem.use_external_dem(job, DEM_FILE)
+
+    assert '<externalDEMApplyEGM>false' not in job.xml_data
+    assert '<externalDEMApplyEGM>true</externalDEMApplyEGM>' in job.xml_data
@@ -0,0 +1,34 @@
+import os
+
+import psi_export
+
+
+def test_only_the_master_job_exports_into_the_stamps_folder(tmp_path):
+    output_dir, xml_dir = str(tmp_path / 'INSAR_20200106'), str(tmp_path / 'xml')
+    master, pair = [
+        psi_export.psi_export_job(f"/ly/coreg/20200106_{date}_IW1.dim",
+                                  f"/ly/ifg/20200106_{date}_IW1.dim", output_dir,
+                                  xml_dir, master=(date == '20200118'))
+        for date in ['20200118', '20200130']
+    ]
+    rslc = os.path.join(output_dir, 'rslc', '20200106.rslc')
+
+    assert not master.deps and not pair.deps
+    assert f"<targetFolder>{output_dir}</targetFolder>" in master.xml_data
+    assert rslc in master.outputs and rslc + '.par' in master.outputs
+    assert not master.post_steps
+    assert output_dir + '<' not in pair.xml_data
+    assert rslc not in pair.outputs
+
+    # StampsExport of the pair writes into its own folder, with the master
+    (function, args), = pair.post_steps
+    export_dir = args[0]
+    for name in psi_export.pair_files(pair.inputs[0]) + ['rslc/20200106.rslc']:
+        path = os.path.join(export_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+    function(*args, {})
+
+    assert sorted(pair.outputs) == sorted(
+        p for p in (os.path.join(r, f) for r, _, fs in os.walk(output_dir) for f in fs))
+    assert not os.path.exists(export_dir)
@@ -0,0 +1,31 @@
+import pytest
+
+import s1_index
+
+
+@pytest.mark.parametrize('values, bbox', [
+    (['100.1', '100.5', '40.2', '40.4'], [100.1, 100.5, 40.2, 40.4]),
+    (['.5', '+10', '-1e1', '4.5E1'], [0.5, 10.0, -10.0, 45.0]),
+    (['POLYGON', '((100', '40,', '101', '40,', '101', '41,', '100', '40))'],
+     [100.0, 101.0, 40.0, 41.0]),
+    (['polygon((-.5 1e1,0.5 10,0.5 11,-.5 10), (0 10.2,0.1 10.2,0 10.3,0 10.2))'],
+     [-0.5, 0.5, 10.0, 11.0]),
+])
+def test_parse_aoi(values, bbox):
+    assert s1_index.parse_aoi(values) == bbox
+
+
+@pytest.mark.parametrize('values', [
+    ['100.1', '100.5', '40.2'],
+    ['100.1', '100.5', '40.2', '40.4', '1'],
+    ['box', '100.1', '100.5', '40.2'],
+    ['100.5', '100.1', '40.2', '40.4'],
+    ['POLYGON ((100 40, 101 40, 101 41))'],
+    ['POLYGON ((100 40, 101 40, 101 41, 100 41))'],
+    ['POLYGON ((100 40, 101 40, 101, 100 40))'],
+    ['POLYGON ((100 40 5, 101 40 5, 101 41 5, 100 40 5))'],
+    ['LINESTRING (100 40, 101 41)'],
+])
+def test_parse_aoi_rejects_malformed(values):
+    with pytest.raises(ValueError):
+        s1_index.parse_aoi(values)
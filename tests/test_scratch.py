@@ -0,0 +1,56 @@
+import os
+
+import gpt_runner
+import scratch
+
+
+def make_job(tmp_path, name, size):
+    src = tmp_path / 'src'
+    src.mkdir(exist_ok=True)
+    input_file = src / f"{name}_in.tif"
+    with open(input_file, 'wb') as f:
+        f.truncate(size * 2**20)
+    output_file = str(tmp_path / 'out' / f"{name}_out.tif")
+    xml_data = f"<file>{input_file}</file><file>{output_file}</file>"
+    return gpt_runner.GptJob(name, str(tmp_path / f"{name}.xml"), xml_data,
+                             [str(input_file)], [output_file])
+
+
+def write_outputs(staging, job):
+    for local in staging.jobs[job][1].values():
+        with open(local, 'wb') as f:
+            f.truncate(os.path.getsize(job.inputs[0]))
+
+
+def test_outputs_are_reserved_until_copied_back(tmp_path):
+    staging = scratch.Scratch(str(tmp_path / 'scratch'), capacity=10)
+    first = make_job(tmp_path, 'first', 3)
+    second = make_job(tmp_path, 'second', 3)
+
+    staging.stage(first)
+    assert staging.reserved[first] == 3
+    assert staging.used() == 6
+
+    # 3M of inputs fit, 3M more of outputs do not
+    xml_path = staging.stage(second)
+    assert second not in staging.reserved
+    assert second.outputs[0] in open(xml_path).read()
+
+    write_outputs(staging, first)
+    staging.copy_back(first).result()
+    assert first not in staging.reserved
+    assert os.path.getsize(first.outputs[0]) == 3 * 2**20
+    staging.close()
+
+
+def test_stage_falls_back_to_the_real_paths(tmp_path):
+    staging = scratch.Scratch(str(tmp_path / 'scratch'), capacity=10)
+    job = make_job(tmp_path, 'job', 3)
+    # the graph cannot be written to the scratch directory
+    os.rmdir(os.path.join(staging.scratch_dir, 'xml'))
+
+    assert staging.stage(job) == job.xml_path
+    assert job not in staging.reserved
+    assert staging.written_outputs(job) == {}
+    assert all(entry['refs'] == 0 for entry in staging.entries.values())
+    staging.close()
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import stamps_export
+
+PAR = "range_pixel_spacing:   2.329562   m\nazimuth_lines:   1500\n"
+
+
+def write_tree(root):
+    files = {
+        os.path.join('rslc', '20200118.rslc'): b'\x00\x01\x02\x03',
+        os.path.join('rslc', '20200118.rslc.par'): PAR.encode(),
+        os.path.join('diff0', '20200106_20200118.diff'): b'\x04\x05\x06\x07',
+    }
+    paths = []
+    for name, data in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+
+    return paths
+
+
+@pytest.fixture
+def trees(tmp_path):
+    mine, snap = str(tmp_path / 'native'), str(tmp_path / 'snap')
+    return write_tree(mine), mine, snap, write_tree(snap)
+
+
+def test_identical_trees_match(trees):
+    paths, mine, snap, _ = trees
+    assert stamps_export.compare_outputs(paths, mine, snap)
+
+
+def test_parameter_value_off_fails(trees):
+    paths, mine, snap, _ = trees
+    with open(os.path.join(snap, 'rslc', '20200118.rslc.par'), 'w') as f:
+        f.write(PAR.replace('2.329562', '2.329662'))
+    assert not stamps_export.compare_outputs(paths, mine, snap)
+
+
+def test_raster_byte_off_fails(trees):
+    paths, mine, snap, _ = trees
+    with open(os.path.join(snap, 'diff0', '20200106_20200118.diff'), 'r+b') as f:
+        f.write(b'\xff')
+    assert not stamps_export.compare_outputs(paths, mine, snap)
+
+
+def test_file_missing_in_snap_dir_fails(trees):
+    paths, mine, snap, _ = trees
+    os.remove(os.path.join(snap, 'rslc', '20200118.rslc'))
+    assert not stamps_export.compare_outputs(paths, mine, snap)
@@ -0,0 +1,40 @@
+import os
+import time
+
+import gpt_runner
+import work_queue
+
+
+def make_queue(tmp_path, lease_timeout=work_queue.LEASE_TIMEOUT):
+    queue = work_queue.WorkQueue(str(tmp_path / 'queue'), lease_timeout)
+    queue.enqueue(gpt_runner.GptJob('job', str(tmp_path / 'job.xml'), ''))
+    return queue
+
+
+def test_finish_after_requeue_leaves_job_to_new_worker(tmp_path):
+    queue = make_queue(tmp_path, lease_timeout=0)
+    job_id, first = queue.claim('first')
+    assert queue.requeue_expired() == [job_id]
+    _, second = queue.claim('second')
+
+    first['returncode'] = 0
+    assert not queue.finish(job_id, first)
+    assert queue.counts()['running'] == 1
+    assert queue.holds_lease(job_id, second['lease'])
+
+    second['returncode'] = 0
+    assert queue.finish(job_id, second)
+    assert queue.counts() == {'pending': 0, 'running': 0, 'done': 1, 'failed': 0}
+
+
+def test_only_the_lease_holder_renews_it(tmp_path):
+    queue = make_queue(tmp_path, lease_timeout=1)
+    job_id, entry = queue.claim('worker')
+    time.sleep(1.2)
+    queue.heartbeat(job_id, entry['lease'])
+    assert queue.requeue_expired() == []
+
+    queue.heartbeat(job_id, 'other:lease')
+    time.sleep(1.2)
+    assert queue.requeue_expired() == [job_id]
+    assert not os.path.exists(os.path.join(queue.path, f".clock-{work_queue.worker_name()}"))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+##################################
+# Program is part of SNAP2StaMPS #
+# Copyright (c) 2022, Lei Yuan   #
+# Author: Lei Yuan, 2022         #
+##################################
+
+import importlib
+import json
+import os
+import socket
+import sys
+import threading
+import uuid
+
+QUEUE_STATES = ['pending', 'running', 'done', 'failed']
+HEARTBEAT_INTERVAL = 30
+LEASE_TIMEOUT = 300
+
+
+class WorkQueue:
+    """Queue of gpt jobs kept as files in a directory on a shared filesystem.
+
+    Each job is a JSON file that moves between the pending, running, done
+    and failed subdirectories by os.rename, which is atomic on local and
+    NFS filesystems, so only one worker can claim a job. A running job has
+    a .lease file holding the token of its claim, which its worker touches
+    every heartbeat interval; jobs whose lease expired are requeued by any
+    other worker. Lease times are compared with the clock of the file
+    server, not of the node, so clock skew between nodes does not matter.
+    """
+
+    def __init__(self, path, lease_timeout=LEASE_TIMEOUT):
+        self.path = path
+        self.lease_timeout = lease_timeout
+        for state in QUEUE_STATES:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def job_path(self, state, job_id, ext='.json'):
+        return os.path.join(self.path, state, job_id + ext)
+
+    def job_ids(self, state):
+        return sorted(f[0:-5] for f in os.listdir(os.path.join(self.path, state))
+                      if f.endswith('.json'))
+
+    def enqueue(self, job, state='pending'):
+        """Add a GptJob, its dependencies must be enqueued as well."""
+        job_id = queue_id(job)
+        entry = {
+            'name': job.name,
+            'xml_path': job.xml_path,
+            'inputs': job.inputs,
+            'outputs': job.outputs,
+            'deps': [queue_id(dep) for dep in job.deps],
+            'pre_steps': [[function_name(f), args] for f, args in job.pre_steps],
+            'post_steps': [[function_name(f), args] for f, args in job.post_steps],
+        }
+        for old_state in QUEUE_STATES:
+            for ext in ['.json', '.lease']:
+                if os.path.exists(self.job_path(old_state, job_id, ext)):
+                    os.remove(self.job_path(old_state, job_id, ext))
+
+        tmp_path = self.job_path(state, job_id, '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f, indent=2)
+        os.replace(tmp_path, self.job_path(state, job_id))
+
+    def claim(self, worker):
+        """Move a pending job with finished dependencies to running.
+
+        Return (job_id, entry), or None if no job can be started now.
+        """
+        done = set(self.job_ids('done'))
+        failed = set(self.job_ids('failed'))
+        for job_id in self.job_ids('pending'):
+            try:
+                with open(self.job_path('pending', job_id), 'r') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            if any(dep in failed for dep in entry['deps']):
+                entry['error'] = 'a job it depends on failed'
+                self.move(job_id, entry, 'pending', 'failed')
+                continue
+            if not all(dep in done for dep in entry['deps']):
+                continue
+
+            try:
+                os.rename(self.job_path('pending', job_id),
+                          self.job_path('running', job_id))
+            except FileNotFoundError:
+                # claimed by another worker in the meantime
+                continue
+            entry['worker'] = worker
+            entry['lease'] = f"{worker}:{uuid.uuid4().hex}"
+            tmp_path = self.job_path('running', job_id, '.lease.tmp')
+            with open(tmp_path, 'w') as f:
+                f.write(entry['lease'])
+            os.replace(tmp_path, self.job_path('running', job_id, '.lease'))
+
+            return job_id, entry
+
+        return None
+
+    def holds_lease(self, job_id, lease):
+        """Check whether lease, the token of a claim, still holds job_id."""
+        try:
+            with open(self.job_path('running', job_id, '.lease'), 'r') as f:
+                return f.read() == lease
+        except FileNotFoundError:
+            return False
+
+    def heartbeat(self, job_id, lease):
+        """Renew the lease of a running job if it is still held by lease."""
+        if self.holds_lease(job_id, lease):
+            try:
+                os.utime(self.job_path('running', job_id, '.lease'))
+            except FileNotFoundError:
+                pass
+
+    def move(self, job_id, entry, state_from, state_to):
+        """Write entry to state_to and remove the job from state_from."""
+        tmp_path = self.job_path(state_to, job_id, '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f, indent=2)
+        os.replace(tmp_path, self.job_path(state_to, job_id))
+        for ext in ['.json', '.lease']:
+            try:
+                os.remove(self.job_path(state_from, job_id, ext))
+            except FileNotFoundError:
+                pass
+
+    def finish(self, job_id, entry):
+        """Move a running job to done or failed by its return code.
+
+        Return False if the job was requeued while it ran, then it is left
+        to the worker that claimed it since.
+        """
+        if not (os.path.exists(self.job_path('running', job_id)) and
+                self.holds_lease(job_id, entry['lease'])):
+            return False
+
+        state = 'done' if entry.get('returncode') == 0 else 'failed'
+        self.move(job_id, entry, 'running', state)
+        return True
+
+    def fs_time(self):
+        """Return the current time of the filesystem of the queue.
+
+        Touching a file sets its mtime from the clock of the file server,
+        like the heartbeats do, so this probe file gives the time leases
+        are compared with.
+        """
+        probe = os.path.join(self.path, f".clock-{worker_name()}")
+        with open(probe, 'a'):
+            pass
+        os.utime(probe)
+        now = os.stat(probe).st_mtime
+        os.remove(probe)
+
+        return now
+
+    def requeue_expired(self):
+        """Move running jobs whose lease expired back to pending."""
+        requeued = []
+        now = self.fs_time()
+        for job_id in self.job_ids('running'):
+            stamps = []
+            for ext in ['.json', '.lease']:
+                try:
+                    stat = os.stat(self.job_path('running', job_id, ext))
+                    # rename updates ctime, touching the lease its mtime
+                    stamps.append(max(stat.st_mtime, stat.st_ctime))
+                except FileNotFoundError:
+                    continue
+            if stamps and now - max(stamps) < self.lease_timeout:
+                continue
+
+            # the lease goes first, so that it is never taken for the lease
+            # of a worker claiming the job again
+            try:
+                os.remove(self.job_path('running', job_id, '.lease'))
+            except FileNotFoundError:
+                pass
+            try:
+                os.rename(self.job_path('running', job_id),
+                          self.job_path('pending', job_id))
+            except FileNotFoundError:
+                continue
+            requeued.append(job_id)
+
+        return requeued
+
+    def requeue_failed(self):
+        """Move all failed jobs back to pending."""
+        for job_id in self.job_ids('failed'):
+            os.rename(self.job_path('failed', job_id),
+                      self.job_path('pending', job_id))
+
+    def counts(self):
+        return {state: len(self.job_ids(state)) for state in QUEUE_STATES}
+
+
+class Heartbeat(threading.Thread):
+    """Renew the lease of a running job until stop() is called."""
+
+    def __init__(self, queue, job_id, lease, interval=HEARTBEAT_INTERVAL):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.job_id = job_id
+        self.lease = lease
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.queue.heartbeat(self.job_id, self.lease)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+def queue_id(job):
+    """Return the queue id of a job, the name of its graph file."""
+    return os.path.basename(job.xml_path)[0:-4]
+
+
+def function_name(function):
+    """Return module.function of a module level function, also of a script run as main."""
+    module = sys.modules[function.__module__]
+    module_name = os.path.splitext(os.path.basename(module.__file__))[0]
+
+    return f"{module_name}.{function.__name__}"
+
+
+def import_function(name):
+    """Return the function of a name made by function_name."""
+    module_name, function = name.rsplit('.', 1)
+
+    return getattr(importlib.import_module(module_name), function)
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"